@@ -0,0 +1,561 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# Modules that must not be loaded by the inference path (model definition, weight loading, embedding, kNN).
+# tqdm is not checked: torch.hub, imported by torchvision.models, imports it at module level when it is installed
+HEAVY_MODULES = ["faiss", "sklearn", "matplotlib", "pytorch_lightning"]
+
+IMPORT_PROBE = """
+import json, sys, time, resource
+t = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t
+print(json.dumps({{"seconds": elapsed,
+                   "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                   "loaded": [m for m in {heavy} if m in sys.modules]}}))
+"""
+
+def bench_import_time(module="libs.Inference", repeat=3):
+    """
+        Measure in a fresh interpreter the import time of a module and which heavy dependencies it loads.
+        The best of `repeat` runs is returned to reduce the noise of the filesystem cache
+    """
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", IMPORT_PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                                capture_output=True, text=True, check=True)
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return min(runs, key=lambda r: r["seconds"])
+
+def check_import_budget(args):
+    result = bench_import_time(args.module, args.repeat)
+    print("import {}: {:.2f}s, max rss {:.0f} MB, heavy modules loaded: {}".format(
+        args.module, result["seconds"], result["max_rss_mb"], result["loaded"] or "none"))
+
+    if result["loaded"]:
+        sys.exit("{} imports {} at module import time".format(args.module, ", ".join(result["loaded"])))
+    if result["seconds"] > args.budget:
+        sys.exit("import time {:.2f}s is over the budget of {:.2f}s".format(result["seconds"], args.budget))
+
+class RandomTripletDataset:
+    """
+        Triplets of random images with the same layout of TripletTrashbinDataset items
+    """
+    def __init__(self, length, img_size=224, num_class=3):
+        self.length, self.img_size, self.num_class = length, img_size, num_class
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        import torch
+        g = torch.Generator().manual_seed(i)
+        images = torch.randn(3, 3, self.img_size, self.img_size, generator=g)
+        labels = torch.randint(self.num_class, (3,), generator=g).float()
+        return images[0], labels[0], images[1], labels[1], images[2], labels[2]
+
+class SeparableImageDataset:
+    """
+        (image, label) pairs of random images whose mean depends on the label, so that nearest neighbour
+        classification is meaningful also with random weights
+    """
+    def __init__(self, length, img_size=224, num_class=3, seed=0):
+        self.length, self.img_size, self.num_class, self.seed = length, img_size, num_class, seed
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        import torch
+        g = torch.Generator().manual_seed(self.seed * 1000003 + i)
+        label = i % self.num_class
+        image = torch.randn(3, self.img_size, self.img_size, generator=g) + (label - 1)
+        return image, float(label)
+
+def _random_triplet_loader(length, batch_size, img_size, num_workers):
+    import torch.distributed as dist
+    from torch.utils.data import DataLoader
+    from torch.utils.data.distributed import DistributedSampler
+
+    dataset = RandomTripletDataset(length, img_size)
+    sampler = DistributedSampler(dataset, shuffle=False) if dist.is_available() and dist.is_initialized() else None
+    return DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, sampler=sampler)
+
+def _throughput_callback(warmup, result_path):
+    import pytorch_lightning as pl
+
+    class ThroughputCallback(pl.Callback):
+        def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, unused=0):
+            if batch_idx == warmup:
+                self.start = time.perf_counter()
+
+        def on_train_end(self, trainer, pl_module):
+            elapsed = time.perf_counter() - self.start
+            steps = trainer.global_step - warmup
+            if trainer.is_global_zero:
+                with open(result_path, 'w') as f:
+                    json.dump({"world_size": trainer.world_size, "steps": steps, "seconds": elapsed,
+                               "step_seconds": elapsed / steps,
+                               "samples_per_second": steps * pl_module.batch_size * trainer.world_size / elapsed,
+                               "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}, f)
+
+    return ThroughputCallback()
+
+def run_training(args):
+    """
+        Train TripletNetwork on random triplets for a fixed number of steps with `processes` DDP ranks (gloo)
+        and write the throughput and the peak memory measured on rank zero to args.result
+    """
+    import pytorch_lightning as pl
+    from libs.Model import TripletNetwork
+    from libs.Training import CPUThreadsCallback, cpu_split_per_rank, ddp_cpu_trainer_kwargs
+
+    num_threads, num_workers = cpu_split_per_rank(args.processes)
+    trainer_kwargs = ddp_cpu_trainer_kwargs(args.processes) if args.processes > 1 else dict(accelerator="cpu", devices=1)
+    trainer = pl.Trainer(max_steps=args.steps, logger=False, enable_checkpointing=False, enable_progress_bar=False,
+                            enable_model_summary=False, num_sanity_val_steps=0, limit_val_batches=0,
+                            callbacks=[CPUThreadsCallback(num_threads), _throughput_callback(args.warmup, args.result)],
+                            **trainer_kwargs)
+
+    model = TripletNetwork(batch_size=args.batch_size, pretrained=False, bf16=args.bf16, checkpoint_fire=args.checkpoint_fire)
+    length = args.steps * args.batch_size * args.processes
+    trainer.fit(model, train_dataloaders=_random_triplet_loader(length, args.batch_size, args.img_size, num_workers))
+
+def _train_run(args, processes=1, bf16=False, checkpoint_fire=False):
+    """
+        Execute run_training in a fresh interpreter, so that the peak memory is measured per configuration
+    """
+    flags = (["--bf16"] if bf16 else []) + (["--checkpoint-fire"] if checkpoint_fire else [])
+    with tempfile.TemporaryDirectory() as tmp:
+        result_path = os.path.join(tmp, "result.json")
+        subprocess.run([sys.executable, __file__, "train-run", "--processes", str(processes), "--steps", str(args.steps),
+                        "--warmup", str(args.warmup), "--batch-size", str(args.batch_size),
+                        "--img-size", str(args.img_size), "--result", result_path] + flags, check=True)
+        with open(result_path) as f:
+            return json.load(f)
+
+def bench_bf16(args):
+    """
+        Compare float32 and bfloat16 autocast on cpu: training step time, peak memory and the effect
+        on the kNN accuracy (evaluate_classification) of the same weights
+    """
+    import numpy as np
+    import torch
+    from torch.utils.data import DataLoader
+    from libs.Inference import extract_representation, predict_nn, evaluate_classification, model_metric
+    from libs.Model import TripletNetwork
+
+    fp32, bf16 = _train_run(args), _train_run(args, bf16=True)
+    print("{:>9} {:>10} {:>12}".format("", "step (s)", "max rss (MB)"))
+    for name, r in (("float32", fp32), ("bfloat16", bf16)):
+        print("{:>9} {:>10.3f} {:>12.0f}".format(name, r["step_seconds"], r["max_rss_mb"]))
+
+    if args.checkpoint:
+        model = TripletNetwork.load_from_checkpoint(checkpoint_path=args.checkpoint)
+    else:
+        torch.manual_seed(0)
+        model = TripletNetwork(pretrained=False)
+    train_loader = DataLoader(SeparableImageDataset(args.eval_size, args.img_size, seed=0), batch_size=args.batch_size)
+    test_loader = DataLoader(SeparableImageDataset(args.eval_size // 4, args.img_size, seed=1), batch_size=args.batch_size)
+
+    accuracy = {}
+    for name, flag in (("float32", False), ("bfloat16", True)):
+        train_rep, train_label = extract_representation(model, train_loader, bf16=flag)
+        test_rep, test_label = extract_representation(model, test_loader, bf16=flag)
+        accuracy[name] = evaluate_classification(predict_nn(train_rep, test_rep, train_label, metric=model_metric(model)), test_label)
+        if flag:
+            print("relative error of the bfloat16 test embeddings: {:.4f}".format(
+                np.linalg.norm(test_rep - reference) / np.linalg.norm(reference)))
+        reference = test_rep
+    print("accuracy float32 {float32:.4f} bfloat16 {bfloat16:.4f}".format(**accuracy))
+
+    return {"float32": dict(fp32, accuracy=accuracy["float32"]), "bfloat16": dict(bf16, accuracy=accuracy["bfloat16"])}
+
+def bench_checkpointing(args):
+    """
+        Memory/time tradeoff of the activation checkpointing over the Fire modules, for every batch size
+    """
+    results = []
+    print("{:>6} {:>14} {:>14} {:>16} {:>16}".format("batch", "step (s)", "ckpt step (s)", "max rss (MB)", "ckpt rss (MB)"))
+    for batch_size in args.batch_sizes:
+        args.batch_size = batch_size
+        plain, checkpointed = _train_run(args), _train_run(args, checkpoint_fire=True)
+        print("{:>6} {:>14.3f} {:>14.3f} {:>16.0f} {:>16.0f}".format(batch_size, plain["step_seconds"], checkpointed["step_seconds"],
+                                                                    plain["max_rss_mb"], checkpointed["max_rss_mb"]))
+        results.append({"batch_size": batch_size, "plain": plain, "checkpoint_fire": checkpointed})
+    return results
+
+def bench_ddp_scaling(args):
+    """
+        Run run_ddp_training with an increasing number of processes on this host and report the speedup.
+        The batch size is per rank, so the global batch grows with the number of processes
+    """
+    results = [_train_run(args, processes=processes) for processes in args.processes]
+
+    base = results[0]["samples_per_second"] / results[0]["world_size"]
+    print("{:>10} {:>14} {:>8} {:>11}".format("processes", "samples/s", "speedup", "efficiency"))
+    for r in results:
+        speedup = r["samples_per_second"] / base
+        print("{:>10} {:>14.1f} {:>8.2f} {:>10.0%}".format(r["world_size"], r["samples_per_second"], speedup, speedup / r["world_size"]))
+    return results
+
+def make_synthetic_corpus(root, n_per_class=100, width=320, height=240, seed=0):
+    """
+        Write a synthetic three-class trashbin corpus in root/images and its all_labels.csv (image, label):
+        a grey bin on a random background, filled from the bottom with noise up to empty/half/full level.
+        Returns the path of all_labels.csv
+    """
+    import numpy as np
+    import pandas as pd
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(root, "images"), exist_ok=True)
+    rows = []
+    for label in range(3):
+        for i in range(n_per_class):
+            image = np.empty((height, width, 3), dtype=np.uint8)
+            image[:] = rng.integers(0, 256, 3, dtype=np.uint8)
+            x0, x1, y0, y1 = width // 4, 3 * width // 4, height // 6, height - height // 12
+            image[y0:y1, x0:x1] = 128
+            level = y1 - int((y1 - y0) * (0.05 + 0.45 * label) * rng.uniform(0.8, 1.2))
+            image[level:y1, x0 + 4:x1 - 4] = rng.integers(0, 256, (y1 - level, x1 - x0 - 8, 3), dtype=np.uint8)
+            path = os.path.abspath(os.path.join(root, "images", "synthetic_{}_{}.jpg".format(label, i)))
+            Image.fromarray(image).save(path, quality=90)
+            rows.append((path, label))
+
+    all_labels_path = os.path.join(root, "all_labels.csv")
+    pd.DataFrame(rows, columns=["image", "label"]).to_csv(all_labels_path, index=False)
+    return all_labels_path
+
+def make_synthetic_splits(root, n_per_class=100, seed=0):
+    """
+        Synthetic corpus in root with the triplet_training/validation/test.csv read by TripletTrashbinDataModule
+    """
+    import numpy as np
+    import pandas as pd
+    from libs.Dataset import create_triplet_csv, split_train_val_test
+
+    np.random.seed(seed)
+    all_labels_path = make_synthetic_corpus(root, n_per_class, seed=seed)
+    triplet_path = os.path.join(root, "all_labels_triplet.csv")
+    create_triplet_csv(all_labels_path, triplet_path)
+    train, val, test = split_train_val_test(pd.read_csv(triplet_path), [0.7, 0.15, 0.15])
+    for df, name in ((train, "triplet_training.csv"), (val, "triplet_validation.csv"), (test, "triplet_test.csv")):
+        df.to_csv(os.path.join(root, name), index=False)
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _step_timer():
+    import pytorch_lightning as pl
+
+    class StepTimer(pl.Callback):
+        """
+            Duration of every training step (training_step, backward and optimizer step), data loading excluded
+        """
+        def __init__(self):
+            self.durations = []
+
+        def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, unused=0):
+            self.start = time.perf_counter()
+
+        def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, unused=0):
+            self.durations.append(time.perf_counter() - self.start)
+
+    return StepTimer()
+
+def _batch_recorder():
+    import hashlib
+    import pytorch_lightning as pl
+
+    class BatchRecorder(pl.Callback):
+        """
+            Fingerprint of every training batch, in order
+        """
+        def __init__(self):
+            self.batches = []
+
+        def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, unused=0):
+            self.batches.append(hashlib.sha1(batch[0].numpy().tobytes()).hexdigest()[:12])
+
+    return BatchRecorder()
+
+def check_resume(args):
+    """
+        Train for --steps steps without interruption, then again stopping after --stop-at steps with a mid-epoch
+        checkpoint and resuming from it: the batches of the resumed run must be the ones the uninterrupted run
+        read after step --stop-at. Without data augmentation, so the batches are identical
+    """
+    import pytorch_lightning as pl
+    import torch
+    from pytorch_lightning.callbacks import ModelCheckpoint
+    from libs.Callbacks import ResumableSamplerCallback
+    from libs.Dataset import TripletTrashbinDataModule
+    from libs.Model import TripletNetwork
+
+    def fit(root, max_steps, callbacks, ckpt_path=None):
+        torch.manual_seed(0)
+        dm = TripletTrashbinDataModule(img_size=args.img_size, batch_size=args.batch_size, num_workers=args.workers,
+                                        data_augmentation=False, dst_main_path=root, shuffle=args.shuffle)
+        recorder = _batch_recorder()
+        trainer = pl.Trainer(max_steps=max_steps, accelerator="cpu", devices=1, logger=False, enable_progress_bar=False,
+                                enable_model_summary=False, num_sanity_val_steps=0, limit_val_batches=0,
+                                enable_checkpointing=any(isinstance(c, ModelCheckpoint) for c in callbacks),
+                                callbacks=[ResumableSamplerCallback(), recorder] + callbacks)
+        trainer.fit(TripletNetwork(batch_size=args.batch_size, pretrained=False), datamodule=dm, ckpt_path=ckpt_path)
+        return recorder.batches, len(dm.train_dataloader())
+
+    with tempfile.TemporaryDirectory() as root:
+        make_synthetic_splits(root, args.images_per_class)
+        reference, batches_per_epoch = fit(root, args.steps, [])
+        interrupted, _ = fit(root, args.stop_at, [ModelCheckpoint(dirpath=root, every_n_train_steps=args.stop_at, save_last=True)])
+        resumed, _ = fit(root, args.steps, [], ckpt_path=os.path.join(root, "last.ckpt"))
+
+    print("{} batches per epoch, interrupted after {} steps, resumed for {} steps".format(batches_per_epoch, len(interrupted), len(resumed)))
+    if interrupted + resumed != reference:
+        sys.exit("the resumed run does not continue the batch sequence of the uninterrupted run")
+    print("resumed batch sequence matches the uninterrupted run")
+
+def bench_decoders(args):
+    """
+        Seconds per image of the decoding backends of libs.Decoders on the given images (a synthetic corpus if none),
+        the fastest ones by file type are written to --output as the preferences of TripletTrashbinDataModule(decoders=...)
+    """
+    import glob
+    from libs.Decoders import benchmark_decoders, fastest_preferences
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.images:
+            paths = sorted({p for pattern in args.images for p in glob.glob(pattern, recursive=True) if os.path.isfile(p)})
+        else:
+            make_synthetic_corpus(tmp, args.images_per_class)
+            paths = sorted(glob.glob(os.path.join(tmp, "images", "*.jpg")))
+        results = benchmark_decoders(paths[:args.limit], repeat=args.repeat)
+
+    for ext, seconds in results.items():
+        for name, s in sorted(seconds.items(), key=lambda item: item[1]):
+            print("{:<6} {:<12} {:>8.2f} ms/image".format(ext, name, 1000 * s))
+    preferences = fastest_preferences(results)
+    with open(args.output, "w") as f:
+        json.dump(preferences, f, indent=2)
+    print("preferences written to {}".format(args.output))
+    return results
+
+def bench_transport(args):
+    """
+        float32 vs uint8 transport of the training batches (TripletTrashbinDataModule(uint8_transport=...)):
+        bytes of the images of a batch sent by the workers, collate time and loading throughput
+    """
+    import numpy as np
+    from torch.utils.data.dataloader import default_collate
+    from libs.Dataset import TripletTrashbinDataModule
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        make_synthetic_splits(tmp, args.images_per_class)
+        for name, uint8 in (("float32", False), ("uint8", True)):
+            dm = TripletTrashbinDataModule(img_size=args.img_size, batch_size=args.batch_size, num_workers=args.workers,
+                                           dst_main_path=tmp, validate_images=False, uint8_transport=uint8)
+            dm.setup()
+            samples = [dm.trb_train[i] for i in range(args.batch_size)]
+            collate = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                default_collate(samples)
+                collate.append(time.perf_counter() - start)
+
+            batches, items, start = 0, 0, time.perf_counter()
+            for batch in dm.train_dataloader():
+                # the first batch is a full one, the last can be shorter
+                if batches == 0:
+                    batch_bytes = sum(x.element_size() * x.nelement() for x in batch[0::2])
+                batches += 1
+                items += len(batch[0])
+            seconds = time.perf_counter() - start
+            results[name] = {"batch_mb": batch_bytes / 2 ** 20, "collate_ms": 1000 * float(np.median(collate)),
+                             "items_per_second": items / seconds, "batches": batches}
+
+    for name, r in results.items():
+        print("{:>8} {:>8.2f} MB/batch {:>8.2f} ms collate {:>9.1f} triplets/s".format(
+            name, r["batch_mb"], r["collate_ms"], r["items_per_second"]))
+    return results
+
+def bench_suite(args):
+    """
+        Time the data and model hot paths on a synthetic corpus generated locally (no network, no real dataset)
+        and write the results to a JSON file, to compare them between commits
+    """
+    import platform
+    import numpy as np
+    import pandas as pd
+    import pytorch_lightning as pl
+    import torch
+    from libs.Dataset import TripletTrashbinDataModule, create_triplet_csv, split_train_val_test
+    from libs.Inference import extract_representation, predict_nn, model_metric
+    from libs.Model import TripletNetwork
+    from libs.Visualization import tsne_projection
+
+    torch.manual_seed(0)
+    np.random.seed(0)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.data_dir or tmp
+        all_labels_path = make_synthetic_corpus(root, args.images_per_class)
+
+        triplet_path = os.path.join(root, "all_labels_triplet.csv")
+        _, seconds = _timed(create_triplet_csv, all_labels_path, triplet_path)
+        results["create_triplet_csv"] = {"seconds": seconds, "images": 3 * args.images_per_class}
+
+        train, val, test = split_train_val_test(pd.read_csv(triplet_path), [0.7, 0.15, 0.15])
+        for df, name in ((train, "triplet_training.csv"), (val, "triplet_validation.csv"), (test, "triplet_test.csv")):
+            df.to_csv(os.path.join(root, name), index=False)
+
+        dm = TripletTrashbinDataModule(img_size=args.img_size, batch_size=args.batch_size, dst_main_path=root)
+        dm.setup()
+
+        n = min(len(dm.trb_train), args.items)
+        _, seconds = _timed(lambda: [dm.trb_train[i] for i in range(n)])
+        results["dataset_getitem"] = {"seconds": seconds, "items": n, "items_per_second": n / seconds}
+
+        results["dataloader"] = {}
+        for num_workers in args.workers:
+            dm.num_workers = num_workers
+            items, start = 0, time.perf_counter()
+            for batch in dm.train_dataloader():
+                items += len(batch[0])
+            seconds = time.perf_counter() - start
+            results["dataloader"][str(num_workers)] = {"seconds": seconds, "items": items, "items_per_second": items / seconds}
+        dm.num_workers = 0
+
+        model = TripletNetwork(batch_size=args.batch_size, pretrained=False)
+        step_timer = _step_timer()
+        trainer = pl.Trainer(max_steps=args.steps, accelerator="cpu", devices=1, logger=False, enable_checkpointing=False,
+                                enable_progress_bar=False, enable_model_summary=False, num_sanity_val_steps=0,
+                                limit_val_batches=0, callbacks=[step_timer])
+        trainer.fit(model, datamodule=dm)
+        steps = step_timer.durations[1:] or step_timer.durations   # the first step includes the warm up
+        results["training_step"] = {"steps": len(steps), "mean_seconds": float(np.mean(steps)),
+                                    "p50_seconds": float(np.median(steps)), "batch_size": args.batch_size}
+
+        (train_rep, train_label), seconds = _timed(extract_representation, model, dm.gallery_dataloader())
+        (test_rep, test_label), _ = _timed(extract_representation, model, dm.test_dataloader())
+        results["extract_representation"] = {"seconds": seconds, "images": len(train_rep), "images_per_second": len(train_rep) / seconds}
+
+        _, seconds = _timed(predict_nn, train_rep, test_rep, train_label, metric=model_metric(model))
+        results["predict_nn"] = {"seconds": seconds, "gallery": len(train_rep), "queries": len(test_rep)}
+
+        _, seconds = _timed(tsne_projection, test_rep, test_label)
+        results["tsne"] = {"seconds": seconds, "points": len(test_rep)}
+
+    report = {"commit": _git_commit(), "python": platform.python_version(), "torch": torch.__version__,
+              "host": platform.node(), "cpus": os.cpu_count(), "torch_threads": torch.get_num_threads(),
+              "config": {k: v for k, v in vars(args).items() if k != "func"}, "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for stage, r in results.items():
+        print("{:<24} {}".format(stage, json.dumps(r)))
+    print("results written to {}".format(args.output))
+    return report
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmarks of the triplet trashbin classifier")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    suite = subparsers.add_parser("suite", help="hot paths of data and model on a synthetic corpus, results to JSON")
+    suite.add_argument("--output", default="bench_output.json")
+    suite.add_argument("--data-dir", default=None, help="where to write the synthetic corpus, a temporary directory if not given")
+    suite.add_argument("--images-per-class", type=int, default=100)
+    suite.add_argument("--img-size", type=int, default=224)
+    suite.add_argument("--batch-size", type=int, default=16)
+    suite.add_argument("--items", type=int, default=100, help="items read directly from the dataset")
+    suite.add_argument("--workers", type=int, nargs="+", default=[0, 2])
+    suite.add_argument("--steps", type=int, default=5)
+    suite.set_defaults(func=bench_suite)
+
+    import_time = subparsers.add_parser("import-time", help="guard the import time of the inference path")
+    import_time.add_argument("--module", default="libs.Inference")
+    import_time.add_argument("--budget", type=float, default=3.0, help="maximum import time in seconds")
+    import_time.add_argument("--repeat", type=int, default=3)
+    import_time.set_defaults(func=check_import_budget)
+
+    ddp_scaling = subparsers.add_parser("ddp-scaling", help="throughput of DDP training on cpu with 1..N processes")
+    ddp_scaling.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    ddp_scaling.add_argument("--steps", type=int, default=20)
+    ddp_scaling.add_argument("--warmup", type=int, default=3)
+    ddp_scaling.add_argument("--batch-size", type=int, default=32, help="batch size of each process")
+    ddp_scaling.add_argument("--img-size", type=int, default=224)
+    ddp_scaling.set_defaults(func=bench_ddp_scaling)
+
+    bf16 = subparsers.add_parser("bf16", help="float32 vs bfloat16 autocast: step time, memory and accuracy")
+    bf16.add_argument("--steps", type=int, default=20)
+    bf16.add_argument("--warmup", type=int, default=3)
+    bf16.add_argument("--batch-size", type=int, default=32)
+    bf16.add_argument("--img-size", type=int, default=224)
+    bf16.add_argument("--eval-size", type=int, default=600, help="number of images used for the accuracy")
+    bf16.add_argument("--checkpoint", default=None, help="weights used for the accuracy, random if not given")
+    bf16.set_defaults(func=bench_bf16)
+
+    ckpt = subparsers.add_parser("checkpointing", help="memory/time tradeoff of the Fire modules activation checkpointing")
+    ckpt.add_argument("--batch-sizes", type=int, nargs="+", default=[32, 64, 128, 256])
+    ckpt.add_argument("--steps", type=int, default=10)
+    ckpt.add_argument("--warmup", type=int, default=2)
+    ckpt.add_argument("--img-size", type=int, default=224)
+    ckpt.set_defaults(func=bench_checkpointing)
+
+    resume = subparsers.add_parser("resume-check", help="a run resumed from a mid-epoch checkpoint continues at the next batch")
+    resume.add_argument("--images-per-class", type=int, default=20)
+    resume.add_argument("--img-size", type=int, default=64)
+    resume.add_argument("--batch-size", type=int, default=4)
+    resume.add_argument("--workers", type=int, default=2)
+    resume.add_argument("--steps", type=int, default=16, help="longer than an epoch, so the resumed run crosses an epoch boundary")
+    resume.add_argument("--stop-at", type=int, default=5)
+    resume.add_argument("--shuffle", action="store_true", help="reshuffle the training set every epoch")
+    resume.set_defaults(func=check_resume)
+
+    decoders = subparsers.add_parser("decoders", help="image decoding backends, the fastest on this host saved as preferences")
+    decoders.add_argument("images", nargs="*", help="glob patterns of the images, a synthetic corpus if not given")
+    decoders.add_argument("--images-per-class", type=int, default=100)
+    decoders.add_argument("--limit", type=int, default=500, help="images measured")
+    decoders.add_argument("--repeat", type=int, default=3)
+    decoders.add_argument("--output", default="decoders.json")
+    decoders.set_defaults(func=bench_decoders)
+
+    transport = subparsers.add_parser("transport", help="float32 vs uint8 images between the dataloader workers and the trainer")
+    transport.add_argument("--images-per-class", type=int, default=50)
+    transport.add_argument("--img-size", type=int, default=224)
+    transport.add_argument("--batch-size", type=int, default=32)
+    transport.add_argument("--workers", type=int, default=2)
+    transport.add_argument("--repeat", type=int, default=20, help="collates of the same batch timed")
+    transport.set_defaults(func=bench_transport)
+
+    # single training measurement, re-executed by Lightning in every rank
+    train_run = subparsers.add_parser("train-run")
+    train_run.add_argument("--processes", type=int, default=1)
+    train_run.add_argument("--steps", type=int, default=20)
+    train_run.add_argument("--warmup", type=int, default=3)
+    train_run.add_argument("--batch-size", type=int, default=32)
+    train_run.add_argument("--img-size", type=int, default=224)
+    train_run.add_argument("--bf16", action="store_true")
+    train_run.add_argument("--checkpoint-fire", action="store_true")
+    train_run.add_argument("--result", required=True)
+    train_run.set_defaults(func=run_training)
+
+    args = parser.parse_args()
+    args.func(args)
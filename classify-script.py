@@ -0,0 +1,218 @@
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+from multiprocessing import get_context
+
+# Bulk classification of trashbin snapshots: directories, glob patterns, image files and videos are decoded
+# in a process pool, embedded in large batches and classified against a gallery saved with libs.Gallery.
+# Results are written while they are produced, one row per image or video frame.
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.webp'}
+VIDEO_EXTENSIONS = {'.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v'}
+CLASSES = ['empty', 'half', 'full']
+
+_transform = None
+
+def _init_worker(img_size):
+    global _transform
+    import torch
+    from libs.Inference import build_inference_transform
+
+    # one thread per worker, the parallelism comes from the pool
+    torch.set_num_threads(1)
+    _transform = build_inference_transform(img_size)
+
+def _decode_image(path):
+    from PIL import Image
+
+    try:
+        with Image.open(path) as im:
+            return [(path, _transform(im.convert('RGB')).numpy(), None)]
+    except Exception as e:
+        return [(path, None, '{}: {}'.format(type(e).__name__, e))]
+
+def _decode_video_segment(segment):
+    """
+        Frames start, start + every_n, ... < end of a video. The skipped frames are only grabbed, not decoded
+    """
+    import cv2
+    from PIL import Image
+
+    path, start, end, every_n = segment
+    capture = cv2.VideoCapture(path)
+    results = []
+    try:
+        if not capture.isOpened():
+            return [('{}#{}'.format(path, start), None, 'cannot open video')]
+        capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+        for frame_index in range(start, end):
+            if not capture.grab():
+                break
+            if (frame_index - start) % every_n:
+                continue
+            frame_id = '{}#{}'.format(path, frame_index)
+            ok, frame = capture.retrieve()
+            if not ok:
+                results.append((frame_id, None, 'cannot decode frame'))
+                continue
+            image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            results.append((frame_id, _transform(image).numpy(), None))
+    finally:
+        capture.release()
+    return results
+
+def _video_segments(path, every_n, frames_per_segment):
+    """
+        Segments of the video, ValueError when it can not be split (no OpenCV, unknown frame count)
+    """
+    try:
+        import cv2
+    except ImportError:
+        raise ValueError("opencv-python is needed to read videos")
+
+    capture = cv2.VideoCapture(path)
+    opened = capture.isOpened()
+    frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    capture.release()
+    if not opened:
+        raise ValueError("cannot open video")
+    if frames <= 0:
+        raise ValueError("unknown frame count")
+    # segments start on a kept frame, so every_n is respected across them
+    step = every_n * frames_per_segment
+    return [(path, start, min(start + step, frames), every_n) for start in range(0, frames, step)]
+
+def list_inputs(inputs, every_n, frames_per_segment):
+    """
+        Returns the work items: ('image', path), ('video', (path, start, end, every_n)) segments
+        or ('error', (path, message)) for the videos that can not be read, written as error rows
+    """
+    items = []
+    for source in inputs:
+        if os.path.isdir(source):
+            paths = sorted(p for p in glob.glob(os.path.join(source, '**', '*'), recursive=True)
+                           if os.path.splitext(p)[1].lower() in IMAGE_EXTENSIONS | VIDEO_EXTENSIONS)
+        elif glob.has_magic(source):
+            paths = sorted(glob.glob(source, recursive=True))
+        else:
+            paths = [source]
+        for path in paths:
+            if os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS:
+                try:
+                    items.extend(('video', segment) for segment in _video_segments(path, every_n, frames_per_segment))
+                except ValueError as e:
+                    items.append(('error', (path, str(e))))
+            else:
+                items.append(('image', path))
+    return items
+
+def _decode(item):
+    kind, value = item
+    if kind == 'error':
+        path, error = value
+        return [(path, None, error)]
+    return _decode_image(value) if kind == 'image' else _decode_video_segment(value)
+
+class ResultWriter:
+    """
+        Rows written (and flushed) as they are produced, CSV or JSON lines by the extension of the output
+    """
+    FIELDS = ['id', 'label', 'class', 'distance', 'neighbour', 'error']
+
+    def __init__(self, path):
+        self.file = sys.stdout if path == '-' else open(path, 'w', newline='')
+        self.jsonl = path == '-' or os.path.splitext(path)[1].lower() in ('.jsonl', '.json')
+        if not self.jsonl:
+            self.writer = csv.DictWriter(self.file, fieldnames=self.FIELDS)
+            self.writer.writeheader()
+
+    def write(self, rows):
+        for row in rows:
+            if self.jsonl:
+                self.file.write(json.dumps(row) + '\n')
+            else:
+                self.writer.writerow(row)
+        self.file.flush()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+def classify(args):
+    import numpy as np
+    import torch
+    from libs.Gallery import Gallery, model_fingerprint
+    from libs.Inference import load_embedding_net, model_metric
+
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    model = load_embedding_net(args.weights)
+    gallery = Gallery(args.gallery)
+    if gallery.model is not None and gallery.model != model_fingerprint(model):
+        sys.exit("The gallery {} was built with other weights than {}".format(args.gallery, args.weights))
+    if gallery.metric is not None and gallery.metric != model_metric(model):
+        sys.exit("The gallery {} uses the {} metric, {} the {} one".format(args.gallery, gallery.metric, args.weights, model_metric(model)))
+    items = list_inputs(args.inputs, args.every_n_frames, args.batch_size)
+    writer = ResultWriter(args.output)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model.to(device)
+
+    done, failed, start, last_report = 0, 0, time.perf_counter(), time.perf_counter()
+    ids, tensors = [], []
+
+    def flush():
+        with torch.no_grad(), torch.autocast(device_type=device, dtype=torch.bfloat16, enabled=args.bf16):
+            embeddings = model(torch.from_numpy(np.stack(tensors)).to(device)).float().cpu().numpy()
+        labels, distances, neighbours = gallery.search(embeddings, k=1)
+        writer.write({'id': image_id, 'label': int(labels[i, 0]), 'class': CLASSES[labels[i, 0]] if 0 <= labels[i, 0] < len(CLASSES) else None,
+                      'distance': float(distances[i, 0]), 'neighbour': neighbours[i][0], 'error': None}
+                     for i, image_id in enumerate(ids))
+        ids.clear()
+        tensors.clear()
+
+    # spawned: forking after torch has run its thread pools can deadlock the workers
+    with get_context('spawn').Pool(args.workers, _init_worker, (args.img_size,)) as pool:
+        # imap keeps the input order and lets the workers decode ahead of the model
+        for results in pool.imap(_decode, items, chunksize=args.chunk_size):
+            for image_id, tensor, error in results:
+                if error is not None:
+                    failed += 1
+                    writer.write([{'id': image_id, 'label': None, 'class': None, 'distance': None, 'neighbour': None, 'error': error}])
+                    continue
+                ids.append(image_id)
+                tensors.append(tensor)
+                if len(ids) == args.batch_size:
+                    done += len(ids)
+                    flush()
+            now = time.perf_counter()
+            if now - last_report >= args.report_every:
+                print("{} classified, {} failed, {:.1f} images/s".format(done, failed, done / (now - start)), file=sys.stderr)
+                last_report = now
+        if ids:
+            done += len(ids)
+            flush()
+    writer.close()
+
+    seconds = time.perf_counter() - start
+    print("{} classified, {} failed in {:.1f}s ({:.1f} images/s)".format(done, failed, seconds, done / max(seconds, 1e-9)), file=sys.stderr)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Classify trashbin images and video frames against a saved gallery")
+    parser.add_argument("inputs", nargs="+", help="directories, glob patterns, image or video files")
+    parser.add_argument("--weights", required=True, help="TripletNetwork weights (.ckpt, .pth or .weights)")
+    parser.add_argument("--gallery", required=True, help="gallery directory written by libs.Gallery")
+    parser.add_argument("--output", default="-", help=".csv or .jsonl file, JSON lines on stdout by default")
+    parser.add_argument("--batch-size", type=int, default=128)
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="decoding processes")
+    parser.add_argument("--threads", type=int, default=None, help="torch threads of the model")
+    parser.add_argument("--chunk-size", type=int, default=16, help="inputs sent to a worker at a time")
+    parser.add_argument("--every-n-frames", type=int, default=10, help="frame skipping of the videos")
+    parser.add_argument("--img-size", type=int, default=224)
+    parser.add_argument("--bf16", action="store_true")
+    parser.add_argument("--report-every", type=float, default=10.0, help="seconds between throughput reports")
+
+    classify(parser.parse_args())
@@ -0,0 +1,286 @@
+import queue
+import threading
+import time
+import warnings
+import numpy as np
+import torch
+import torch.nn.functional as F
+import pytorch_lightning as pl
+from libs.Inference import uint8_normalization
+from libs.Mining import mine_hard_negatives
+from libs.Profiling import MemoryMonitor, StageTimer, summarize, format_summary
+
+class EmbeddingProjectorCallback(pl.Callback):
+    """
+        Log the embeddings of the first validation batch to the TensorBoard projector every `every_n_epochs` epochs.
+        Only `max_samples` random anchors are logged, with their images downsized to `thumbnail_size` pixels,
+        and the files are written by a background thread so validation does not wait for the serialization.
+        Requires validation_step to return the anchor embeddings under the 'embeddings' key.
+    """
+    def __init__(self, every_n_epochs=5, max_samples=64, thumbnail_size=32, seed=0):
+        super().__init__()
+        self.every_n_epochs = every_n_epochs
+        self.max_samples = max_samples
+        self.thumbnail_size = thumbnail_size
+        self.rng = np.random.default_rng(seed)
+
+        self._queue = queue.Queue(maxsize=2)
+        self._writer = None
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            experiment, embeddings, labels, thumbnails, global_step = item
+            try:
+                experiment.add_embedding(embeddings, labels, thumbnails, global_step=global_step)
+            except Exception as e:
+                warnings.warn("Embedding projector logging failed: {}".format(e))
+
+    def _should_log(self, trainer, batch_idx):
+        return (batch_idx == 0
+                and not trainer.sanity_checking
+                and trainer.is_global_zero
+                and trainer.logger is not None
+                and trainer.current_epoch % self.every_n_epochs == 0)
+
+    def on_validation_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx):
+        if not self._should_log(trainer, batch_idx) or not isinstance(outputs, dict) or 'embeddings' not in outputs:
+            return
+
+        embeddings = outputs['embeddings']
+        n = min(self.max_samples, embeddings.shape[0])
+        selected = torch.as_tensor(np.sort(self.rng.choice(embeddings.shape[0], n, replace=False)))
+
+        thumbnails = None
+        # batches of cached features (TripletNetwork(cached_features=True)) have no image to show
+        if batch[0].dim() == 4 and batch[0].shape[1] == 3:
+            images = batch[0][selected.to(batch[0].device)]
+            uint8 = images.dtype == torch.uint8
+            thumbnails = F.interpolate(images.float(), size=self.thumbnail_size, mode='bilinear', align_corners=False)
+            # back to [0, 1] as expected by the projector: uint8 batches (uint8_transport) are only scaled,
+            # the normalized ones are the inverse of x * scale + shift of uint8_normalization, times 255
+            if uint8:
+                thumbnails = thumbnails / 255
+            else:
+                scale, shift = uint8_normalization()
+                thumbnails = (thumbnails - shift.to(thumbnails.device)) * (255 * scale.to(thumbnails.device))
+            thumbnails = thumbnails.clamp_(0, 1).cpu()
+
+        labels = batch[1][selected.to(batch[1].device)].cpu().tolist()
+        embeddings = embeddings[selected.to(embeddings.device)].float().cpu()
+
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, name="embedding-projector", daemon=True)
+            self._writer.start()
+        self._queue.put((trainer.logger.experiment, embeddings, labels, thumbnails, trainer.global_step))
+
+    def teardown(self, trainer, pl_module, stage=None):
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+class StageTimingCallback(pl.Callback):
+    """
+        Per-stage timing of the training loop: file open, decode, transform and collate in the dataloader,
+        the three forward passes, the loss, logging, backward and optimizer step in the model, and the time
+        the loop waits for data. Every epoch the stages are logged as TensorBoard scalars (mean, p95 in ms)
+        and histograms, and a summary table is printed at the end of fit.
+        Without this callback the StageTimer of datasets and model stays disabled.
+    """
+    def __init__(self, timer=None):
+        super().__init__()
+        self.timer = timer if timer is not None else StageTimer(enabled=True)
+        self._all = {}
+        self._last_end = None
+
+    def setup(self, trainer, pl_module, stage=None):
+        pl_module.stage_timer = self.timer
+        if trainer.datamodule is not None:
+            trainer.datamodule.stage_timer = self.timer
+
+    def on_fit_start(self, trainer, pl_module):
+        self._all = {}
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        # the first wait of the epoch includes the start of the workers and the validation loop
+        self._last_end = None
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, unused=0):
+        now = time.perf_counter()
+        if self._last_end is not None:
+            self.timer.add('data_wait', now - self._last_end)
+        self._step_start = now
+        self._optimizer_start = None
+
+    def on_before_backward(self, trainer, pl_module, loss):
+        self._backward_start = time.perf_counter()
+
+    def on_after_backward(self, trainer, pl_module):
+        self.timer.add('backward', time.perf_counter() - self._backward_start)
+
+    def on_before_optimizer_step(self, trainer, pl_module, optimizer, opt_idx):
+        self._optimizer_start = time.perf_counter()
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, unused=0):
+        now = time.perf_counter()
+        if self._optimizer_start is not None:
+            self.timer.add('optimizer', now - self._optimizer_start)
+        self.timer.add('step', now - self._step_start)
+        self._last_end = now
+
+    @staticmethod
+    def data_wait_fraction(samples):
+        wait, step = samples.get('data_wait'), samples.get('step')
+        if wait is None or step is None:
+            return None
+        return float(wait.sum() / (wait.sum() + step.sum()))
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        samples = self.timer.pop()
+        for name, values in samples.items():
+            self._all.setdefault(name, []).append(values)
+
+        if trainer.logger is None:
+            return
+        summary = summarize(samples)
+        metrics = {}
+        for name, s in summary.items():
+            metrics['timing/{}_mean_ms'.format(name)] = s['mean'] * 1e3
+            metrics['timing/{}_p95_ms'.format(name)] = s['p95'] * 1e3
+        wait_fraction = self.data_wait_fraction(samples)
+        if wait_fraction is not None:
+            metrics['timing/data_wait_fraction'] = wait_fraction
+        trainer.logger.log_metrics(metrics, step=trainer.global_step)
+
+        experiment = trainer.logger.experiment
+        if hasattr(experiment, 'add_histogram'):
+            for name, values in samples.items():
+                experiment.add_histogram('timing/{}'.format(name), values * 1e3, global_step=trainer.current_epoch)
+
+    def on_fit_end(self, trainer, pl_module):
+        samples = self.timer.pop()
+        for name, values in samples.items():
+            self._all.setdefault(name, []).append(values)
+        if not trainer.is_global_zero or not self._all:
+            return
+        all_samples = {name: np.concatenate(values) for name, values in self._all.items()}
+        print(format_summary(summarize(all_samples), self.data_wait_fraction(all_samples)))
+
+class MemoryCallback(pl.Callback):
+    """
+        Log the memory of the training with the loss: every `every_n_steps` steps the peaks reached since the
+        previous log of the RSS of the main process, of the DataLoader workers (total and largest), of the heap of
+        the main process (the cpu tensors) and on cuda of the allocated tensors. The measures are taken by the
+        background thread of MemoryMonitor every `interval` seconds, not in the training loop.
+        The validation loop is logged as a whole at the end of every validation epoch
+    """
+    def __init__(self, interval=0.05, every_n_steps=50):
+        super().__init__()
+        self.interval = interval
+        self.every_n_steps = every_n_steps
+        self.monitor = None
+        self._fit_peaks = {}
+
+    def _log(self, pl_module, prefix, peaks, **kwargs):
+        workers = peaks.pop('num_workers')
+        pl_module.log('{}/num_workers'.format(prefix), float(workers), **kwargs)
+        for name, value in peaks.items():
+            name = name + '_mb'
+            pl_module.log('{}/{}'.format(prefix, name), value / 2**20, **kwargs)
+            self._fit_peaks[name] = max(self._fit_peaks.get(name, 0), value / 2**20)
+
+    def on_fit_start(self, trainer, pl_module):
+        self.monitor = MemoryMonitor(self.interval).start()
+        self._fit_peaks = {}
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, unused=0):
+        if (batch_idx + 1) % self.every_n_steps == 0:
+            self._log(pl_module, 'memory', self.monitor.reset(), on_step=True, on_epoch=False)
+
+    def on_validation_epoch_start(self, trainer, pl_module):
+        if self.monitor is not None:
+            self.monitor.reset()
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        if self.monitor is not None and not trainer.sanity_checking:
+            self.monitor.sample()
+            self._log(pl_module, 'memory_valid', self.monitor.reset(), on_step=False, on_epoch=True)
+
+    def on_fit_end(self, trainer, pl_module):
+        self.monitor.stop()
+        if trainer.is_global_zero and self._fit_peaks:
+            print("Memory peaks during fit: " + ", ".join("{} {:.0f}".format(name, value) for name, value in self._fit_peaks.items()))
+
+class ResumableSamplerCallback(pl.Callback):
+    """
+        Advance the ResumableSampler of the training dataloader by the samples of every batch used by the training
+        loop, so that a checkpoint saved in the middle of an epoch (e.g. ModelCheckpoint(every_n_train_steps=...))
+        resumes at the next batch instead of at the beginning of the epoch.
+        The state is saved by TripletTrashbinDataModule.state_dict
+    """
+    @staticmethod
+    def _sampler(trainer):
+        datamodule = trainer.datamodule
+        return getattr(datamodule, 'train_sampler', None) if datamodule is not None else None
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, unused=0):
+        sampler = self._sampler(trainer)
+        if sampler is not None:
+            sampler.advance(len(batch[1]))
+
+class HardNegativeMiningCallback(pl.Callback):
+    """
+        Global hard-negative mining between epochs: at the end of every `every_n_epochs` training epochs (from
+        `start_epoch`) the training images are embedded into a faiss index and the negative of every triplet is
+        replaced by one of the `top` nearest neighbours of its anchor with a different label (see libs.Mining).
+        The mined triplets are used by the next epoch. With several processes rank zero mines and broadcasts them
+    """
+    def __init__(self, every_n_epochs=1, start_epoch=0, k=20, top=1):
+        super().__init__()
+        self.every_n_epochs = every_n_epochs
+        self.start_epoch = start_epoch
+        self.k = k
+        self.top = top
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        next_epoch = trainer.current_epoch + 1
+        if (next_epoch < self.start_epoch or (next_epoch - self.start_epoch) % self.every_n_epochs != 0
+                or (trainer.max_epochs is not None and next_epoch >= trainer.max_epochs) or trainer.should_stop):
+            return
+        datamodule = trainer.datamodule
+
+        mined, statistics = None, None
+        if trainer.is_global_zero:
+            mined, statistics = mine_hard_negatives(pl_module, datamodule.trb_train.data, datamodule.mining_load(),
+                                                    k=self.k, top=self.top, batch_size=datamodule.batch_size,
+                                                    num_workers=datamodule.num_workers, seed=next_epoch)
+            # extract_representation leaves the model in eval mode
+            pl_module.train()
+            if trainer.logger is not None:
+                trainer.logger.log_metrics({'mining/' + name: value for name, value in statistics.items()}, step=trainer.global_step)
+        mined = trainer.strategy.broadcast(mined, src=0)
+        datamodule.set_train_triplets(mined)
+
+class ValidationReportCallback(pl.Callback):
+    """
+        Call report(epoch, validation loss) at the end of every validation epoch (not the sanity check) and stop
+        the fit when it returns False. Used by sweep-script.py to stop the unpromising trials early
+    """
+    def __init__(self, report, monitor='valid/loss'):
+        super().__init__()
+        self.report = report
+        self.monitor = monitor
+        self.losses = []
+        self.stopped = False
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        if trainer.sanity_checking or self.monitor not in trainer.callback_metrics:
+            return
+        loss = float(trainer.callback_metrics[self.monitor])
+        self.losses.append(loss)
+        if not self.report(trainer.current_epoch, loss):
+            self.stopped = True
+            trainer.should_stop = True
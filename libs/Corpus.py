@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join, exists
+from PIL import Image
+
+# Manifest of the image corpus written by TripletTrashbinDataModule.prepare_data:
+#   {"images": {path: {"size", "mtime", "width", "height", "mode", "rgb_path"} or {"size", "mtime", "error"}}}
+# Every image is fully decoded once, the images that are not RGB (greyscale, CMYK, palette, RGBA) get an RGB copy
+# in rgb_dir (rgb_path) used in their place, and the images that cannot be read are recorded with the error.
+# An image is checked again only when its size or modification time changes.
+
+MANIFEST_FILE = 'image_manifest.json'
+RGB_DIR = 'rgb'
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+    except OSError:
+        return None, None
+
+def _check_image(path, rgb_dir):
+    size, mtime = _stat(path)
+    entry = {'size': size, 'mtime': mtime}
+    try:
+        with Image.open(path) as im:
+            im.load()
+            entry.update(width=im.width, height=im.height, mode=im.mode, rgb_path=None)
+            if im.mode != 'RGB':
+                # png: the converted copy is lossless
+                rgb_path = join(rgb_dir, hashlib.sha1(path.encode('utf-8')).hexdigest() + '.png')
+                # written on a temporary path and renamed, another process may be converting the same image
+                tmp_path = '{}.{}.tmp'.format(rgb_path, os.getpid())
+                im.convert('RGB').save(tmp_path, format='PNG')
+                os.replace(tmp_path, rgb_path)
+                entry['rgb_path'] = rgb_path
+    except Exception as e:
+        entry = {'size': size, 'mtime': mtime, 'error': '{}: {}'.format(type(e).__name__, e)}
+    return path, entry
+
+def _check_chunk(paths, rgb_dir):
+    return [_check_image(path, rgb_dir) for path in paths]
+
+def load_manifest(manifest_path):
+    if not exists(manifest_path):
+        return {'images': {}}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def validate_corpus(paths, manifest_path, rgb_dir, processes=None, chunk_size=64):
+    """
+        Decode in `processes` processes every image of paths that is not in the manifest or changed since it was
+        checked, write the RGB copies of the images that are not RGB and update the manifest.
+        Returns the manifest
+    """
+    manifest = load_manifest(manifest_path)
+    images = manifest['images']
+    todo = []
+    for path in sorted(set(paths)):
+        entry = images.get(path)
+        if entry is None or (entry['size'], entry['mtime']) != _stat(path) or (entry.get('rgb_path') and not exists(entry['rgb_path'])):
+            todo.append(path)
+    if not todo:
+        return manifest
+
+    from tqdm import tqdm
+
+    os.makedirs(rgb_dir, exist_ok=True)
+    chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for checked in tqdm(pool.map(_check_chunk, chunks, [rgb_dir] * len(chunks)), total=len(chunks), desc="Checking images"):
+            images.update(checked)
+
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+    errors = [path for path in todo if 'error' in images[path]]
+    converted = [path for path in todo if images[path].get('rgb_path')]
+    print("Checked {} images: {} converted to RGB, {} unreadable".format(len(todo), len(converted), len(errors)))
+    for path in errors:
+        print("  {}: {}".format(path, images[path]['error']))
+    return manifest
+
+def corpus_mapping(manifest):
+    """
+        Returns (unreadable paths, {path: RGB copy}) of a manifest
+    """
+    bad, rgb = set(), {}
+    for path, entry in manifest['images'].items():
+        if 'error' in entry:
+            bad.add(path)
+        elif entry.get('rgb_path'):
+            rgb[path] = entry['rgb_path']
+    return bad, rgb
@@ -1,20 +1,29 @@
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
-from tqdm import tqdm
 import pandas as pd
 import numpy as np
-from sklearn.model_selection import train_test_split
-from PIL import Image
 from torch.utils import data # necessary to create a map-style dataset https://pytorch.org/docs/stable/data.html
-from os.path import splitext, join
+from os.path import splitext, join, exists
 from torchvision import transforms
 import pytorch_lightning as pl
 from typing import Optional
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, SequentialSampler
+from torch.utils.data.distributed import DistributedSampler
 from torch.nn import ModuleList
+import torch.distributed as dist
+from pytorch_lightning.trainer.states import TrainerStatus
+from libs.FeatureCache import FeatureCache
+from libs.Profiling import StageTimer, TimedCollate
+from libs.Samplers import ResumableSampler, ClassBalancedBatchSampler
+from libs.Mining import ImageLoader
+from libs.Corpus import MANIFEST_FILE, RGB_DIR, validate_corpus, load_manifest, corpus_mapping
+from libs.Decoders import ImageDecoder, read_bytes
+from libs.Inference import to_tensor_transforms
+from libs.PinnedBuffers import PinnedBatchBuffers
+from libs.ImageCache import ImageCache, build_image_cache
 
 class TripletTrashbinDataset(data.Dataset): # data.Dataset https://pytorch.org/docs/stable/_modules/torch/utils/data/dataset.html#Dataset
-    def __init__(self, csv: str=None, transform: transforms=None):
+    def __init__(self, csv: str=None, transform: transforms=None, decoder: ImageDecoder=None):
 
         if csv is None:
             raise NotImplementedError("No default dataset is provided")
@@ -24,35 +33,81 @@ class TripletTrashbinDataset(data.Dataset): # data.Dataset https://pytorch.org/d
         self.data = pd.read_csv(csv)
         self.data = remove_unnamed_col(self.data)
         self.transform = transform
+        # backend chosen by file type (libs.Decoders), PIL for every file by default
+        self.decoder = decoder if decoder is not None else ImageDecoder()
+        # per-stage timing (open, decode, transform), disabled unless a StageTimingCallback is used
+        self.timer = StageTimer()
 
     def __len__(self):
         return len(self.data)
 
+    def _load(self, path):
+        with self.timer.stage('open'):
+            data = read_bytes(path)
+        with self.timer.stage('decode'):
+            im = self.decoder.decode(path, data)
+        if self.transform is not None:
+            with self.timer.stage('transform'):
+                im = self.transform(im)
+        return im
+
     def __getitem__(self, i=None):
 
         if i is None:
             raise NotImplementedError("Only int type is supported for get the item. None is not allowed")
         
         im_path_anchor, im_label_anchor = self.data.iloc[i]['anchor_image'], self.data.iloc[i].anchor_label
-        im_anchor = Image.open(im_path_anchor)        # Handle image with Image module from Pillow https://pillow.readthedocs.io/en/stable/reference/Image.html
-        if self.transform is not None:
-            im_anchor = self.transform(im_anchor)
+        im_anchor = self._load(im_path_anchor)
 
         im_path_pos, im_label_pos = self.data.iloc[i]['pos_image'], self.data.iloc[i].pos_label
-        im_pos = Image.open(im_path_pos)
-        if self.transform is not None:
-            im_pos = self.transform(im_pos)
+        im_pos = self._load(im_path_pos)
 
         im_path_neg, im_label_neg = self.data.iloc[i]['neg_image'], self.data.iloc[i].neg_label
-        im_neg = Image.open(im_path_neg)
-        if self.transform is not None:
-            im_neg = self.transform(im_neg)
+        im_neg = self._load(im_path_neg)
 
         return im_anchor, im_label_anchor, im_pos, im_label_pos, im_neg, im_label_neg
 
+class CachedTripletDataset(TripletTrashbinDataset):
+    """
+        Triplet dataset that returns the cached activations of the frozen layers (see libs.FeatureCache) instead of the images
+    """
+    def __init__(self, csv: str=None, cache: FeatureCache=None):
+        super().__init__(csv)
+        self.cache = cache
+
+    def __getitem__(self, i=None):
+
+        if i is None:
+            raise NotImplementedError("Only int type is supported for get the item. None is not allowed")
+
+        row = self.data.iloc[i]
+        return (self.cache[row['anchor_image']], row.anchor_label,
+                self.cache[row['pos_image']], row.pos_label,
+                self.cache[row['neg_image']], row.neg_label)
+
+class CachedImageTripletDataset(TripletTrashbinDataset):
+    """
+        Triplet dataset that reads the decoded images from an image cache (see libs.ImageCache) as uint8 tensors,
+        the transforms work on tensors
+    """
+    def __init__(self, csv: str=None, cache: ImageCache=None, transform: transforms=None):
+        super().__init__(csv, transform)
+        self.cache = cache
+
+    def _load(self, path):
+        with self.timer.stage('open'):
+            im = self.cache[path]
+        if self.transform is not None:
+            with self.timer.stage('transform'):
+                im = self.transform(im)
+        return im
+
 class TripletTrashbinDataModule(pl.LightningDataModule):
     def __init__(self, img_size, batch_size=32, num_workers=0, data_augmentation=True,
-                    trb_train_csv='triplet_training.csv', trb_val_csv='triplet_validation.csv', trb_test_csv='triplet_test.csv'):
+                    trb_train_csv='triplet_training.csv', trb_val_csv='triplet_validation.csv', trb_test_csv='triplet_test.csv',
+                    feature_cache=None, dst_main_path='dataset', stage_timer=None, shuffle=False, seed=0,
+                    validate_images=True, prepare_processes=None, classes_per_batch=None, samples_per_class=None, decoders=None,
+                    uint8_transport=False, image_cache=None):
         super().__init__()
 
         self.batch_size = batch_size
@@ -60,16 +115,57 @@ class TripletTrashbinDataModule(pl.LightningDataModule):
         self.img_size = img_size
         self.num_workers = num_workers
     
-        self.dst_main_path = 'dataset'
+        self.dst_main_path = dst_main_path
 
         self.trb_train_csv = join(self.dst_main_path, trb_train_csv)
         self.trb_val_csv = join(self.dst_main_path, trb_val_csv)
         self.trb_test_csv = join(self.dst_main_path, trb_test_csv)
         self.data_augmentation = data_augmentation
-
+        # directory of a feature cache built with libs.FeatureCache.build_feature_cache: when given, every split
+        # returns the cached activations of the frozen layers and the transforms (augmentation included) are not used
+        self.feature_cache = feature_cache
+        # StageTimer shared with the datasets and the collate of the dataloaders (see StageTimingCallback)
+        self.stage_timer = stage_timer
+        # the training set is read through a ResumableSampler, its state is saved in the checkpoints
+        # (see state_dict and ResumableSamplerCallback). The .csv are already shuffled, shuffle=True
+        # reshuffles them every epoch with seed + epoch
+        self.shuffle = shuffle
+        self.seed = seed
+        self.train_sampler = None
+        self._train_sampler_state = None
+        # with classes_per_batch (P) and samples_per_class (K) every training batch holds K triplets of each of P
+        # anchor classes (ClassBalancedBatchSampler) and batch_size is ignored for training. The triplets of the .csv
+        # only get the same anchor class mix, the in-batch triplets are formed by TripletNetwork(batch_hard=True)
+        self.classes_per_batch = classes_per_batch
+        self.samples_per_class = samples_per_class
+        # prepare_data decodes every image once (in prepare_processes processes) and writes a manifest
+        # in dst_main_path, see libs.Corpus: the rows with unreadable images are dropped and the images
+        # that are not RGB are read from their RGB copy. With validate_images=False nothing is checked, the manifest
+        # of a previous check is still applied if there is one (e.g. the trials of sweep-script.py)
+        self.validate_images = validate_images
+        self.prepare_processes = prepare_processes
+        self.corpus_manifest = join(self.dst_main_path, MANIFEST_FILE)
+        # negatives of the training triplets chosen by hard-negative mining (see HardNegativeMiningCallback),
+        # saved in the checkpoints with the sampler state
+        self._train_negatives = None
+        self._train_triplets_replaced = False
+        # image decoding backends by file type (libs.Decoders.ImageDecoder): None decodes everything with PIL,
+        # a dict or the JSON written by `benchmark-script.py decoders` picks faster ones
+        self.decoder = ImageDecoder(decoders)
+        # the workers return uint8 CHW images (a quarter of the bytes of float32 through shared memory and in the
+        # collate), scaled and normalized by the model (TripletNetwork.embed). On GPU the batches are copied
+        # to the device from preallocated pinned buffers (see transfer_batch_to_device)
+        self.uint8_transport = uint8_transport
+        self.pinned_buffers = None
+        # directory of the image caches built by build_image_cache: the images are read already decoded and
+        # preprocessed, only the augmentation runs in the workers, and the batches are uint8
+        self.image_cache = image_cache
+
+        # the transforms are the deterministic preprocessing (applied once by the image cache), the random
+        # augmentation and the conversion to tensor
         if data_augmentation:
-            self.train_transform = transforms.Compose([
-                transforms.Resize(self.img_size + 6),
+            self.train_preprocessing = transforms.Resize(self.img_size + 6, antialias=True)
+            self.train_augmentation = [
                 transforms.RandomCrop(self.img_size),
                 # transforms.RandomApply(ModuleList([
                 #     transforms.ColorJitter(brightness=.3, hue=.2),
@@ -78,65 +174,235 @@ class TripletTrashbinDataModule(pl.LightningDataModule):
                 # transforms.RandomHorizontalFlip(p=0.3),
                 transforms.RandomPerspective(distortion_scale=0.3, p=0.2),
                 # transforms.RandomEqualize(p=0.2),
-                transforms.ToTensor(),
-                transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+            ]
+            self.train_transform = transforms.Compose([
+                self.train_preprocessing,
+                *self.train_augmentation,
+                *to_tensor_transforms(self.uint8_transport),
             ])
 
-            self.test_transform = transforms.Compose([
-                transforms.Resize(self.img_size + 32), 
+            self.test_preprocessing = transforms.Compose([
+                transforms.Resize(self.img_size + 32, antialias=True),
                 transforms.CenterCrop(self.img_size),
                 # transforms.AutoAugment(transforms.AutoAugmentPolicy.SVHN),
                 # transforms.RandomInvert(p=0.3),
                 # transforms.RandomHorizontalFlip(p=0.2),
                 # transforms.RandomGrayscale(p=0.2),
-                transforms.ToTensor(),
-                transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+            ])
+            self.test_transform = transforms.Compose([
+                self.test_preprocessing,
+                *to_tensor_transforms(self.uint8_transport),
             ])
 
         else:    
+            self.train_preprocessing = self.test_preprocessing = transforms.Resize((self.img_size, self.img_size), antialias=True)
+            self.train_augmentation = []
             self.transform = transforms.Compose([
-                transforms.Resize((self.img_size, self.img_size)),
-                transforms.ToTensor(),
-                transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+                self.train_preprocessing,
+                *to_tensor_transforms(self.uint8_transport),
             ])
 
 
-    # def prepare_data(self):
-        # do nothing
+    def prepare_data(self):
+        if self.validate_images:
+            validate_corpus(self._csv_image_paths(), self.corpus_manifest, join(self.dst_main_path, RGB_DIR),
+                            processes=self.prepare_processes)
+
+    def _csv_image_paths(self):
+        paths = set()
+        for csv in (self.trb_train_csv, self.trb_val_csv, self.trb_test_csv):
+            df = pd.read_csv(csv, usecols=['anchor_image', 'pos_image', 'neg_image'])
+            for col in df.columns:
+                paths.update(df[col])
+        return paths
+
+    def _corpus_mapping(self):
+        if not self.validate_images and not exists(self.corpus_manifest):
+            return set(), {}
+        return corpus_mapping(load_manifest(self.corpus_manifest))
+
+    def _image_cache_dir(self, variant):
+        # without data augmentation the training and the test preprocessing are the same, one cache
+        return join(self.image_cache, variant if self.data_augmentation else 'train')
+
+    def build_image_cache(self, processes=None):
+        """
+            Build in image_cache the caches of the images with the training and the test preprocessing
+            (libs.ImageCache.build_image_cache), so the cached images are the ones the transforms would produce
+        """
+        for variant, preprocessing in (('train', self.train_preprocessing), ('test', self.test_preprocessing)):
+            build_image_cache(self.image_paths(), self._image_cache_dir(variant), preprocessing, decoder=self.decoder, processes=processes)
+
+    def image_paths(self):
+        """
+            Paths of all the images referenced by the train, validation and test .csv,
+            as read by the datasets (unreadable images excluded, RGB copies in place of the originals)
+        """
+        bad, rgb = self._corpus_mapping()
+        return sorted(set(rgb.get(path, path) for path in self._csv_image_paths() if path not in bad))
+
+    def _apply_corpus_mapping(self, datasets):
+        bad, rgb = self._corpus_mapping()
+        if not bad and not rgb:
+            return
+        columns = ['anchor_image', 'pos_image', 'neg_image']
+        for dataset in datasets:
+            dropped = dataset.data[columns].isin(bad).any(axis=1)
+            if dropped.any():
+                print("Dropped {} triplets with unreadable images".format(int(dropped.sum())))
+            dataset.data = dataset.data[~dropped].reset_index(drop=True)
+            for col in columns:
+                dataset.data[col] = dataset.data[col].map(lambda path: rgb.get(path, path))
 
     def setup(self, stage: Optional[str] = None):
 
-        if self.data_augmentation:
+        if self.feature_cache is not None:
+            cache = FeatureCache(self.feature_cache)
+            if stage == "fit" or stage is None:
+                self.trb_train = CachedTripletDataset(self.trb_train_csv, cache)
+                self.trb_val = CachedTripletDataset(self.trb_val_csv, cache)
+            if stage == "test" or stage is None:
+                self.trb_test = CachedTripletDataset(self.trb_test_csv, cache)
+        elif self.image_cache is not None:
+            # the cached images are already preprocessed, only the augmentation is left
+            self.train_image_cache = ImageCache(self._image_cache_dir('train'), self.train_preprocessing)
+            self.test_image_cache = ImageCache(self._image_cache_dir('test'), self.test_preprocessing)
+            self.cache_train_transform = transforms.Compose(self.train_augmentation)
+            if stage == "fit" or stage is None:
+                self.trb_train = CachedImageTripletDataset(self.trb_train_csv, self.train_image_cache, transform=self.cache_train_transform)
+                self.trb_val = CachedImageTripletDataset(self.trb_val_csv, self.train_image_cache, transform=self.cache_train_transform)
+            if stage == "test" or stage is None:
+                self.trb_test = CachedImageTripletDataset(self.trb_test_csv, self.test_image_cache)
+        elif self.data_augmentation:
             # Assign train/val datasets for use in dataloaders
             if stage == "fit" or stage is None:
-                self.trb_train = TripletTrashbinDataset(self.trb_train_csv, transform=self.train_transform)
-                self.trb_val = TripletTrashbinDataset(self.trb_val_csv, transform=self.train_transform)
+                self.trb_train = TripletTrashbinDataset(self.trb_train_csv, transform=self.train_transform, decoder=self.decoder)
+                self.trb_val = TripletTrashbinDataset(self.trb_val_csv, transform=self.train_transform, decoder=self.decoder)
 
             # Assign test dataset for use in dataloader(s)
             if stage == "test" or stage is None:
-                self.trb_test = TripletTrashbinDataset(self.trb_test_csv, transform=self.test_transform)
+                self.trb_test = TripletTrashbinDataset(self.trb_test_csv, transform=self.test_transform, decoder=self.decoder)
         else:
             if stage == "fit" or stage is None:
-                self.trb_train = TripletTrashbinDataset(self.trb_train_csv, transform=self.transform)
-                self.trb_val = TripletTrashbinDataset(self.trb_val_csv, transform=self.transform)
+                self.trb_train = TripletTrashbinDataset(self.trb_train_csv, transform=self.transform, decoder=self.decoder)
+                self.trb_val = TripletTrashbinDataset(self.trb_val_csv, transform=self.transform, decoder=self.decoder)
 
             if stage == "test" or stage is None:
-                self.trb_test = TripletTrashbinDataset(self.trb_test_csv, transform=self.transform)
+                self.trb_test = TripletTrashbinDataset(self.trb_test_csv, transform=self.transform, decoder=self.decoder)
+
+        names = (['trb_train', 'trb_val'] if stage in ("fit", None) else []) + (['trb_test'] if stage in ("test", None) else [])
+        self._apply_corpus_mapping([getattr(self, name) for name in names])
+
+    def _distributed(self):
+        """
+            True while a multi-process trainer is running, the dataloaders requested outside of it
+            (e.g. by the evaluation functions) always cover the whole dataset
+        """
+        return (self.trainer is not None and self.trainer.world_size > 1
+                and self.trainer.state.status == TrainerStatus.RUNNING
+                and dist.is_available() and dist.is_initialized())
+
+    def _dataloader(self, dataset, sampler=None, batch_sampler=None):
+        # the samplers are built here rather than by Lightning (Trainer(replace_sampler_ddp=False)),
+        # the .csv are already shuffled so every rank reads a strided slice of them in order
+        if sampler is None and batch_sampler is None and self._distributed():
+            sampler = DistributedSampler(dataset, shuffle=False)
+        collate_fn = None
+        if self.stage_timer is not None and self.stage_timer.enabled:
+            dataset.timer = self.stage_timer
+            collate_fn = TimedCollate(self.stage_timer)
+        if batch_sampler is not None:
+            return DataLoader(dataset, batch_sampler=batch_sampler, num_workers=self.num_workers, collate_fn=collate_fn)
+        return DataLoader(dataset, batch_size=self.batch_size, num_workers=self.num_workers, sampler=sampler, collate_fn=collate_fn)
+
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        if not (self.uint8_transport and device.type == 'cuda' and isinstance(batch, (list, tuple))):
+            return super().transfer_batch_to_device(batch, device, dataloader_idx)
+        if self.pinned_buffers is None:
+            self.pinned_buffers = PinnedBatchBuffers()
+        batch = super().transfer_batch_to_device(self.pinned_buffers.stage(batch), device, dataloader_idx)
+        self.pinned_buffers.record()
+        return batch
+
+    def mining_load(self):
+        """
+            Model input of a training image for libs.Mining.mine_hard_negatives: the cached activations
+            with a feature cache, otherwise the image with the deterministic (test) transform
+        """
+        if self.feature_cache is not None:
+            return self.trb_train.cache.__getitem__
+        if self.image_cache is not None:
+            return ImageLoader(transforms.Compose([]), self.test_image_cache.__getitem__)
+        return ImageLoader(self.test_transform if self.data_augmentation else self.transform, self.decoder)
+
+    def set_train_triplets(self, triplets):
+        """
+            Replace the training triplets (same rows, e.g. mined negatives), used from the next epoch
+        """
+        if len(triplets) != len(self.trb_train.data):
+            raise ValueError("Expected {} triplets, got {}".format(len(self.trb_train.data), len(triplets)))
+        self.trb_train.data = triplets.reset_index(drop=True)
+        self._train_negatives = None
+        self._train_triplets_replaced = True
 
     def train_dataloader(self):
-        return DataLoader(self.trb_train, batch_size=self.batch_size, num_workers=self.num_workers)
+        if self._train_negatives is not None:
+            triplets = self.trb_train.data.copy()
+            triplets['neg_image'], triplets['neg_label'] = self._train_negatives
+            self.set_train_triplets(triplets)
+        num_replicas, rank = (dist.get_world_size(), dist.get_rank()) if self._distributed() else (1, 0)
+        if self.classes_per_batch is not None:
+            sampler = ClassBalancedBatchSampler(self.trb_train.data['anchor_label'].to_numpy(), self.classes_per_batch,
+                                                self.samples_per_class, num_replicas=num_replicas, rank=rank, seed=self.seed)
+        else:
+            sampler = ResumableSampler(len(self.trb_train), num_replicas=num_replicas, rank=rank, shuffle=self.shuffle, seed=self.seed)
+        if self._train_sampler_state is not None:
+            sampler.load_state_dict(self._train_sampler_state)
+            self._train_sampler_state = None
+        elif type(self.train_sampler) is type(sampler) and self.train_sampler.length == sampler.length:
+            # reloaded dataloader (e.g. reload_dataloaders_every_n_epochs), the position is kept
+            sampler.load_state_dict(self.train_sampler.state_dict())
+        self.train_sampler = sampler
+        if isinstance(sampler, ClassBalancedBatchSampler):
+            return self._dataloader(self.trb_train, batch_sampler=sampler)
+        return self._dataloader(self.trb_train, sampler)
+
+    def gallery_dataloader(self):
+        """
+            The whole training set once, in the order of the .csv: the gallery of the evaluation functions. Unlike
+            train_dataloader there is no shuffling, class balancing or rank split, and the training sampler is untouched
+        """
+        return self._dataloader(self.trb_train, SequentialSampler(self.trb_train))
+
+    def state_dict(self):
+        """
+            Saved by Lightning in the checkpoints: position of the training sampler in the current epoch
+        """
+        state = {}
+        if self.train_sampler is not None:
+            state['train_sampler'] = self.train_sampler.state_dict()
+        if self._train_triplets_replaced:
+            state['train_negatives'] = (self.trb_train.data['neg_image'].tolist(), self.trb_train.data['neg_label'].tolist())
+        return state
+
+    def load_state_dict(self, state_dict):
+        # restored before the dataloaders are created, applied by train_dataloader
+        self._train_sampler_state = state_dict.get('train_sampler')
+        self._train_negatives = state_dict.get('train_negatives')
 
     def val_dataloader(self):
-        return DataLoader(self.trb_val, batch_size=self.batch_size, num_workers=self.num_workers)
+        return self._dataloader(self.trb_val)
 
     def test_dataloader(self):
-        return DataLoader(self.trb_test, batch_size=self.batch_size, num_workers=self.num_workers)
+        return self._dataloader(self.trb_test)
 
 def create_triplet_csv(all_labels_path=join("dataset", "all_labels.csv"), dest_csv_path=join("dataset", "all_labels_triplet.csv")):
     """
         Function that allows to arrange a triplet dataset to perform the task from the original.
         The original .csv with the dataset is available here: https://drive.google.com/drive/folders/1LmN-fXWZ8UpRkLeMjbootN46V9AHaE4x?usp=sharing (ask for permission)
     """
+    from tqdm import tqdm
+
     triplet_df = pd.DataFrame({"anchor_image": [],
                         "anchor_label": [],
                         "pos_image": [],
@@ -203,6 +469,8 @@ def split_train_val_test(dataset, perc):
     """
         Split dataset into training and test set using sklearn.model_selection.train_test_split function
     """
+    from sklearn.model_selection import train_test_split
+
     train, testval = train_test_split(dataset, test_size = perc[1]+perc[2])
     val, test = train_test_split(testval, test_size = perc[2]/(perc[1]+perc[2]))
     return train, val, test
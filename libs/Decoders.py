@@ -0,0 +1,186 @@
+import io
+import json
+import os
+import time
+from os.path import splitext
+from PIL import Image
+
+# Image decoding backends of the datasets. PIL returns a PIL RGB image, the other backends a uint8 CHW tensor, with
+# no copy back to PIL: the torchvision transforms of the datamodule take both (see libs.Inference.to_tensor_transforms),
+# so they can be swapped without touching the transforms.
+# ImageDecoder picks the backend by file extension with fallback to the next ones (PIL last, it reads everything);
+# benchmark_decoders measures them on the current host and fastest_preferences turns the results into a choice.
+
+class PILDecoder:
+    name = 'pil'
+    extensions = None   # any format Pillow (or Pillow-SIMD, same module) can read
+
+    def __call__(self, data):
+        im = Image.open(io.BytesIO(data))
+        im.load()
+        return im if im.mode == 'RGB' else im.convert('RGB')
+
+class TorchvisionDecoder:
+    """
+        torchvision.io (libjpeg / libpng of torchvision) on the raw bytes
+    """
+    name = 'torchvision'
+    extensions = ('.jpg', '.jpeg', '.png')
+
+    def __init__(self):
+        import torch
+        from torchvision.io import decode_image, ImageReadMode
+
+        self.torch = torch
+        self.decode_image = decode_image
+        self.mode = ImageReadMode.RGB
+
+    def __call__(self, data):
+        return self.decode_image(self.torch.frombuffer(data, dtype=self.torch.uint8), mode=self.mode)
+
+class TurboJPEGDecoder:
+    """
+        libjpeg-turbo through PyTurboJPEG (pip install PyTurboJPEG, needs the libturbojpeg library)
+    """
+    name = 'turbojpeg'
+    extensions = ('.jpg', '.jpeg')
+
+    def __init__(self):
+        from turbojpeg import TurboJPEG, TJPF_RGB
+
+        self.jpeg = TurboJPEG()
+        self.pixel_format = TJPF_RGB
+
+    def __call__(self, data):
+        return _chw_tensor(self.jpeg.decode(bytes(data), pixel_format=self.pixel_format))
+
+class SimpleJPEGDecoder:
+    """
+        libjpeg-turbo bundled in the simplejpeg wheel (pip install simplejpeg)
+    """
+    name = 'simplejpeg'
+    extensions = ('.jpg', '.jpeg')
+
+    def __init__(self):
+        import simplejpeg
+
+        self.decode_jpeg = simplejpeg.decode_jpeg
+
+    def __call__(self, data):
+        return _chw_tensor(self.decode_jpeg(bytes(data), colorspace='RGB'))
+
+def _chw_tensor(array):
+    import torch
+
+    # HWC array of the decoder seen as CHW, without copying
+    return torch.from_numpy(array).permute(2, 0, 1)
+
+DECODERS = {cls.name: cls for cls in (PILDecoder, TorchvisionDecoder, TurboJPEGDecoder, SimpleJPEGDecoder)}
+
+def available_decoders(names=None):
+    """
+        {name: backend} of the backends that can be used here
+    """
+    decoders = {}
+    for name in names or DECODERS:
+        if name not in DECODERS:
+            raise ValueError("Unknown decoder {}, expected one of {}".format(name, list(DECODERS)))
+        try:
+            decoders[name] = DECODERS[name]()
+        except (ImportError, OSError, RuntimeError):
+            # not installed, or the native library is missing
+            pass
+    return decoders
+
+def read_bytes(path):
+    """
+        The whole file in one read, in a writable buffer (torch.frombuffer needs it)
+    """
+    with open(path, 'rb') as f:
+        data = bytearray(os.fstat(f.fileno()).st_size)
+        f.readinto(data)
+    return data
+
+class ImageDecoder:
+    """
+        Decode image files with the backend preferred for their extension: when a backend is not installed or fails on
+        a file the next one is tried, PIL last. preferences is {extension: [backend names]} or a JSON file written by
+        the `decoders` benchmark (see benchmark-script.py), None decodes everything with PIL.
+        The backends are created in the process that decodes, so the decoder can be sent to the dataloader workers
+    """
+    def __init__(self, preferences=None):
+        if isinstance(preferences, str):
+            with open(preferences) as f:
+                preferences = json.load(f)
+        preferences = preferences or {}
+        self.preferences = {ext.lower(): list(names) for ext, names in preferences.items()}
+        self._decoders = None
+        self._chains = {}
+
+    def __getstate__(self):
+        return {'preferences': self.preferences, '_decoders': None, '_chains': {}}
+
+    def _chain(self, ext):
+        if self._decoders is None:
+            self._decoders = available_decoders({name for names in self.preferences.values() for name in names} | {'pil'})
+        if ext not in self._chains:
+            names = [name for name in self.preferences.get(ext, []) if name in self._decoders]
+            self._chains[ext] = [self._decoders[name] for name in names + ([] if 'pil' in names else ['pil'])]
+        return self._chains[ext]
+
+    def backend(self, path):
+        """
+            Name of the first backend tried for the file
+        """
+        return self._chain(splitext(path)[1].lower())[0].name
+
+    def decode(self, path, data):
+        error = None
+        for decoder in self._chain(splitext(path)[1].lower()):
+            try:
+                return decoder(data)
+            except Exception as e:
+                error = e
+        raise error
+
+    def __call__(self, path):
+        return self.decode(path, read_bytes(path))
+
+def benchmark_decoders(paths, names=None, repeat=3):
+    """
+        Seconds per image of every available backend on the files of each extension of paths (best of `repeat` passes,
+        the bytes are read once before timing). A backend that fails on a file is left out for that extension.
+        Returns {extension: {name: seconds}}
+    """
+    decoders = available_decoders(names)
+    by_extension = {}
+    for path in paths:
+        by_extension.setdefault(splitext(path)[1].lower(), []).append(read_bytes(path))
+
+    results = {}
+    for ext, files in by_extension.items():
+        results[ext] = {}
+        for name, decoder in decoders.items():
+            if decoder.extensions is not None and ext not in decoder.extensions:
+                continue
+            try:
+                best = float('inf')
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    for data in files:
+                        decoder(data)
+                    best = min(best, time.perf_counter() - start)
+            except Exception:
+                continue
+            results[ext][name] = best / len(files)
+    return results
+
+def fastest_preferences(results):
+    """
+        Preferences of ImageDecoder from the results of benchmark_decoders: fastest backend first, PIL as last fallback
+    """
+    preferences = {}
+    for ext, seconds in results.items():
+        names = sorted(seconds, key=seconds.get)
+        preferences[ext] = names + ([] if 'pil' in names else ['pil'])
+    return preferences
@@ -0,0 +1,93 @@
+import numpy as np
+from libs.Inference import iter_representations, index_representations
+
+# Retrieval evaluation computed from one batched faiss search with k = the largest k needed:
+# recall@k, mAP@k, top-1 accuracy, per-class precision/recall and the confusion matrix of the nearest neighbour.
+
+CLASS_NAMES = ['empty', 'half', 'full']
+
+def search_neighbour_labels(index, index_labels, queries, k, batch_size=1024):
+    """
+        Labels of the k nearest neighbours in the index of every query, shape (n, min(k, index size)).
+        A missing neighbour (faiss id -1, e.g. an approximate index that finds fewer than k) has label -1
+    """
+    k = max(min(k, index.ntotal), 1)
+    neighbours = np.concatenate([index.search(np.ascontiguousarray(queries[i:i + batch_size], dtype=np.float32), k)[1]
+                                 for i in range(0, len(queries), batch_size)])
+    return np.where(neighbours >= 0, np.asarray(index_labels)[neighbours], -1)
+
+def retrieval_metrics(neighbour_labels, query_labels, gallery_labels, num_classes=None):
+    """
+        Metrics of the ranked neighbour labels (n, K) of queries with labels query_labels, retrieved from a gallery
+        with labels gallery_labels:
+            recall@k     fraction of queries with a neighbour of their class among the first k (for k = 1, 5, 10... <= K)
+            mAP@K        mean of the average precision of the first K neighbours, normalized by min(K, images of the class)
+            accuracy     top-1 accuracy (same as evaluate_classification with predict_nn)
+        plus the confusion matrix of the nearest neighbour and precision/recall of every class.
+        Missing neighbours (label -1, see search_neighbour_labels) are never relevant and are left out of the
+        confusion matrix, a query without any neighbour counts as wrong in accuracy and recall
+    """
+    neighbour_labels = np.asarray(neighbour_labels).astype(np.int64)
+    query_labels = np.asarray(query_labels).astype(np.int64)
+    gallery_labels = np.asarray(gallery_labels).astype(np.int64)
+    num_classes = num_classes or int(max(neighbour_labels.max(), query_labels.max(), gallery_labels.max())) + 1
+    K = neighbour_labels.shape[1]
+
+    relevant = neighbour_labels == query_labels[:, None]
+    metrics = {}
+    for k in [k for k in (1, 5, 10, 20, 50, 100) if k < K] + [K]:
+        metrics['recall@{}'.format(k)] = float(relevant[:, :k].any(axis=1).mean())
+
+    hits = np.cumsum(relevant, axis=1)
+    precision_at = hits / np.arange(1, K + 1)
+    class_sizes = np.bincount(gallery_labels, minlength=num_classes)
+    average_precision = (precision_at * relevant).sum(axis=1) / np.maximum(np.minimum(K, class_sizes[query_labels]), 1)
+    metrics['mAP@{}'.format(K)] = float(average_precision.mean())
+
+    predicted = neighbour_labels[:, 0]
+    found = predicted >= 0
+    confusion = np.bincount(num_classes * query_labels[found] + predicted[found], minlength=num_classes ** 2).reshape(num_classes, num_classes)
+    true_positives = np.diag(confusion)
+    metrics['accuracy'] = float(true_positives.sum() / max(len(query_labels), 1))
+    metrics['precision'] = (true_positives / np.maximum(confusion.sum(axis=0), 1)).tolist()
+    metrics['recall'] = (true_positives / np.maximum(np.bincount(query_labels, minlength=num_classes), 1)).tolist()
+    metrics['confusion_matrix'] = confusion.tolist()
+    return metrics
+
+def evaluate_retrieval(model, train_loader, test_loader, k=10, bf16=None):
+    """
+        Retrieval metrics of the test set against the training set: the training set is added batch by batch to a
+        faiss index (which holds all of it) and every test batch is searched once with k neighbours (see retrieval_metrics)
+    """
+    index, train_label = index_representations(model, train_loader, bf16=bf16)
+    neighbour_labels, test_label = [], []
+    for rep, label in iter_representations(model, test_loader, bf16=bf16):
+        neighbour_labels.append(search_neighbour_labels(index, train_label, rep, k))
+        test_label.append(label)
+    return retrieval_metrics(np.concatenate(neighbour_labels), np.concatenate(test_label), train_label)
+
+def scalar_metrics(metrics, prefix='eval/', class_names=CLASS_NAMES):
+    """
+        The metrics as a flat {name: float}, per-class values named after the classes
+    """
+    scalars = {}
+    for name, value in metrics.items():
+        if name == 'confusion_matrix':
+            continue
+        if isinstance(value, list):
+            for c, v in enumerate(value):
+                scalars['{}{}/{}'.format(prefix, name, class_names[c] if c < len(class_names) else c)] = v
+        else:
+            scalars[prefix + name] = value
+    return scalars
+
+def log_retrieval_metrics(logger, metrics, step, prefix='eval/', class_names=CLASS_NAMES):
+    """
+        Log the metrics as scalars and, on TensorBoard, the confusion matrix as a figure
+    """
+    logger.log_metrics(scalar_metrics(metrics, prefix, class_names), step=step)
+    experiment = getattr(logger, 'experiment', None)
+    if hasattr(experiment, 'add_figure'):
+        from libs.Visualization import plot_confusion_matrix
+
+        experiment.add_figure(prefix + 'confusion_matrix', plot_confusion_matrix(metrics['confusion_matrix'], class_names), global_step=step)
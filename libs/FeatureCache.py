@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import numpy as np
+import torch
+from os.path import join, exists
+from torch.utils import data
+from torch.utils.data import DataLoader
+from libs.Decoders import ImageDecoder
+from libs.Inference import normalize_uint8, uint8_normalization
+
+# Activations of the frozen part of the embedding net, computed once for every unique image and stored in
+# a float16 memory map (features.npy) with a manifest of the image paths (manifest.json).
+# The cache is valid as long as the frozen weights, the transform and the image files do not change.
+
+FEATURES_FILE = 'features.npy'
+MANIFEST_FILE = 'manifest.json'
+
+class _ImagePathDataset(data.Dataset):
+    def __init__(self, paths, transform, decoder):
+        self.paths = paths
+        self.transform = transform
+        # RGB images, the file is closed after reading (libs.Decoders)
+        self.decoder = decoder
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        return self.transform(self.decoder(self.paths[i]))
+
+def _fingerprint(prefix, transform, paths):
+    h = hashlib.sha1()
+    for name, tensor in prefix.state_dict().items():
+        h.update(name.encode('utf-8'))
+        h.update(tensor.detach().to('cpu').contiguous().numpy().tobytes())
+    h.update(repr(transform).encode('utf-8'))
+    # an image replaced in place changes size or modification time
+    for path in paths:
+        st = os.stat(path)
+        h.update('{}\t{}\t{}\n'.format(path, st.st_size, st.st_mtime_ns).encode('utf-8'))
+    return h.hexdigest()
+
+def build_feature_cache(prefix, image_paths, transform, cache_dir, batch_size=64, num_workers=0, decoder=None):
+    """
+        Compute the activations of `prefix` (the frozen layers, see TripletNetwork.frozen_prefix) for every unique
+        image of image_paths, decoded with decoder (a libs.Decoders.ImageDecoder, PIL by default), and store them
+        in cache_dir. Nothing is computed if the cache is already up to date.
+        The transform must be deterministic (no data augmentation), since every image is computed only once
+    """
+    from tqdm import tqdm
+
+    paths = sorted(set(image_paths))
+    fingerprint = _fingerprint(prefix, transform, paths)
+    manifest_path = join(cache_dir, MANIFEST_FILE)
+    if exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f).get('fingerprint') == fingerprint:
+                return FeatureCache(cache_dir)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    loader = DataLoader(_ImagePathDataset(paths, transform, decoder if decoder is not None else ImageDecoder()),
+                        batch_size=batch_size, num_workers=num_workers)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    prefix.eval()
+    prefix.to(device)
+
+    features, row = None, 0
+    with torch.no_grad():
+        for x in tqdm(loader, total=len(loader)):
+            # transforms ending with PILToTensor (uint8 transport) are normalized here, as the model does
+            out = prefix(normalize_uint8(x.to(device), *uint8_normalization())).to('cpu', torch.float16).numpy()
+            if features is None:
+                features = np.lib.format.open_memmap(join(cache_dir, FEATURES_FILE + '.tmp'), mode='w+',
+                                                        dtype=np.float16, shape=(len(paths),) + out.shape[1:])
+            features[row:row + len(out)] = out
+            row += len(out)
+    features.flush()
+    del features
+    os.replace(join(cache_dir, FEATURES_FILE + '.tmp'), join(cache_dir, FEATURES_FILE))
+
+    # the manifest is written last, an interrupted build is never taken for a valid cache
+    with open(manifest_path, 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'paths': paths}, f)
+
+    return FeatureCache(cache_dir)
+
+class FeatureCache:
+    """
+        Read-only access to the cached activations by image path
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(join(cache_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        self.rows = {path: i for i, path in enumerate(manifest['paths'])}
+        self.features = np.load(join(cache_dir, FEATURES_FILE), mmap_mode='r')
+
+    # only the path is pickled (e.g. for spawned processes), the memory map is opened again on unpickling
+    def __getstate__(self):
+        return {'cache_dir': self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['cache_dir'])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, path):
+        # np.array copies the row out of the read-only memory map
+        return torch.from_numpy(np.array(self.features[self.rows[path]]))
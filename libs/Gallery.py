@@ -0,0 +1,357 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import numpy as np
+from os.path import join, exists
+from PIL import Image
+from torch.utils import data
+from torch.utils.data import DataLoader
+from libs.Inference import extract_representation, build_index, check_metric, model_metric, normalize_embeddings
+
+# Persisted gallery of labelled embeddings (the training images) used to classify by nearest neighbour.
+# Every committed version is a directory with:
+#   embeddings.npy  float32 (n, dim), row i is the embedding of the image with key keys[i]
+#   labels.npy      int64 (n,)
+#   keys.npy        int64 (n,), stable ids of the images in the faiss index
+#   index.faiss     faiss.IndexIDMap2 over the embeddings, searched by key
+#   manifest.json   {"version", "dim", "metric", "model", "next_key", "ids": [image ids in row order], "metadata"}
+#                   "model" is the fingerprint of the weights that computed the embeddings (model_fingerprint),
+#                   "metric" the metric of that model (libs.Inference.model_metric)
+# and the file CURRENT names the live version. A new version is written in a temporary directory,
+# renamed, and only then CURRENT is replaced, so readers always see a complete gallery.
+
+CURRENT_FILE = 'CURRENT'
+MANIFEST_FILE = 'manifest.json'
+INDEX_FILE = 'index.faiss'
+
+class _LabelledImages(data.Dataset):
+    def __init__(self, paths, labels, transform):
+        self.paths = paths
+        self.labels = labels
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        return self.transform(Image.open(self.paths[i]).convert('RGB')), self.labels[i]
+
+class _GalleryVersion:
+    """
+        Immutable content of one version of the gallery
+    """
+    def __init__(self, version, ids, keys, labels, embeddings, index, next_key, metadata, metric, model):
+        self.version = version
+        self.ids = ids
+        self.keys = keys
+        self.labels = labels
+        self.embeddings = embeddings
+        self.index = index
+        self.next_key = next_key
+        self.metadata = metadata
+        self.metric = metric
+        self.model = model
+        self.rows = {image_id: row for row, image_id in enumerate(ids)}
+        self.key_rows = {int(key): row for row, key in enumerate(keys)}
+
+def model_fingerprint(model):
+    """
+        sha1 of the weights of the embedding net of model (a TripletNetwork or the net of load_embedding_net)
+    """
+    h = hashlib.sha1()
+    for name, tensor in getattr(model, 'embedding_net', model).state_dict().items():
+        h.update(name.encode('utf-8'))
+        h.update(tensor.detach().to('cpu').contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+def _new_index(dim, metric):
+    import faiss
+
+    # exact index: HNSW does not support remove_ids
+    return faiss.IndexIDMap2(build_index(dim, metric))
+
+class Gallery:
+    """
+        Labelled embeddings persisted in `root` with the faiss index built on them, updated incrementally:
+        `add` embeds only the images not already in the gallery, `remove` drops images by id, and `commit`
+        writes a new version and swaps it in atomically. Searches always run on a consistent version, so a
+        serving process can keep searching while another one updates the gallery and then call `reload`.
+        Image ids are the image paths unless given otherwise.
+        The metric (see libs.Inference.METRICS) is the one of the model of the first embeddings and is saved with
+        them: with 'cosine' the embeddings and the queries are normalized and searched by inner product.
+        The fingerprint of the weights that computed the embeddings is saved too: embeddings of other weights
+        or of another metric are refused, after retraining build a new gallery.
+    """
+    def __init__(self, root, dim=None, metadata=None, keep_versions=2):
+        self.root = root
+        self.keep_versions = keep_versions
+        self._lock = threading.Lock()
+        self._pending = None
+
+        if exists(join(root, CURRENT_FILE)):
+            self._current = self._load(self._current_version())
+        elif dim is not None:
+            os.makedirs(root, exist_ok=True)
+            # the index is created with the metric of the first embeddings
+            self._current = _GalleryVersion(0, [], np.zeros(0, np.int64), np.zeros(0, np.int64),
+                                            np.zeros((0, dim), np.float32), None, 0, metadata or {}, None, None)
+        else:
+            raise FileNotFoundError("No gallery in {}, pass dim to create a new one".format(root))
+
+    def _current_version(self):
+        with open(join(self.root, CURRENT_FILE)) as f:
+            return f.read().strip()
+
+    def _load(self, name):
+        import faiss
+
+        path = join(self.root, name)
+        with open(join(path, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        return _GalleryVersion(manifest['version'], manifest['ids'],
+                               np.load(join(path, 'keys.npy')), np.load(join(path, 'labels.npy')),
+                               np.load(join(path, 'embeddings.npy'), mmap_mode='r'),
+                               faiss.read_index(join(path, INDEX_FILE)) if exists(join(path, INDEX_FILE)) else None,
+                               manifest['next_key'], manifest['metadata'],
+                               manifest.get('metric', 'l2'), manifest.get('model'))
+
+    def reload(self):
+        """
+            Switch to the latest committed version if another process committed one
+        """
+        version = self._load(self._current_version())
+        if version.version != self._current.version:
+            self._current = version
+        return self._current.version
+
+    def __len__(self):
+        return len(self._current.ids)
+
+    def __contains__(self, image_id):
+        return image_id in self._current.rows
+
+    @property
+    def version(self):
+        return self._current.version
+
+    @property
+    def dim(self):
+        return self._current.embeddings.shape[1]
+
+    @property
+    def metric(self):
+        """
+            Metric of the model of the embeddings, None for a gallery still empty
+        """
+        return self._pending['metric'] if self._pending is not None else self._current.metric
+
+    @property
+    def model(self):
+        """
+            Fingerprint of the weights of the embeddings (model_fingerprint), None for a gallery still empty
+        """
+        return self._pending['model'] if self._pending is not None else self._current.model
+
+    @property
+    def ids(self):
+        return self._current.ids
+
+    @property
+    def labels(self):
+        return self._current.labels
+
+    @property
+    def metadata(self):
+        return self._current.metadata
+
+    def _working(self):
+        # changes are applied to a copy of the current version, the live one is only replaced by commit
+        if self._pending is None:
+            current = self._current
+            self._pending = {'ids': list(current.ids), 'labels': list(current.labels), 'keys': list(current.keys),
+                             'embeddings': [np.asarray(current.embeddings)], 'next_key': current.next_key,
+                             'live': {image_id: int(key) for image_id, key in zip(current.ids, current.keys)},
+                             'removed': set(), 'model': current.model, 'metric': current.metric}
+        return self._pending
+
+    def missing(self, image_ids):
+        """
+            The ids of image_ids that are not in the gallery (nor added since the last commit)
+        """
+        live = self._pending['live'] if self._pending is not None else self._current.rows
+        return [image_id for image_id in image_ids if image_id not in live]
+
+    def _check_model(self, fingerprint, metric):
+        pending = self._working()
+        if metric is None and pending['metric'] is None:
+            raise ValueError("The metric of the model is needed for the first embeddings of the gallery {}".format(self.root))
+        if metric is not None and pending['metric'] is not None and metric != pending['metric']:
+            raise ValueError("The gallery {} holds embeddings of the {} metric, the model uses {}".format(self.root, pending['metric'], metric))
+        pending['metric'] = pending['metric'] or check_metric(metric)
+        if fingerprint is None:
+            return
+        if pending['model'] is not None and pending['model'] != fingerprint and pending['live']:
+            raise ValueError("The gallery {} holds embeddings of other weights ({}), build a new gallery for these ones ({})"
+                             .format(self.root, pending['model'], fingerprint))
+        pending['model'] = fingerprint
+
+    def add_embeddings(self, image_ids, embeddings, labels, fingerprint=None, metric=None):
+        """
+            Add already computed embeddings. Ids already in the gallery are replaced.
+            fingerprint (model_fingerprint of the weights that computed them) and metric (model_metric of the same model,
+            needed for the first embeddings) are checked against the gallery
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if embeddings.ndim != 2 or embeddings.shape[1] != self.dim:
+            raise ValueError("Expected embeddings of shape (n, {}), got {}".format(self.dim, embeddings.shape))
+        with self._lock:
+            self._check_model(fingerprint, metric)
+            embeddings = normalize_embeddings(embeddings, self.metric)
+            self.remove(image_ids)
+            pending = self._working()
+            keys = range(pending['next_key'], pending['next_key'] + len(image_ids))
+            pending['ids'].extend(image_ids)
+            pending['labels'].extend(int(label) for label in labels)
+            pending['keys'].extend(keys)
+            pending['live'].update(zip(image_ids, keys))
+            pending['next_key'] += len(image_ids)
+            pending['embeddings'].append(embeddings)
+
+    def add(self, model, image_paths, labels, transform, batch_size=64, num_workers=0):
+        """
+            Embed with model only the images of image_paths not already in the gallery and add them.
+            Returns the number of images embedded. Raises ValueError if the gallery was built with other weights
+        """
+        fingerprint, metric = model_fingerprint(model), model_metric(model)
+        self._check_model(fingerprint, metric)
+        new = set(self.missing(image_paths))
+        # an image listed more than once (e.g. anchor of several triplets) is embedded once
+        selected = dict((path, label) for path, label in zip(image_paths, labels) if path in new)
+        if not selected:
+            return 0
+        paths, new_labels = list(selected), list(selected.values())
+        loader = DataLoader(_LabelledImages(paths, new_labels, transform), batch_size=batch_size, num_workers=num_workers)
+        embeddings, _ = extract_representation(model, loader)
+        self.add_embeddings(paths, embeddings, new_labels, fingerprint, metric)
+        return len(paths)
+
+    def remove(self, image_ids):
+        """
+            Remove images by id, unknown ids are ignored
+        """
+        pending = self._working()
+        for image_id in image_ids:
+            key = pending['live'].pop(image_id, None)
+            if key is not None:
+                pending['removed'].add(key)
+
+    def update(self, model, image_paths, labels, transform, **kwargs):
+        """
+            Make the gallery contain exactly image_paths: the images no longer listed are removed and only
+            the new ones are embedded. Returns (added, removed)
+        """
+        self._check_model(model_fingerprint(model), model_metric(model))
+        listed = set(image_paths)
+        stale = [image_id for image_id in self._working()['live'] if image_id not in listed]
+        self.remove(stale)
+        return self.add(model, image_paths, labels, transform, **kwargs), len(stale)
+
+    def _apply_pending(self):
+        import faiss
+
+        pending, current = self._pending, self._current
+        embeddings = np.concatenate(pending['embeddings'])
+        ids, labels, keys = pending['ids'], np.asarray(pending['labels'], np.int64), np.asarray(pending['keys'], np.int64)
+
+        # the rows added since the last commit are the last ones, the index of the current version is extended
+        # with them and the removed keys are dropped, nothing already indexed is embedded or added again
+        index = faiss.clone_index(current.index) if current.index is not None else None
+        if index is None and pending['metric'] is not None:
+            index = _new_index(embeddings.shape[1], pending['metric'])
+        n_old = len(current.ids)
+        if len(ids) > n_old:
+            index.add_with_ids(embeddings[n_old:], keys[n_old:])
+
+        # removals are tracked by key: an id replaced before commit keeps only its last row
+        keep = np.array([int(key) not in pending['removed'] for key in keys], dtype=bool)
+        if not keep.all():
+            index.remove_ids(np.ascontiguousarray(keys[~keep]))
+            ids = [image_id for image_id, k in zip(ids, keep) if k]
+            embeddings, labels, keys = embeddings[keep], labels[keep], keys[keep]
+        return ids, labels, keys, np.ascontiguousarray(embeddings), index
+
+    def commit(self, metadata=None):
+        """
+            Write the pending changes as a new version and make it the current one. Returns the new version
+        """
+        import faiss
+
+        with self._lock:
+            if self._pending is None and metadata is None and exists(join(self.root, CURRENT_FILE)):
+                return self._current.version
+            if self._pending is None:
+                self._working()
+            ids, labels, keys, embeddings, index = self._apply_pending()
+            version = self._current.version + 1
+            metadata = dict(self._current.metadata, **(metadata or {}))
+
+            name = 'v{:06d}'.format(version)
+            tmp_path = join(self.root, name + '.tmp')
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            os.makedirs(tmp_path)
+            np.save(join(tmp_path, 'embeddings.npy'), embeddings)
+            np.save(join(tmp_path, 'labels.npy'), labels)
+            np.save(join(tmp_path, 'keys.npy'), keys)
+            if index is not None:
+                faiss.write_index(index, join(tmp_path, INDEX_FILE))
+            with open(join(tmp_path, MANIFEST_FILE), 'w') as f:
+                json.dump({'version': version, 'dim': embeddings.shape[1], 'metric': self.metric, 'model': self._pending['model'],
+                           'next_key': self._pending['next_key'],
+                           'ids': ids, 'metadata': metadata}, f)
+            os.replace(tmp_path, join(self.root, name))
+
+            with open(join(self.root, CURRENT_FILE + '.tmp'), 'w') as f:
+                f.write(name)
+            os.replace(join(self.root, CURRENT_FILE + '.tmp'), join(self.root, CURRENT_FILE))
+
+            self._current = _GalleryVersion(version, ids, keys, labels, embeddings, index, self._pending['next_key'], metadata,
+                                            self._pending['metric'], self._pending['model'])
+            self._pending = None
+            self._remove_old_versions()
+            return version
+
+    def rollback(self):
+        """
+            Discard the changes since the last commit
+        """
+        self._pending = None
+
+    def _remove_old_versions(self):
+        versions = sorted(d for d in os.listdir(self.root) if d.startswith('v') and not d.endswith('.tmp'))
+        for name in versions[:-self.keep_versions]:
+            shutil.rmtree(join(self.root, name), ignore_errors=True)
+
+    def search(self, queries, k=1):
+        """
+            k nearest gallery images of every query. Returns (labels, distances, ids) with shape (n, k),
+            ids as a list of lists of image ids. With the cosine metric the distances are 1 - cosine similarity
+        """
+        current = self._current
+        if not current.ids:
+            raise ValueError("The gallery is empty")
+        queries = normalize_embeddings(np.ascontiguousarray(queries, dtype=np.float32), current.metric)
+        distances, keys = current.index.search(queries, k)
+        if current.metric == 'cosine':
+            distances = 1 - distances
+        rows = np.vectorize(lambda key: current.key_rows.get(int(key), -1), otypes=[np.int64])(keys)
+        labels = np.where(rows >= 0, current.labels[rows], -1)
+        ids = [[current.ids[r] if r >= 0 else None for r in row] for row in rows]
+        return labels, distances, ids
+
+    def predict(self, queries):
+        """
+            Label of the nearest gallery image of every query, as predict_nn
+        """
+        return self.search(queries, k=1)[0][:, 0]
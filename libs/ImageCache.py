@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import numpy as np
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join, exists
+from torchvision import transforms
+from libs.Decoders import ImageDecoder
+from libs.Inference import ImageToTensor
+
+# Decoded images with the deterministic preprocessing of the datamodule already applied (e.g. the Resize of the
+# training transform, see TripletTrashbinDataModule.build_image_cache), computed once for every unique image and
+# stored as uint8 CHW arrays one after the other in a memory map (images.bin). The images can have different shapes
+# (a Resize that keeps the aspect ratio): offsets.npy and shapes.npy locate them, the manifest.json lists the image
+# paths and the preprocessing. The processes reading the same cache (e.g. the trials of sweep-script.py) share its
+# pages in the OS page cache instead of decoding every image again. The cache is valid as long as the preprocessing
+# and the image files do not change.
+
+IMAGES_FILE = 'images.bin'
+OFFSETS_FILE = 'offsets.npy'
+SHAPES_FILE = 'shapes.npy'
+MANIFEST_FILE = 'manifest.json'
+
+def _fingerprint(paths, preprocessing):
+    h = hashlib.sha1(repr(preprocessing).encode('utf-8'))
+    for path in paths:
+        st = os.stat(path)
+        h.update('{}\t{}\t{}\n'.format(path, st.st_size, st.st_mtime_ns).encode('utf-8'))
+    return h.hexdigest()
+
+def _load_chunk(paths, preprocessing, decoder):
+    transform = transforms.Compose([preprocessing, ImageToTensor(uint8=True)])
+    return [transform(decoder(path)).numpy() for path in paths]
+
+def build_image_cache(image_paths, cache_dir, preprocessing, decoder=None, processes=None, chunk_size=64):
+    """
+        Decode (with decoder, a libs.Decoders.ImageDecoder) every unique image of image_paths in `processes` processes,
+        apply the preprocessing transform (deterministic, on PIL images or uint8 tensors) and store it in cache_dir.
+        Nothing is computed if the cache is already up to date
+    """
+    from tqdm import tqdm
+
+    paths = sorted(set(image_paths))
+    fingerprint = _fingerprint(paths, preprocessing)
+    manifest_path = join(cache_dir, MANIFEST_FILE)
+    if exists(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f).get('fingerprint') == fingerprint:
+                return ImageCache(cache_dir, preprocessing)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    decoder = decoder if decoder is not None else ImageDecoder()
+    offsets, shapes = [0], []
+    starts = range(0, len(paths), chunk_size)
+    with open(join(cache_dir, IMAGES_FILE + '.tmp'), 'wb') as images, ProcessPoolExecutor(max_workers=processes) as pool:
+        chunks = pool.map(_load_chunk, [paths[start:start + chunk_size] for start in starts], [preprocessing] * len(starts),
+                          [decoder] * len(starts))
+        for chunk in tqdm(chunks, total=len(starts), desc="Caching images"):
+            for image in chunk:
+                images.write(np.ascontiguousarray(image).tobytes())
+                offsets.append(offsets[-1] + image.size)
+                shapes.append(image.shape)
+    os.replace(join(cache_dir, IMAGES_FILE + '.tmp'), join(cache_dir, IMAGES_FILE))
+    np.save(join(cache_dir, OFFSETS_FILE), np.asarray(offsets, dtype=np.int64))
+    np.save(join(cache_dir, SHAPES_FILE), np.asarray(shapes, dtype=np.int64).reshape(-1, 3))
+
+    # the manifest is written last, an interrupted build is never taken for a valid cache
+    with open(manifest_path, 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'preprocessing': repr(preprocessing), 'paths': paths}, f)
+
+    return ImageCache(cache_dir, preprocessing)
+
+class ImageCache:
+    """
+        Read-only access to the cached uint8 CHW images by image path. With preprocessing, the cache must have
+        been built with the same one (compared by repr), otherwise ValueError
+    """
+    def __init__(self, cache_dir, preprocessing=None):
+        self.cache_dir = cache_dir
+        with open(join(cache_dir, MANIFEST_FILE)) as f:
+            manifest = json.load(f)
+        self.preprocessing = manifest.get('preprocessing')
+        if preprocessing is not None and self.preprocessing != repr(preprocessing):
+            raise ValueError("The image cache {} was built with the preprocessing {}, expected {}: build it again"
+                             .format(cache_dir, self.preprocessing, repr(preprocessing)))
+        self.rows = {path: i for i, path in enumerate(manifest['paths'])}
+        self.offsets = np.load(join(cache_dir, OFFSETS_FILE))
+        self.shapes = np.load(join(cache_dir, SHAPES_FILE))
+        # np.memmap fails on an empty file
+        self.images = np.memmap(join(cache_dir, IMAGES_FILE), dtype=np.uint8, mode='r') if self.offsets[-1] else np.zeros(0, np.uint8)
+
+    # only the path is pickled (e.g. for spawned processes), the memory map is opened again on unpickling
+    def __getstate__(self):
+        return {'cache_dir': self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['cache_dir'])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, path):
+        row = self.rows[path]
+        # np.array copies the image out of the read-only memory map
+        image = np.array(self.images[self.offsets[row]:self.offsets[row + 1]])
+        return torch.from_numpy(image.reshape(self.shapes[row]))
@@ -0,0 +1,279 @@
+import numpy as np
+import torch
+from torch import nn
+from torchvision import transforms
+from torchvision.models import squeezenet1_1
+import os
+from os.path import join, splitext
+
+# Only numpy, torch and torchvision are imported at module level: faiss, sklearn and tqdm are
+# imported inside the functions that need them, so embedding images does not pay for them.
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+# Distance of the embeddings, set once on the model (TripletNetwork(metric=...)) and followed by extraction,
+# indexes and kNN: 'l2' euclidean distance, 'cosine' inner product of L2-normalized embeddings
+METRICS = ('l2', 'cosine')
+
+def check_metric(metric):
+    if metric not in METRICS:
+        raise ValueError("Unknown metric {}, expected one of {}".format(metric, METRICS))
+    return metric
+
+def normalize_embeddings(rep, metric='l2'):
+    """
+        Rows with unit L2 norm for the cosine metric, unchanged for l2
+    """
+    if check_metric(metric) == 'l2':
+        return rep
+    return rep / np.maximum(np.linalg.norm(rep, axis=1, keepdims=True), 1e-12).astype(rep.dtype)
+
+def build_index(dim, metric='l2', hnsw_neighbors=0, fp16=False):
+    """
+        faiss index of the metric: exact (IndexFlatL2 / IndexFlatIP), HNSW graph with hnsw_neighbors links per node,
+        or exact on float16 vectors (half the memory) with fp16=True. With cosine the vectors must be normalized
+    """
+    import faiss
+
+    faiss_metric = faiss.METRIC_INNER_PRODUCT if check_metric(metric) == 'cosine' else faiss.METRIC_L2
+    if hnsw_neighbors:
+        return faiss.IndexHNSWFlat(dim, hnsw_neighbors, faiss_metric)
+    if fp16:
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss_metric)
+    return faiss.IndexFlatIP(dim) if metric == 'cosine' else faiss.IndexFlatL2(dim)
+
+def model_metric(model):
+    return getattr(model, 'metric', 'l2')
+
+def build_embedding_net(pretrained=True):
+    """
+        SqueezeNet 1_1 feature extractor used by TripletNetwork, with the classifier replaced by nn.Identity
+    """
+    squeezeNet = squeezenet1_1(pretrained=pretrained)
+    squeezeNet.classifier = nn.Identity()
+    return squeezeNet
+
+def build_inference_transform(img_size=224, uint8=False):
+    """
+        Same preprocessing of TripletTrashbinDataModule.test_transform. With uint8=True the images are returned
+        as uint8 CHW tensors, normalized by the model (see normalize_uint8)
+    """
+    return transforms.Compose([
+        transforms.Resize(img_size + 32, antialias=True),
+        transforms.CenterCrop(img_size),
+        *to_tensor_transforms(uint8),
+    ])
+
+class ImageToTensor:
+    """
+        PILToTensor (uint8=True) or ToTensor of PIL images that also takes the uint8 CHW tensors of the
+        libs.Decoders backends: returned as they are, or scaled to [0, 1]
+    """
+    def __init__(self, uint8=False):
+        self.uint8 = uint8
+
+    def __call__(self, image):
+        if isinstance(image, torch.Tensor):
+            return image if self.uint8 else image.float().div_(255)
+        return transforms.functional.pil_to_tensor(image) if self.uint8 else transforms.functional.to_tensor(image)
+
+    def __repr__(self):
+        return '{}(uint8={})'.format(self.__class__.__name__, self.uint8)
+
+def to_tensor_transforms(uint8=False):
+    """
+        Last transforms of the preprocessing: float32 normalized tensor, or uint8 CHW tensor (a quarter of the bytes
+        between the dataloader workers and the trainer) scaled and normalized later by normalize_uint8.
+        The input is a PIL image or a uint8 CHW tensor (see ImageToTensor)
+    """
+    if uint8:
+        return [ImageToTensor(uint8=True)]
+    return [ImageToTensor(), transforms.Normalize(IMAGENET_MEAN, IMAGENET_STD)]
+
+def uint8_normalization(mean=IMAGENET_MEAN, std=IMAGENET_STD):
+    """
+        (scale, shift) of shape (1, 3, 1, 1) with x * scale + shift == Normalize(mean, std)(x / 255)
+    """
+    mean, std = torch.tensor(mean).view(1, -1, 1, 1), torch.tensor(std).view(1, -1, 1, 1)
+    return 1 / (255 * std), -mean / std
+
+def normalize_uint8(x, scale, shift):
+    """
+        Scaling and normalization of a uint8 batch in a single addcmul, batches of other dtypes are returned unchanged
+    """
+    if x.dtype != torch.uint8:
+        return x
+    return torch.addcmul(shift.to(x.device), x.to(scale.dtype), scale.to(x.device))
+
+def embedding_state_dict(state_dict):
+    """
+        Returns only the weights of embedding_net from a TripletNetwork state_dict, without the 'embedding_net.' prefix
+    """
+    prefix = 'embedding_net.'
+    if not any(k.startswith(prefix) for k in state_dict):
+        return state_dict
+    return {k[len(prefix):]: v for k, v in state_dict.items() if k.startswith(prefix)}
+
+def load_embedding_net(path, map_location="cpu"):
+    """
+        Load the embedding net from a Lightning .ckpt, from a state_dict saved with torch.save (.pth)
+        or from a memory mapped .weights file, without importing pytorch_lightning.
+        Weights loaded from .weights are shared with the page cache and are not copied
+    """
+    from libs.Weights import WEIGHTS_EXT, load_flat_weights, assign_state_dict
+
+    embedding_net = build_embedding_net(pretrained=False)
+    # the metric of the model (see METRICS) is kept on the net, .pth files do not store it
+    metric = 'l2'
+
+    if splitext(path)[1] == WEIGHTS_EXT:
+        state_dict, metadata = load_flat_weights(path)
+        assign_state_dict(embedding_net, embedding_state_dict(state_dict))
+        metric = metadata.get('metric', metric)
+    else:
+        state_dict = torch.load(path, map_location=map_location)
+        if splitext(path)[1] == '.ckpt':
+            metric = state_dict.get('hyper_parameters', {}).get('metric', metric)
+            state_dict = state_dict['state_dict']
+        embedding_net.load_state_dict(embedding_state_dict(state_dict))
+
+    embedding_net.metric = metric
+    embedding_net.eval()
+    return embedding_net
+
+def iter_representations(model, loader, bf16=None, metric=None):
+    """
+        Yields (representations, labels) of every batch of the loader as float32 numpy arrays, so the consumer
+        decides what to keep. With bf16=True the model runs under bfloat16 autocast, by default it follows
+        model.bf16 if the model has it. The representations are normalized for the cosine metric (model.metric by default)
+    """
+    metric = metric or model_metric(model)
+    from tqdm import tqdm
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if bf16 is None:
+        bf16 = getattr(model, 'bf16', False)
+    model.eval()
+    model.to(device)
+    with torch.no_grad(), torch.autocast(device_type=device, dtype=torch.bfloat16, enabled=bf16):
+        for batch in tqdm(loader, total=len(loader)):
+            rep = model(batch[0].to(device))
+            yield normalize_embeddings(rep.detach().float().to('cpu').numpy(), metric), np.asarray(batch[1])
+
+def extract_representation(model, loader, bf16=None, metric=None):
+    """
+        Extra representation from data loader with a model.
+        The output is allocated once from the first batch, the batches are copied in it and dropped,
+        so the peak memory is the output plus one batch (bf16 as in iter_representations)
+    """
+    n = len(loader.sampler)
+    representations, labels, row = None, None, 0
+    for rep, label in iter_representations(model, loader, bf16=bf16, metric=metric):
+        if representations is None:
+            representations = np.empty((n,) + rep.shape[1:], dtype=np.float32)
+            labels = np.empty((n,) + label.shape[1:], dtype=label.dtype)
+        representations[row:row + len(rep)] = rep
+        labels[row:row + len(rep)] = label
+        row += len(rep)
+    if representations is None:
+        raise ValueError("The loader is empty")
+    return representations[:row], labels[:row]
+
+def index_representations(model, loader, index=None, bf16=None, metric=None):
+    """
+        Add the representations of the loader to a faiss index (exact index of the metric, see build_index, if not
+        given) batch by batch. No intermediate array of all the representations is built, but a flat index holds every
+        vector: its memory is O(dataset), n x 86528 float32 (338 KB per image). Pass index=build_index(dim, fp16=True)
+        to halve it, or use extract_to_shards to keep the vectors on disk. Returns the index and the labels of its rows
+    """
+    metric = metric or model_metric(model)
+    labels = []
+    for rep, label in iter_representations(model, loader, bf16=bf16, metric=metric):
+        if index is None:
+            index = build_index(rep.shape[1], metric)
+        index.add(rep)
+        labels.append(label)
+    return index, np.concatenate(labels)
+
+def extract_to_shards(model, loader, shard_dir, shard_rows=4096, bf16=None, dtype=np.float32):
+    """
+        Write the representations of the loader in shard_dir as .npy shards of shard_rows rows
+        (rep_00000.npy, label_00000.npy, ...) while they are produced, for sets that do not fit in memory.
+        dtype=np.float16 halves the size, safe for the normalized embeddings of the cosine metric.
+        Returns the list of shard names, read them back with iter_shards
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    shards, reps, labels, rows = [], [], [], 0
+
+    def flush():
+        name = '{:05d}'.format(len(shards))
+        np.save(join(shard_dir, 'rep_' + name + '.npy'), np.concatenate(reps).astype(dtype, copy=False))
+        np.save(join(shard_dir, 'label_' + name + '.npy'), np.concatenate(labels))
+        shards.append(name)
+        reps.clear()
+        labels.clear()
+
+    for rep, label in iter_representations(model, loader, bf16=bf16):
+        reps.append(rep)
+        labels.append(label)
+        rows += len(rep)
+        if rows >= shard_rows:
+            flush()
+            rows = 0
+    if reps:
+        flush()
+    return shards
+
+def iter_shards(shard_dir):
+    """
+        Yields (representations, labels) of the shards written by extract_to_shards, memory mapped
+    """
+    names = sorted(f[len('rep_'):-len('.npy')] for f in os.listdir(shard_dir) if f.startswith('rep_'))
+    for name in names:
+        yield (np.load(join(shard_dir, 'rep_' + name + '.npy'), mmap_mode='r'),
+               np.load(join(shard_dir, 'label_' + name + '.npy')))
+
+def predict_nn(train_rep, test_rep, train_label, batch_size=1024, metric='l2', hnsw_neighbors=0):
+    """
+        Predict the predicted labels on the test set using NN with the metric (see build_index): pass the one of the
+        model of the representations, model_metric(model)
+    """
+    # no copy when the representations are already contiguous float32 (as returned by extract_representation)
+    train_rep = normalize_embeddings(np.ascontiguousarray(train_rep, dtype=np.float32), metric)
+    index = build_index(train_rep.shape[1], metric, hnsw_neighbors=hnsw_neighbors)
+    index.add(train_rep)
+
+    return search_labels(index, normalize_embeddings(test_rep, metric), train_label, batch_size=batch_size)
+
+def search_labels(index, test_rep, train_label, batch_size=1024):
+    """
+        Label of the nearest neighbour in the index of every row of test_rep, searched batch_size rows at a time
+        (-1 when the index returns no neighbour)
+    """
+    indices = np.concatenate([index.search(np.ascontiguousarray(test_rep[i:i + batch_size], dtype=np.float32), k=1)[1][:, 0]
+                              for i in range(0, len(test_rep), batch_size)])
+    return np.where(indices >= 0, np.asarray(train_label)[indices], -1)
+
+def predict_nn_streaming(model, train_loader, test_loader, bf16=None):
+    """
+        predict_nn without materializing the representations: the training set is embedded straight into the
+        index and the test set is searched batch by batch. Returns (predicted labels, test labels)
+    """
+    index, train_label = index_representations(model, train_loader, bf16=bf16)
+    pred, gt = [], []
+    for rep, label in iter_representations(model, test_loader, bf16=bf16):
+        pred.append(search_labels(index, rep, train_label))
+        gt.append(label)
+    return np.concatenate(pred), np.concatenate(gt)
+
+def evaluate_classification(pred_label, gt_label):
+    """
+        Measure the accuracy of the prediction obtained from the predicted value and ground truth using accuracy_score
+    """
+    from sklearn.metrics import accuracy_score
+
+    # The best performance is 1 with normalize == True and the number of samples with normalize == False.
+    classification_error = accuracy_score(y_true=gt_label, y_pred=pred_label, normalize=True)
+
+    return classification_error
@@ -0,0 +1,73 @@
+import torch
+from torch import nn
+
+class EmbeddingMemoryBank(nn.Module):
+    """
+        Fixed-size FIFO of the most recent embeddings and labels (cross-batch memory), preallocated as a ring buffer.
+        Used by TripletNetwork(memory_bank_size=...) to draw hard negatives among thousands of recent embeddings
+        without extra forward passes: under the small learning rate of the training they are close to the ones
+        the current weights would compute.
+        The buffers are allocated by the first enqueue, with the dimension of the embeddings, and are not saved in
+        the checkpoints: the bank fills again in size / batch_size steps.
+        With the 86528-dimensional embeddings of SqueezeNet every entry takes 338 KB in float32, half in float16
+    """
+    def __init__(self, size, dtype=torch.float32):
+        super().__init__()
+        self.size = size
+        self.register_buffer('embeddings', torch.zeros(0, dtype=dtype), persistent=False)
+        self.register_buffer('labels', torch.zeros(0, dtype=torch.long), persistent=False)
+        self.position = 0
+        self.filled = 0
+
+    def __len__(self):
+        return self.filled
+
+    @torch.no_grad()
+    def enqueue(self, embeddings, labels):
+        if self.embeddings.dim() != 2 or self.embeddings.shape[1] != embeddings.shape[1]:
+            self.embeddings = embeddings.new_zeros((self.size, embeddings.shape[1]), dtype=self.embeddings.dtype)
+            self.labels = torch.full((self.size,), -1, dtype=torch.long, device=embeddings.device)
+            self.position = self.filled = 0
+        embeddings = embeddings.detach()[-self.size:]
+        labels = labels[-self.size:]
+        n = len(embeddings)
+        end = self.position + n
+        first = min(end, self.size) - self.position
+        self.embeddings[self.position:self.position + first] = embeddings[:first].to(self.embeddings.dtype)
+        self.labels[self.position:self.position + first] = labels[:first].long()
+        if first < n:
+            self.embeddings[:n - first] = embeddings[first:].to(self.embeddings.dtype)
+            self.labels[:n - first] = labels[first:].long()
+        self.position = end % self.size
+        self.filled = min(self.size, self.filled + n)
+
+    @torch.no_grad()
+    def _hardest(self, anchors, labels, chunk_size):
+        # closest bank entry of another class (euclidean distance), computed chunk by chunk so that only
+        # chunk_size entries are converted to float32 at a time
+        best_distance = anchors.new_full((len(anchors),), float('inf'))
+        best_index = torch.zeros(len(anchors), dtype=torch.long, device=anchors.device)
+        for start in range(0, self.filled, chunk_size):
+            bank = self.embeddings[start:min(start + chunk_size, self.filled)].float()
+            distances = torch.cdist(anchors, bank)
+            distances.masked_fill_(labels.long().unsqueeze(1) == self.labels[start:start + len(bank)].unsqueeze(0), float('inf'))
+            distance, index = distances.min(dim=1)
+            closer = distance < best_distance
+            best_distance = torch.where(closer, distance, best_distance)
+            best_index = torch.where(closer, index + start, best_index)
+        return best_distance, best_index
+
+    def hardest_negatives(self, anchors, labels, negatives, chunk_size=256):
+        """
+            For every anchor the closest among its negative and the bank entries of another class.
+            The bank entries are constants, the gradient flows through the anchors (and the negatives kept)
+        """
+        if self.filled == 0:
+            return negatives
+        anchors_detached = anchors.detach().float()
+        bank_distance, bank_index = self._hardest(anchors_detached, labels, chunk_size)
+        own_distance = torch.pairwise_distance(anchors_detached, negatives.detach().float())
+        from_bank = bank_distance < own_distance
+        if not from_bank.any():
+            return negatives
+        return torch.where(from_bank.unsqueeze(1), self.embeddings[bank_index].to(negatives.dtype), negatives)
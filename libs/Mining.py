@@ -0,0 +1,89 @@
+import numpy as np
+from PIL import Image
+from torch.utils import data
+from torch.utils.data import DataLoader
+from libs.Inference import index_representations, model_metric
+
+# Global hard-negative mining: every image of the training triplets is embedded once into a faiss index and the
+# negative of every triplet is replaced by one of the nearest neighbours of its anchor with a different label.
+
+class _MiningImages(data.Dataset):
+    def __init__(self, paths, labels, load):
+        self.paths = paths
+        self.labels = labels
+        self.load = load
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        return self.load(self.paths[i]), self.labels[i]
+
+def _images(triplets):
+    """
+        Unique (path, label) of the images of a triplet table
+    """
+    images = {}
+    for image_col, label_col in (('anchor_image', 'anchor_label'), ('pos_image', 'pos_label'), ('neg_image', 'neg_label')):
+        images.update(zip(triplets[image_col], triplets[label_col]))
+    return list(images), np.asarray(list(images.values()), dtype=np.int64)
+
+def mine_hard_negatives(model, triplets, load, k=20, top=1, batch_size=64, num_workers=0, query_batch_size=1024, seed=None):
+    """
+        Returns a copy of the triplet table with the negatives replaced by hard negatives: for every anchor
+        one of the `top` nearest neighbours (among the k nearest) with a different label, chosen at random.
+        The anchors with no wrong-class neighbour among the k nearest keep their negative.
+        The neighbours are searched with the metric of the model (model.metric, see libs.Inference.METRICS).
+        load(path) returns the model input of an image (a deterministic transform should be used).
+        Returns (triplets, statistics)
+    """
+    paths, labels = _images(triplets)
+    loader = DataLoader(_MiningImages(paths, labels, load), batch_size=batch_size, num_workers=num_workers)
+    metric = model_metric(model)
+    index, index_labels = index_representations(model, loader, metric=metric)
+    rows = {path: i for i, path in enumerate(paths)}
+
+    # only the anchors are searched, each once, reconstructed from the index in batches of query_batch_size
+    anchors = np.unique(triplets['anchor_image'].map(rows).to_numpy())
+    negatives, negative_distances = {}, []
+    rng = np.random.default_rng(seed)
+    for start in range(0, len(anchors), query_batch_size):
+        queries = anchors[start:start + query_batch_size]
+        x = np.stack([index.reconstruct(int(q)) for q in queries])
+        distances, neighbours = index.search(x, k + 1)
+        if metric == 'cosine':
+            # inner products of normalized embeddings, as cosine distances
+            distances = 1 - distances
+        wrong = (neighbours >= 0) & (index_labels[np.maximum(neighbours, 0)] != index_labels[queries][:, None])
+        for i, q in enumerate(queries):
+            candidates = np.flatnonzero(wrong[i])[:top]
+            if len(candidates):
+                j = rng.choice(candidates)
+                negatives[q] = neighbours[i, j]
+                negative_distances.append(distances[i, j])
+
+    mined = triplets.copy()
+    anchor_rows = triplets['anchor_image'].map(rows).to_numpy()
+    found = np.array([row in negatives for row in anchor_rows], dtype=bool)
+    negative_rows = np.array([negatives[row] for row in anchor_rows[found]], dtype=np.int64)
+    changed = found.copy()
+    if found.any():
+        changed[found] = mined.loc[found, 'neg_image'].to_numpy() != np.asarray(paths, dtype=object)[negative_rows]
+        mined.loc[found, 'neg_image'] = np.asarray(paths, dtype=object)[negative_rows]
+        mined.loc[found, 'neg_label'] = index_labels[negative_rows]
+
+    statistics = {'images': len(paths), 'mined_fraction': float(found.mean()), 'changed_fraction': float(changed.mean()),
+                  'negative_distance': float(np.mean(negative_distances)) if negative_distances else float('nan')}
+    return mined, statistics
+
+class ImageLoader:
+    """
+        load function of mine_hard_negatives for image files (picklable, so it can be used by the workers)
+    """
+    def __init__(self, transform, decoder=None):
+        self.transform = transform
+        # libs.Decoders.ImageDecoder, PIL if not given
+        self.decoder = decoder
+
+    def __call__(self, path):
+        return self.transform(self.decoder(path) if self.decoder is not None else Image.open(path))
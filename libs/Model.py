@@ -1,135 +1,229 @@
 import numpy as np
 import pytorch_lightning as pl
-import matplotlib.pyplot as plt
-from torch import nn
 import torch
-from torch.optim import SGD
 from torch import nn
-import torch
+from torch.optim import SGD
+from torch.utils.checkpoint import checkpoint
+from torchvision.models.squeezenet import Fire
+from functools import partial
+from contextlib import nullcontext
 import warnings
 from pytorch_lightning.utilities.warnings import PossibleUserWarning
 warnings.filterwarnings("ignore", category=PossibleUserWarning)
-from tqdm import tqdm
-import faiss
-from sklearn.metrics import accuracy_score
-from sklearn.manifold import TSNE
-from torchvision.models import squeezenet1_1
-from os.path import splitext, join
+from libs.Inference import build_embedding_net, extract_representation, index_representations, predict_nn, evaluate_classification, check_metric, model_metric, \
+                            uint8_normalization, normalize_uint8
+from libs.Evaluation import evaluate_retrieval, retrieval_metrics, search_neighbour_labels
+from libs.Visualization import plot_tsne, plot_values_tsne
+from libs.Profiling import StageTimer
+from libs.MemoryBank import EmbeddingMemoryBank
+from os.path import join
+
+# default margin of the cosine metric: the distances of L2-normalized embeddings are at most 2,
+# with a margin >= 2 the triplet loss is never zero
+COSINE_MARGIN = 0.5
+
+def cosine_distance(x, y):
+    return 1 - nn.functional.cosine_similarity(x, y)
+
+def triplet_criterion(metric='l2', with_distance=False):
+    """
+        Default criterion of the metric: TripletMarginLoss with margin 2 for l2 and COSINE_MARGIN for cosine.
+        With with_distance=True a TripletMarginWithDistanceLoss on the distance of the metric (1 - cosine similarity for cosine)
+    """
+    margin = COSINE_MARGIN if check_metric(metric) == 'cosine' else 2
+    if with_distance:
+        return nn.TripletMarginWithDistanceLoss(distance_function=cosine_distance if metric == 'cosine' else None, margin=margin)
+    return nn.TripletMarginLoss(margin=margin)
 
 class TripletNetwork(pl.LightningModule):
     """
         Triplet Neural Network that use SqueezeNet 1_1 as feature extractor.
         Arguments are fixed to avoid errors during checkpoint loading.
     """
-    def __init__(self, lr=7.585775750291837e-08, momentum=0.99, num_class=3, batch_size=256, criterion=nn.TripletMarginLoss(margin=2)):
+    def __init__(self, lr=7.585775750291837e-08, momentum=0.99, num_class=3, batch_size=256, criterion=None,
+                    pretrained=True, bf16=False, checkpoint_fire=False, frozen_fire=0, cached_features=False,
+                    memory_bank_size=0, memory_bank_fp16=False, metric='l2', batch_hard=False):
         super(TripletNetwork, self).__init__()
 
         self.save_hyperparameters(ignore=['embedding_net'])
 
-        squeezeNet = squeezenet1_1(pretrained=True)
-        squeezeNet.classifier = nn.Identity()
-
-        self.embedding_net = squeezeNet
-        self.criterion = criterion
+        self.embedding_net = build_embedding_net(pretrained=pretrained)
 
         self.num_class = num_class
         self.lr = lr
         self.momentum = momentum
         self.batch_size = batch_size
+        # bfloat16 autocast of the embedding net, the loss is always computed in float32
+        self.bf16 = bf16
+        # activation checkpointing at the boundaries of the Fire modules: their activations are recomputed
+        # during backward instead of being kept for the whole batch, trading time for memory
+        self.checkpoint_fire = checkpoint_fire
+
+        # the first frozen_fire Fire modules (and the layers before them) are not trained. With cached_features
+        # the inputs are their activations, precomputed once by libs.FeatureCache, and only the rest of the net runs
+        fire_indices = [i for i, layer in enumerate(self.embedding_net.features) if isinstance(layer, Fire)]
+        if not 0 <= frozen_fire <= len(fire_indices):
+            raise ValueError("frozen_fire must be between 0 and {} (the Fire modules of the net), got {}".format(len(fire_indices), frozen_fire))
+        self.frozen_layers = fire_indices[frozen_fire - 1] + 1 if frozen_fire > 0 else 0
+        self.cached_features = cached_features
+        for p in self.frozen_prefix().parameters():
+            p.requires_grad = False
+
+        # FIFO of the last memory_bank_size anchor embeddings: the negative of every triplet is replaced by the closest
+        # embedding of another class in the bank when it is harder (libs.MemoryBank), float16 halves its memory
+        self.memory_bank = None
+        if memory_bank_size > 0:
+            self.memory_bank = EmbeddingMemoryBank(memory_bank_size, torch.float16 if memory_bank_fp16 else torch.float32)
+
+        # distance of the embeddings, followed by the loss, the memory bank and the faiss indexes (libs.Inference.METRICS).
+        # With 'cosine' the embeddings are L2-normalized, their euclidean distance sqrt(2 - 2 cos) orders them as the
+        # cosine similarity, so the margin of the criterion is on a [0, 2] scale. criterion=None is triplet_criterion(metric)
+        self.metric = check_metric(metric)
+        self.criterion = criterion if criterion is not None else triplet_criterion(metric)
+        if self.metric == 'cosine' and getattr(self.criterion, 'margin', 0) >= 2:
+            raise ValueError("The cosine distances are at most 2, the margin {} of the criterion must be lower (see triplet_criterion)"
+                             .format(self.criterion.margin))
+
+        # batch-hard triplet loss over all the embeddings of the batch (anchors, positives and negatives) instead of
+        # the triplets of the .csv, fed by class balanced batches (TripletTrashbinDataModule(classes_per_batch=...)).
+        # It uses the margin and the distance of the criterion: euclidean or cosine_distance
+        self.batch_hard = batch_hard
+        if batch_hard:
+            if memory_bank_size > 0:
+                raise ValueError("memory_bank_size and batch_hard can not be used together")
+            distance_function = getattr(self.criterion, 'distance_function', None)
+            if distance_function not in (None, cosine_distance):
+                raise ValueError("batch_hard supports the euclidean distance and cosine_distance, not {}".format(distance_function))
+            self.batch_hard_distance = 'cosine' if distance_function is cosine_distance else 'euclidean'
+
+        # uint8 image batches (TripletTrashbinDataModule(uint8_transport=True)) are scaled and normalized at the start
+        # of embed, not saved in the checkpoints
+        scale, shift = uint8_normalization()
+        self.register_buffer('input_scale', scale, persistent=False)
+        self.register_buffer('input_shift', shift, persistent=False)
+
+        # per-stage timing of the steps, disabled unless a StageTimingCallback is used
+        self.stage_timer = StageTimer()
+
+    def _autocast(self, module, x):
+        # autocast is entered again inside the checkpointed function, so the recomputation uses the same precision.
+        # Without bf16 an autocast opened by the caller (e.g. extract_representation) is left untouched
+        if not self.bf16:
+            return module(x)
+        with torch.autocast(device_type=x.device.type, dtype=torch.bfloat16):
+            return module(x)
+
+    def frozen_prefix(self):
+        """
+            Frozen layers of the embedding net, whose activations can be cached (see libs.FeatureCache)
+        """
+        return self.embedding_net.features[:self.frozen_layers]
+
+    def _embed_layers(self, x, start=0):
+        checkpointing = self.checkpoint_fire and self.training and torch.is_grad_enabled()
+        for layer in self.embedding_net.features[start:]:
+            if checkpointing and isinstance(layer, Fire):
+                x = checkpoint(partial(self._autocast, layer), x, use_reentrant=False)
+            else:
+                x = self._autocast(layer, x)
+        x = self._autocast(self.embedding_net.classifier, x)
+        return torch.flatten(x, 1)
+
+    def embed(self, x):
+        x = normalize_uint8(x, self.input_scale, self.input_shift)
+        if self.cached_features:
+            # the cache is stored in float16
+            x = self._embed_layers(x.float(), start=self.frozen_layers)
+        elif self.checkpoint_fire and self.training and torch.is_grad_enabled():
+            x = self._embed_layers(x)
+        else:
+            x = self._autocast(self.embedding_net, x)
+        return nn.functional.normalize(x.float(), dim=1) if self.metric == 'cosine' else x
 
     def forward(self, x):
-        return self.embedding_net(x)
+        return self.embed(x)
 
     def configure_optimizers(self):
         return SGD(self.embedding_net.parameters(), self.hparams.lr, momentum=self.hparams.momentum)
 
     # Lightning automatically sets the model to training for training_step and to eval for validation.
     def training_step(self, batch, batch_idx):
-        I_i, _, I_j, _, I_k, _ = batch
-
-        anchor = self.embedding_net(I_i)
-        positive = self.embedding_net(I_j)
-        negative = self.embedding_net(I_k)
-
-        l = self.criterion(anchor, positive, negative)
+        I_i, l_i, I_j, l_j, I_k, l_k = batch
+
+        with self.stage_timer.stage('forward_anchor'):
+            anchor = self.embed(I_i).float()
+        with self.stage_timer.stage('forward_positive'):
+            positive = self.embed(I_j).float()
+        with self.stage_timer.stage('forward_negative'):
+            negative = self.embed(I_k).float()
+
+        with self.stage_timer.stage('loss'):
+            if self.batch_hard:
+                l = batch_hard_triplet_loss(torch.cat([anchor, positive, negative]), torch.cat([l_i, l_j, l_k]),
+                                            self.criterion.margin, self.batch_hard_distance)
+            else:
+                if self.memory_bank is not None:
+                    negative = self.memory_bank.hardest_negatives(anchor, l_i, negative)
+                    self.memory_bank.enqueue(anchor, l_i)
+                l = self.criterion(anchor, positive, negative)
 
         # logs metrics for each training_step, and the average across the epoch, to the progress bar and logger
-        self.log('train/loss', l) #, on_step=True, on_epoch=True, prog_bar=True, logger=True)
+        with self.stage_timer.stage('log'):
+            self.log('train/loss', l) #, on_step=True, on_epoch=True, prog_bar=True, logger=True)
         
         return l
 
     def validation_step(self, batch, batch_idx):
         I_i, _, I_j, _, I_k, _ = batch
-        anchor = self.embedding_net(I_i)
-        positive = self.embedding_net(I_j)
-        negative = self.embedding_net(I_k)
-        
+        with self.stage_timer.stage('valid_forward'):
+            anchor = self.embed(I_i).float()
+            positive = self.embed(I_j).float()
+            negative = self.embed(I_k).float()
+
         l = self.criterion(anchor, positive, negative)
-        
-        self.log('valid/loss', l)
-        
-        if batch_idx == 0:
-            self.logger.experiment.add_embedding(anchor, batch[3], I_i, global_step=self.global_step)
 
-class TripletNetworkV2(pl.LightningModule):
+        # averaged over the ranks when training with DDP, the loggers write only on rank zero
+        self.log('valid/loss', l, sync_dist=True)
+
+        # the embeddings are logged to the projector by EmbeddingProjectorCallback
+        return {'loss': l, 'embeddings': anchor.detach()}
+
+def batch_hard_triplet_loss(embeddings, labels, margin, distance='euclidean'):
     """
-        Triplet Neural Network that use SqueezeNet 1_1 as feature extractor.
+        Triplet loss of every embedding with the farthest embedding of its class and the closest one of another class
+        in the batch. The distances are an N x N matrix: torch.cdist for 'euclidean', 1 - cosine similarity for 'cosine'
+    """
+    if distance == 'cosine':
+        normalized = nn.functional.normalize(embeddings, dim=1)
+        distances = 1 - normalized @ normalized.t()
+    else:
+        # without the matrix product form, whose gradient is not finite on the zero distances of the diagonal
+        distances = torch.cdist(embeddings, embeddings, compute_mode='donot_use_mm_for_euclid_dist')
+    same = labels.unsqueeze(0) == labels.unsqueeze(1)
+    hardest_positive = distances.masked_fill(~same, 0).max(dim=1).values
+    hardest_negative = distances.masked_fill(same, float('inf')).min(dim=1).values
+    # embeddings without any other class in the batch have no triplet
+    valid = torch.isfinite(hardest_negative)
+    losses = torch.relu(hardest_positive - hardest_negative.masked_fill(~valid, 0) + margin) * valid
+    return losses.sum() / valid.sum().clamp(min=1)
+
+class TripletNetworkV2(TripletNetwork):
+    """
+        Triplet Neural Network that use SqueezeNet 1_1 as feature extractor, trained with TripletMarginWithDistanceLoss
+        (by default on the distance of the metric, see triplet_criterion).
         Arguments are fixed to avoid errors during checkpoint loading.
     """
-    def __init__(self, lr=7.585775750291837e-08, momentum=0.99, num_class=3, batch_size=256, criterion=nn.TripletMarginWithDistanceLoss(margin=2)):
-        super(TripletNetworkV2, self).__init__()
-
-        self.save_hyperparameters(ignore=['embedding_net'])
-
-        squeezeNet = squeezenet1_1(pretrained=True)
-        squeezeNet.classifier = nn.Identity()
-
-        self.embedding_net = squeezeNet
-        self.criterion = criterion
-
-        self.num_class = num_class
-        self.lr = lr
-        self.momentum = momentum
-        self.batch_size = batch_size
-
-    def forward(self, x):
-        return self.embedding_net(x)
-
-    def configure_optimizers(self):
-        return SGD(self.embedding_net.parameters(), self.hparams.lr, momentum=self.hparams.momentum)
-
-    # Lightning automatically sets the model to training for training_step and to eval for validation.
-    def training_step(self, batch, batch_idx):
-        I_i, _, I_j, _, I_k, _ = batch
-
-        anchor = self.embedding_net(I_i)
-        positive = self.embedding_net(I_j)
-        negative = self.embedding_net(I_k)
-
-        l = self.criterion(anchor, positive, negative)
-
-        # logs metrics for each training_step, and the average across the epoch, to the progress bar and logger
-        self.log('train/loss', l) #, on_step=True, on_epoch=True, prog_bar=True, logger=True)
-        
-        return l
-
-    def validation_step(self, batch, batch_idx):
-        I_i, _, I_j, _, I_k, _ = batch
-        anchor = self.embedding_net(I_i)
-        positive = self.embedding_net(I_j)
-        negative = self.embedding_net(I_k)
-        
-        l = self.criterion(anchor, positive, negative)
-        
-        self.log('valid/loss', l)
-        
-        if batch_idx == 0:
-            self.logger.experiment.add_embedding(anchor, batch[3], I_i, global_step=self.global_step)
+    def __init__(self, lr=7.585775750291837e-08, momentum=0.99, num_class=3, batch_size=256, criterion=None, metric='l2', **kwargs):
+        criterion = criterion if criterion is not None else triplet_criterion(metric, with_distance=True)
+        super(TripletNetworkV2, self).__init__(lr=lr, momentum=momentum, num_class=num_class, batch_size=batch_size, criterion=criterion,
+                                               metric=metric, **kwargs)
 
 def extr_rgb_rep(loader):
     """
         Extract representations from data loader
     """
+    from tqdm import tqdm
+
     representations, label = [], []
     for batch in tqdm(loader, total=len(loader)):
         representations.append(batch[0].view(batch[0].shape[0], -1).numpy())
@@ -137,68 +231,8 @@ def extr_rgb_rep(loader):
 
     return np.concatenate(representations), np.concatenate(label)
 
-def extract_representation(model, loader):
-    """
-        Extra representation from data loader with a model
-    """
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    model.eval()
-    model.to(device)
-    representations, labels = [], []
-    for batch in tqdm(loader, total=len(loader)):
-        x = batch[0].to(device)
-        rep = model(x)
-        rep = rep.detach().to('cpu').numpy()
-        labels.append(batch[1])
-        representations.append(rep)
-    return np.concatenate(representations), np.concatenate(labels)
-
-def predict_nn(train_rep, test_rep, train_label):
-    """
-        Predict the predicted labels on the test set using NN
-    """
-    index = faiss.IndexFlatL2(train_rep.shape[1])
-
-    index.add(train_rep.astype(np.float32))
-
-    indices = np.array([index.search(x.reshape(1,-1).astype(np.float32), k=1)[1][0][0] for x in test_rep])
-
-    return train_label[indices].squeeze()
-
-def evaluate_classification(pred_label, gt_label):
-    """
-        Measure the accuracy of the prediction obtained from the predicted value and ground truth using accuracy_score
-    """
-
-    # The best performance is 1 with normalize == True and the number of samples with normalize == False.
-    classification_error = accuracy_score(y_true=gt_label, y_pred=pred_label, normalize=True)
-
-    return classification_error
-
-def plot_values_tsne(embedding_net, test_loader):
-    """
-        Extract representation from test dataloader. Select randomly 10000 elements and using TSNE
-        from sklearn.manifold plot the result using matplotlib
-
-        t-SNE is a tool to visualize high-dimensional data.
-        It converts similarities between data points to joint probabilities and
-        tries to minimize the Kullback-Leibler divergence between the joint probabilities
-        of the low-dimensional embedding and the high-dimensional data.
-        more here https://scikit-learn.org/stable/modules/generated/sklearn.manifold.TSNE.html
-    """
-    test_rep, test_labels = extract_representation(embedding_net, test_loader)
-    selected_rep = np.random.choice(len(test_rep), 10000)
-    selected_test_rep = test_rep[selected_rep]
-    selected_test_labels = test_labels[selected_rep]
-    
-    tsne = TSNE(2)
-    rep_tsne = tsne.fit_transform(selected_test_rep)
-
-    plt.figure(figsize=(8,6))
-    for c in np.unique(selected_test_labels):
-        plt.plot(rep_tsne[selected_test_labels==c, 0], rep_tsne[selected_test_labels==c, 1], 'o', label=c)
-    plt.legend()
-    plt.show()
+def _memory_stage(monitor, name):
+    return monitor.stage(name) if monitor is not None else nullcontext()
 
 def evaluating_performance(lighting_module, datamodule):
     """
@@ -207,64 +241,64 @@ def evaluating_performance(lighting_module, datamodule):
     """
     # Uso il modello per estrarre le rappresentazione dal training e dal test_set
 
-    train_rep_base, train_label = extract_representation(lighting_module, datamodule.train_dataloader())
+    train_rep_base, train_label = extract_representation(lighting_module, datamodule.gallery_dataloader())
     test_rep_base, test_label = extract_representation(lighting_module, datamodule.test_dataloader())
 
     # Valuto le performance del sistema con queste rappresentazioni non ancora ottimizzate
 
-    pred_test_label_base = predict_nn(train_rep=train_rep_base, test_rep=test_rep_base, train_label=train_label)
+    pred_test_label_base = predict_nn(train_rep=train_rep_base, test_rep=test_rep_base, train_label=train_label,
+                                      metric=model_metric(lighting_module))
 
     class_error = evaluate_classification(pred_test_label_base, test_label)
 
     print('Classification error {}'.format(class_error))
 
-    plot_values_tsne(lighting_module.embedding_net, datamodule.test_dataloader())
+    return plot_tsne(test_rep_base, test_label)
 
-def evaluating_performance_only(lighting_module, datamodule):
+def evaluating_performance_only(lighting_module, datamodule, monitor=None, return_metrics=False):
     """
-        Calculates the classification error of the model and displays
-        the graph of the tsne obtained
+        Calculates the classification error of the model.
+        The training representations are added to the index batch by batch (the index holds all of them, O(dataset)
+        memory), the test ones are searched batch by batch and not kept.
+        With a libs.Profiling.MemoryMonitor the memory peak of every stage is recorded in monitor.stages.
+        With return_metrics=True returns (classification error, retrieval metrics of libs.Evaluation)
     """
-    # Uso il modello per estrarre le rappresentazione dal training e dal test_set
+    # Uso il modello per estrarre le rappresentazione dal training e le cerco nell'indice batch per batch
 
-    train_rep_base, train_label = extract_representation(lighting_module, datamodule.train_dataloader())
-    test_rep_base, test_label = extract_representation(lighting_module, datamodule.test_dataloader())
-
-    # Valuto le performance del sistema con queste rappresentazioni non ancora ottimizzate
+    with _memory_stage(monitor, 'predict_nn'):
+        metrics = evaluate_retrieval(lighting_module, datamodule.gallery_dataloader(), datamodule.test_dataloader())
 
-    pred_test_label_base = predict_nn(train_rep=train_rep_base, test_rep=test_rep_base, train_label=train_label)
-
-    class_error = evaluate_classification(pred_test_label_base, test_label)
+    # top-1 accuracy of the nearest neighbour, as evaluate_classification
+    class_error = metrics['accuracy']
 
     print('Classification error {}'.format(class_error))
 
-def evaluating_performance_and_save_tsne_plot(lighting_module, datamodule, plot_name=""):
+    return (class_error, metrics) if return_metrics else class_error
+
+def evaluating_performance_and_save_tsne_plot(lighting_module, datamodule, plot_name="", monitor=None, return_metrics=False):
     """
         Calculates the classification error of the model and save on specific path
-        the graph of the tsne obtained
+        the graph of the tsne obtained (memory peaks of the stages and return_metrics as in evaluating_performance_only).
+        The test representations are kept for t-SNE, the training ones only in the index (O(dataset) memory)
     """
     # Uso il modello per estrarre le rappresentazione dal training e dal test_set
 
-    train_rep_base, train_label = extract_representation(lighting_module, datamodule.train_dataloader())
-    test_rep_base, test_label = extract_representation(lighting_module, datamodule.test_dataloader())
+    with _memory_stage(monitor, 'index_train'):
+        index, train_label = index_representations(lighting_module, datamodule.gallery_dataloader())
+    with _memory_stage(monitor, 'extract_test'):
+        test_rep_base, test_label = extract_representation(lighting_module, datamodule.test_dataloader())
 
     # Valuto le performance del sistema con queste rappresentazioni non ancora ottimizzate
 
-    pred_test_label_base = predict_nn(train_rep=train_rep_base, test_rep=test_rep_base, train_label=train_label)
+    # one search with the k neighbours of the retrieval metrics, the first one is the prediction
+    with _memory_stage(monitor, 'predict_nn'):
+        metrics = retrieval_metrics(search_neighbour_labels(index, train_label, test_rep_base, k=10), test_label, train_label)
 
-    class_error = evaluate_classification(pred_test_label_base, test_label)
+    class_error = metrics['accuracy']
     print('Classification error {}'.format(class_error))
 
-    test_rep, test_labels = extract_representation(lighting_module.embedding_net, datamodule.test_dataloader())
-    selected_rep = np.random.choice(len(test_rep), 10000)
-    selected_test_rep = test_rep[selected_rep]
-    selected_test_labels = test_labels[selected_rep]
-    
-    tsne = TSNE(2)
-    rep_tsne = tsne.fit_transform(selected_test_rep)
-
-    plt.figure(figsize=(8,6))
-    for c in np.unique(selected_test_labels):
-        plt.plot(rep_tsne[selected_test_labels==c, 0], rep_tsne[selected_test_labels==c, 1], 'o', label=c)
-    plt.legend()
-    plt.savefig(join('models/', plot_name))
\ No newline at end of file
+    # the projection is cached next to the plot, so plotting again the same checkpoint skips t-SNE
+    with _memory_stage(monitor, 'tsne'):
+        plot_tsne(test_rep_base, test_label, plot_path=join('models/', plot_name), cache_path=join('models/', plot_name + '.npz'))
+
+    return (class_error, metrics) if return_metrics else class_error
@@ -0,0 +1,53 @@
+import torch
+
+class PinnedBatchBuffers:
+    """
+        Preallocated page-locked host buffers for the uint8 image batches copied to the GPU
+        (see TripletTrashbinDataModule(uint8_transport=True)). Every image tensor of the batch has `slots` buffers,
+        allocated once for its shape and used in turn: a buffer is refilled only when the asynchronous copy
+        from it to the device has completed. Pinning is done in the training process, the memory pinned by the
+        dataloader workers would not be usable by its CUDA context
+    """
+    def __init__(self, slots=2):
+        self.slots = slots
+        self.buffers = {}
+        self.position = {}
+        self.events = {}
+        self._used = []
+
+    # pickled empty (e.g. with the datamodule sent to a spawned process): the CUDA events can not be pickled
+    # and the pinned memory belongs to this process
+    def __getstate__(self):
+        return {'slots': self.slots}
+
+    def __setstate__(self, state):
+        self.__init__(state['slots'])
+
+    def _buffer(self, key, tensor):
+        if key not in self.buffers:
+            self.buffers[key] = [torch.empty(tensor.shape, dtype=tensor.dtype).pin_memory() for _ in range(self.slots)]
+            self.events[key] = [None] * self.slots
+            self.position[key] = 0
+        slot = self.position[key]
+        self.position[key] = (slot + 1) % self.slots
+        if self.events[key][slot] is not None:
+            self.events[key][slot].synchronize()
+        self._used.append((key, slot))
+        return self.buffers[key][slot]
+
+    def stage(self, batch):
+        """
+            The batch with its uint8 tensors copied in pinned buffers, the other items unchanged
+        """
+        return type(batch)(self._buffer((i, tuple(x.shape)), x).copy_(x) if isinstance(x, torch.Tensor) and x.dtype == torch.uint8 else x
+                           for i, x in enumerate(batch))
+
+    def record(self):
+        """
+            Mark the buffers of the last staged batch as busy until the copies queued on the current stream are done
+        """
+        for key, slot in self._used:
+            event = torch.cuda.Event()
+            event.record()
+            self.events[key][slot] = event
+        self._used = []
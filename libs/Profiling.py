@@ -0,0 +1,251 @@
+import contextlib
+import ctypes
+import multiprocessing as mp
+import queue
+import threading
+import time
+from collections import defaultdict
+import numpy as np
+import torch
+from torch.utils.data import get_worker_info
+from torch.utils.data.dataloader import default_collate
+
+_DISABLED = contextlib.nullcontext()
+
+class _Timing:
+    __slots__ = ('samples', 'start')
+
+    def __init__(self, samples):
+        self.samples = samples
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.samples.append(time.perf_counter() - self.start)
+
+class StageTimer:
+    """
+        Collect the duration of named stages of the hot paths (file open, decode, forward...).
+        When disabled `stage` returns a shared no-op context manager, so the instrumentation costs
+        one method call per stage. Samples recorded in DataLoader workers are sent to the main process
+        through a queue at every `flush` (workers must be forked, the default on Linux)
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.samples = defaultdict(list)
+        self._queue = mp.Queue() if enabled else None
+
+    def stage(self, name):
+        if not self.enabled:
+            return _DISABLED
+        return _Timing(self.samples[name])
+
+    def add(self, name, seconds):
+        if self.enabled:
+            self.samples[name].append(seconds)
+
+    def flush(self):
+        """
+            Send the samples recorded in a worker process to the main process
+        """
+        if self.enabled and get_worker_info() is not None and self.samples:
+            self._queue.put(dict(self.samples))
+            self.samples.clear()
+
+    def drain(self):
+        """
+            Merge in the main process the samples sent by the workers
+        """
+        if not self.enabled:
+            return
+        while True:
+            try:
+                worker_samples = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            for name, values in worker_samples.items():
+                self.samples[name].extend(values)
+
+    def pop(self):
+        """
+            Returns the samples collected so far and starts a new collection
+        """
+        self.drain()
+        samples = {name: np.asarray(values) for name, values in self.samples.items() if values}
+        self.samples.clear()
+        return samples
+
+    # the queue is only inherited by forked workers, a pickled timer (e.g. in a spawned process) is disabled
+    def __getstate__(self):
+        return {'enabled': False}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+class TimedCollate:
+    """
+        default_collate timed as the 'collate' stage. Since it runs once per batch in the worker,
+        it also flushes the worker samples of the batch to the main process
+    """
+    def __init__(self, timer):
+        self.timer = timer
+
+    def __call__(self, batch):
+        with self.timer.stage('collate'):
+            batch = default_collate(batch)
+        self.timer.flush()
+        return batch
+
+def summarize(samples):
+    """
+        count, total, mean, p50, p95 and max (seconds) of every stage
+    """
+    return {name: {'count': len(v), 'total': float(v.sum()), 'mean': float(v.mean()),
+                   'p50': float(np.percentile(v, 50)), 'p95': float(np.percentile(v, 95)), 'max': float(v.max())}
+            for name, v in samples.items()}
+
+def format_summary(summary, data_wait_fraction=None):
+    """
+        Table of the stages sorted by total time
+    """
+    lines = ["{:<20} {:>8} {:>10} {:>10} {:>10} {:>10}".format("stage", "count", "total (s)", "mean (ms)", "p50 (ms)", "p95 (ms)")]
+    for name, s in sorted(summary.items(), key=lambda item: -item[1]['total']):
+        lines.append("{:<20} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+            name, s['count'], s['total'], s['mean'] * 1e3, s['p50'] * 1e3, s['p95'] * 1e3))
+    if data_wait_fraction is not None:
+        lines.append("data wait: {:.1%} of the training loop".format(data_wait_fraction))
+    return "\n".join(lines)
+
+class _MallInfo2(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_size_t) for name in
+                ('arena', 'ordblks', 'smblks', 'hblks', 'hblkhd', 'usmblks', 'fsmblks', 'uordblks', 'fordblks', 'keepcost')]
+
+_mallinfo2 = None
+
+def heap_allocated():
+    """
+        Bytes currently allocated with malloc by this process (glibc mallinfo2: arenas and mmapped blocks), where
+        the cpu tensors of torch live. Unlike the RSS it goes down when tensors are freed, and it does not count
+        the mapped files and the shared memory of the batches. None without glibc >= 2.33
+    """
+    global _mallinfo2
+    if _mallinfo2 is None:
+        try:
+            _mallinfo2 = ctypes.CDLL(None).mallinfo2
+            _mallinfo2.restype = _MallInfo2
+        except (OSError, AttributeError):
+            _mallinfo2 = False
+    if not _mallinfo2:
+        return None
+    info = _mallinfo2()
+    return info.uordblks + info.hblkhd
+
+class MemoryMonitor:
+    """
+        Sample in a background thread the RSS of this process and of its children (the DataLoader workers) and
+        the bytes allocated on the heap of this process (heap_allocated, the cpu tensors) every `interval` seconds,
+        keeping the peaks since the last `reset`. On cuda the exact peak of the tensors allocated by torch is tracked
+        too; on cpu the heap peak is sampled, allocations shorter than `interval` can be missed.
+        Use `stage(name)` to record the peak of a block of code (e.g. an evaluation stage)
+    """
+    def __init__(self, interval=0.05):
+        import psutil
+
+        self.interval = interval
+        self._process = psutil.Process()
+        self._psutil = psutil
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stages = {}
+        self.last = {}
+        self.peak_main = self.peak_workers = self.peak_total = self.peak_heap = 0
+        self.peak_per_worker = {}
+        self.reset()
+
+    def sample(self):
+        """
+            Measure now, on top of the samples of the background thread (it walks the child processes)
+        """
+        main = self._process.memory_info().rss
+        heap = heap_allocated()
+        workers = {}
+        for child in self._process.children(recursive=True):
+            try:
+                workers[child.pid] = child.memory_info().rss
+            except (self._psutil.NoSuchProcess, self._psutil.AccessDenied):
+                pass
+        with self._lock:
+            self.last = {'main': main, 'workers': workers, 'heap': heap}
+            self.peak_main = max(self.peak_main, main)
+            if heap is not None:
+                self.peak_heap = max(self.peak_heap, heap)
+            self.peak_workers = max(self.peak_workers, sum(workers.values()))
+            self.peak_total = max(self.peak_total, main + sum(workers.values()))
+            for pid, rss in workers.items():
+                self.peak_per_worker[pid] = max(self.peak_per_worker.get(pid, 0), rss)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="memory-monitor", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def reset(self):
+        """
+            Start a new peak measurement and return the peaks (bytes) measured since the previous reset
+        """
+        with self._lock:
+            peaks = self.peaks()
+            self.peak_main = self.peak_workers = self.peak_total = self.peak_heap = 0
+            self.peak_per_worker = {}
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self.sample()
+        return peaks
+
+    def peaks(self):
+        """
+            Peaks (bytes) since the last reset
+        """
+        peaks = {'main_rss': self.peak_main, 'workers_rss': self.peak_workers, 'total_rss': self.peak_total,
+                 'max_worker_rss': max(self.peak_per_worker.values(), default=0), 'num_workers': len(self.peak_per_worker)}
+        if self.last.get('heap') is not None:
+            peaks['main_heap'] = self.peak_heap
+        if torch.cuda.is_available():
+            peaks['cuda_allocated'] = torch.cuda.max_memory_allocated()
+        return peaks
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+            Record in self.stages[name] the peaks reached while the block runs and the growth of the main RSS
+        """
+        self.reset()
+        start = self._process.memory_info().rss
+        try:
+            yield
+        finally:
+            self.sample()
+            peaks = self.peaks()
+            peaks['main_rss_increase'] = max(0, peaks['main_rss'] - start)
+            self.stages[name] = peaks
+
+    def format_stages(self):
+        lines = ["{:<24} {:>14} {:>16} {:>16}".format("stage", "peak rss (MB)", "rss increase (MB)", "workers rss (MB)")]
+        for name, p in self.stages.items():
+            lines.append("{:<24} {:>14.0f} {:>16.0f} {:>16.0f}".format(name, p['main_rss'] / 2**20, p['main_rss_increase'] / 2**20,
+                                                                        p['workers_rss'] / 2**20))
+        return "\n".join(lines)
@@ -0,0 +1,138 @@
+import warnings
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+class ResumableSampler(Sampler):
+    """
+        Sampler of the training set that can be checkpointed in the middle of an epoch.
+        It yields the indices of this rank (strided and padded as DistributedSampler(shuffle=False), or a
+        permutation of seed + epoch with shuffle=True) skipping the `consumed` ones, so a resumed run continues
+        at the exact batch where it stopped. `consumed` is advanced by ResumableSamplerCallback when the training
+        loop actually uses a batch, not when the workers prefetch it. __len__ stays the length of the whole epoch,
+        as expected by the training loop, which restores its own batch count.
+        The random data augmentation of the workers is not part of the state
+    """
+    def __init__(self, length, num_replicas=1, rank=0, shuffle=False, seed=0):
+        self.length = length
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.consumed = 0
+        self.num_samples = (length + num_replicas - 1) // num_replicas
+
+    def _indices(self):
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(self.length, generator=generator).numpy()
+        else:
+            indices = np.arange(self.length)
+        # padded with the first indices so that every rank has the same number of samples
+        total = self.num_samples * self.num_replicas
+        indices = np.concatenate([indices, indices[:total - self.length]])
+        return indices[self.rank:total:self.num_replicas]
+
+    def __iter__(self):
+        # an epoch consumed completely (e.g. a new fit on the same datamodule) starts again from the beginning
+        if self.consumed >= self.num_samples:
+            self.consumed = 0
+        return iter(self._indices()[self.consumed:].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        """
+            Called by the training loop at the start of every epoch: a new epoch starts from its first sample,
+            the epoch being resumed keeps the consumed samples
+        """
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.consumed = 0
+
+    def advance(self, n):
+        self.consumed = min(self.num_samples, self.consumed + n)
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'consumed': self.consumed, 'length': self.length,
+                'num_replicas': self.num_replicas, 'shuffle': self.shuffle, 'seed': self.seed}
+
+    def load_state_dict(self, state):
+        if (state.get('length'), state.get('num_replicas'), state.get('shuffle'), state.get('seed')) != (self.length, self.num_replicas, self.shuffle, self.seed):
+            warnings.warn("The sampler state was saved for a different dataset or world size, the epoch starts from the beginning")
+            return
+        self.epoch = state['epoch']
+        self.consumed = state['consumed']
+
+class ClassBalancedBatchSampler(Sampler):
+    """
+        Batch sampler that builds every batch from P = classes_per_batch classes x K = samples_per_class rows of each,
+        so every batch holds the same class mix and the most valid in-batch triplets.
+        Only an index array per class is kept. Each class is read in a random order (seed + epoch) and reshuffled when
+        exhausted, so the small classes are oversampled; an epoch has len(labels) // (P * K) batches in total.
+        With several processes every rank builds the same batches and takes one every num_replicas.
+        Checkpointable as ResumableSampler (state_dict, load_state_dict, set_epoch, advance)
+    """
+    def __init__(self, labels, classes_per_batch, samples_per_class, num_replicas=1, rank=0, seed=0):
+        labels = np.asarray(labels)
+        self.classes = np.unique(labels)
+        if classes_per_batch > len(self.classes):
+            raise ValueError("classes_per_batch ({}) is larger than the number of classes ({})".format(classes_per_batch, len(self.classes)))
+        self.class_indices = [np.flatnonzero(labels == c).astype(np.int64) for c in self.classes]
+        self.length = len(labels)
+        self.classes_per_batch = classes_per_batch
+        self.samples_per_class = samples_per_class
+        self.batch_size = classes_per_batch * samples_per_class
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.consumed = 0
+        self.num_batches = max(1, self.length // self.batch_size // num_replicas)
+
+    def _batches(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        orders = [rng.permutation(indices) for indices in self.class_indices]
+        positions = [0] * len(orders)
+        batches = np.empty((self.num_batches * self.num_replicas, self.batch_size), dtype=np.int64)
+        for batch in batches:
+            for j, c in enumerate(rng.choice(len(orders), self.classes_per_batch, replace=False)):
+                if positions[c] + self.samples_per_class > len(orders[c]):
+                    orders[c], positions[c] = rng.permutation(self.class_indices[c]), 0
+                # classes smaller than K repeat their rows
+                batch[j * self.samples_per_class:(j + 1) * self.samples_per_class] = np.resize(
+                    orders[c][positions[c]:positions[c] + self.samples_per_class], self.samples_per_class)
+                positions[c] += self.samples_per_class
+        return batches[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        if self.consumed >= self.num_batches * self.batch_size:
+            self.consumed = 0
+        for batch in self._batches()[self.consumed // self.batch_size:]:
+            yield batch.tolist()
+
+    def __len__(self):
+        return self.num_batches
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.consumed = 0
+
+    def advance(self, n):
+        self.consumed = min(self.num_batches * self.batch_size, self.consumed + n)
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'consumed': self.consumed, 'length': self.length, 'num_replicas': self.num_replicas,
+                'batch': (self.classes_per_batch, self.samples_per_class), 'seed': self.seed}
+
+    def load_state_dict(self, state):
+        if ((state.get('length'), state.get('num_replicas'), tuple(state.get('batch', ())), state.get('seed'))
+                != (self.length, self.num_replicas, (self.classes_per_batch, self.samples_per_class), self.seed)):
+            warnings.warn("The sampler state was saved for a different dataset, batch or world size, the epoch starts from the beginning")
+            return
+        self.epoch = state['epoch']
+        self.consumed = state['consumed']
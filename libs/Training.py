@@ -0,0 +1,184 @@
+import copy
+import multiprocessing as mp
+import os
+import queue
+import traceback
+import torch
+import pytorch_lightning as pl
+from pytorch_lightning.utilities.apply_func import apply_to_collection
+from pytorch_lightning.strategies import DDPStrategy
+from libs.Evaluation import log_retrieval_metrics
+from libs.Profiling import MemoryMonitor
+from libs.Weights import save_flat_weights
+
+def _memory_monitor():
+    # psutil is optional, without it the evaluation is not measured
+    try:
+        return MemoryMonitor().start()
+    except ImportError:
+        return None
+
+def snapshot_checkpoint(trainer):
+    """
+        The checkpoint trainer.save_checkpoint would write (same hooks, to be called on every rank) as a dict
+        with its tensors copied to cpu, so training can go on while it is serialized
+    """
+    # PL 1.6 has no public API for the checkpoint dict without writing it
+    checkpoint = trainer._checkpoint_connector.dump_checkpoint(weights_only=False)
+    return apply_to_collection(checkpoint, torch.Tensor, lambda t: t.detach().to('cpu', copy=True))
+
+def _checkpoint_and_evaluate(model_cls, datamodule, checkpoint, ckpt_path, plot_name, num_threads, results):
+    """
+        Body of the background process: write the checkpoint snapshot (.ckpt), its state_dict (.pth) and the flat
+        weights, then evaluate it on the datamodule and send the accuracy back
+    """
+    from libs.Model import evaluating_performance_and_save_tsne_plot
+
+    torch.set_num_threads(num_threads)
+    name = os.path.splitext(ckpt_path)[0]
+    try:
+        # renamed once complete, a .ckpt is never read half written
+        tmp_path = '{}.{}.tmp'.format(ckpt_path, os.getpid())
+        torch.save(checkpoint, tmp_path)
+        os.replace(tmp_path, ckpt_path)
+        torch.save(checkpoint['state_dict'], name + '.pth')
+        save_flat_weights(checkpoint['state_dict'], name + '.weights', metadata={'epoch': checkpoint['epoch'],
+                          'metric': checkpoint.get('hyper_parameters', {}).get('metric', 'l2')})
+
+        accuracy, metrics, memory = None, None, {}
+        if plot_name is not None:
+            model = model_cls.load_from_checkpoint(checkpoint_path=ckpt_path)
+            monitor = _memory_monitor()
+            accuracy, metrics = evaluating_performance_and_save_tsne_plot(model, datamodule=datamodule, plot_name=plot_name,
+                                                                          monitor=monitor, return_metrics=True)
+            if monitor is not None:
+                monitor.stop()
+                print(monitor.format_stages())
+                memory = monitor.stages
+        results.put({'checkpoint': ckpt_path, 'step': checkpoint['global_step'], 'accuracy': accuracy, 'metrics': metrics, 'memory': memory})
+    except Exception:
+        results.put({'checkpoint': ckpt_path, 'step': checkpoint['global_step'], 'error': traceback.format_exc()})
+
+class BackgroundEvaluator:
+    """
+        Save checkpoints and run the post-fit evaluation in separate processes on a snapshot of the weights,
+        so the next training phase does not wait for them. Results are logged on `logger` as 'eval/accuracy',
+        with the retrieval metrics (recall@k, mAP, per-class precision/recall, confusion matrix, see libs.Evaluation)
+        when they arrive (see collect and join), with the memory peaks of the evaluation stages if psutil is installed.
+        Each process uses `num_threads` torch threads, keep it low so the evaluation does not starve training.
+    """
+    def __init__(self, logger=None, num_threads=2):
+        self.logger = logger
+        self.num_threads = num_threads
+        self._ctx = mp.get_context('spawn')
+        self._results = self._ctx.Queue()
+        self._processes = []
+
+    def submit(self, trainer, datamodule, ckpt_path, plot_name=None):
+        """
+            Take a cpu snapshot of the checkpoint of the trainer (snapshot_checkpoint, to be called on every rank)
+            and start a process on rank 0 that writes it in ckpt_path, .pth and .weights next to it and, if plot_name
+            is given, evaluates the model on datamodule and saves the t-SNE plot. Only the copy to cpu blocks training
+        """
+        checkpoint = snapshot_checkpoint(trainer)
+        if not trainer.is_global_zero:
+            return None
+
+        # the datamodule is sent without the reference to the trainer, which is not picklable
+        datamodule = copy.copy(datamodule)
+        datamodule.trainer = None
+
+        process = self._ctx.Process(target=_checkpoint_and_evaluate,
+                                    args=(type(trainer.lightning_module), datamodule, checkpoint, ckpt_path,
+                                            plot_name, self.num_threads, self._results),
+                                    name="evaluate-{}".format(os.path.basename(ckpt_path)))
+        process.start()
+        self._processes.append(process)
+        self.collect()
+        return process
+
+    def collect(self, block=False):
+        """
+            Log the results of the finished processes. With block=True wait for at least one result
+        """
+        results = []
+        while True:
+            try:
+                results.append(self._results.get(block=block and not results))
+            except queue.Empty:
+                break
+
+        for result in results:
+            if 'error' in result:
+                print('Background evaluation of {} failed:\n{}'.format(result['checkpoint'], result['error']))
+                continue
+            if result['accuracy'] is not None:
+                print('Classification error {} ({})'.format(result['accuracy'], result['checkpoint']))
+                if self.logger is not None:
+                    metrics = {'eval/accuracy': result['accuracy']}
+                    for stage, peaks in result.get('memory', {}).items():
+                        metrics['memory/eval_{}_peak_mb'.format(stage)] = peaks['main_rss'] / 2**20
+                        metrics['memory/eval_{}_increase_mb'.format(stage)] = peaks['main_rss_increase'] / 2**20
+                        if 'main_heap' in peaks:
+                            metrics['memory/eval_{}_heap_peak_mb'.format(stage)] = peaks['main_heap'] / 2**20
+                    self.logger.log_metrics(metrics, step=result['step'])
+                    if result.get('metrics') is not None:
+                        log_retrieval_metrics(self.logger, result['metrics'], step=result['step'])
+
+        self._processes = [p for p in self._processes if p.is_alive()]
+        return results
+
+    def join(self):
+        """
+            Wait for all the background processes and log their results
+        """
+        results = []
+        while self._processes:
+            results += self.collect()
+            self._processes[0].join(timeout=1)
+        results += self.collect()
+        if self.logger is not None:
+            self.logger.save()
+        return results
+
+def available_cpus():
+    """
+        Number of cores this process may run on (affinity aware)
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
+
+def cpu_split_per_rank(processes_per_node, cpus=None):
+    """
+        Split the cores of a node between the ranks running on it. Returns (torch threads, dataloader workers)
+        for each rank: about a quarter of the cores of a rank decode images, the others run forward/backward
+    """
+    cpus_per_rank = max(1, (cpus or available_cpus()) // processes_per_node)
+    workers = min(8, cpus_per_rank // 4)
+    return max(1, cpus_per_rank - workers), workers
+
+class CPUThreadsCallback(pl.Callback):
+    """
+        Set the number of torch intra-op threads in every rank, so that the ranks sharing a node do not oversubscribe it
+    """
+    def __init__(self, num_threads):
+        super().__init__()
+        self.num_threads = num_threads
+
+    def setup(self, trainer, pl_module, stage=None):
+        torch.set_num_threads(self.num_threads)
+
+def ddp_cpu_trainer_kwargs(processes_per_node, num_nodes=1):
+    """
+        pl.Trainer arguments for data-parallel training on cpu with the gloo backend.
+        The distributed samplers are created by TripletTrashbinDataModule, so Lightning must not replace them.
+        Multi-node runs need MASTER_ADDR, MASTER_PORT and NODE_RANK in the environment of every node.
+        Add CPUThreadsCallback(cpu_split_per_rank(processes_per_node)[0]) to the callbacks of the trainer
+    """
+    return dict(accelerator="cpu",
+                devices=processes_per_node,
+                num_nodes=num_nodes,
+                strategy=DDPStrategy(process_group_backend="gloo", find_unused_parameters=False),
+                replace_sampler_ddp=False)
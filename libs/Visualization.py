@@ -0,0 +1,140 @@
+import hashlib
+import numpy as np
+from os.path import exists
+from libs.Inference import extract_representation
+
+# matplotlib and sklearn are imported only when a projection or a plot is requested.
+# Plots are drawn on an Agg canvas, so they never need a display and never block on plt.show().
+
+def stratified_sample(labels, n_samples=10000, seed=0):
+    """
+        Select n_samples indices without replacement, keeping the proportion of every class.
+        All the indices are returned if there are less than n_samples elements
+    """
+    labels = np.asarray(labels)
+    if n_samples >= len(labels):
+        return np.arange(len(labels))
+
+    rng = np.random.default_rng(seed)
+    classes, counts = np.unique(labels, return_counts=True)
+    quotas = np.floor(counts / len(labels) * n_samples).astype(int)
+    # the samples lost by the rounding go to the classes with the largest remainder
+    remainders = counts / len(labels) * n_samples - quotas
+    quotas[np.argsort(-remainders)[:n_samples - quotas.sum()]] += 1
+
+    selected = [rng.choice(np.flatnonzero(labels == c), size=min(q, n), replace=False)
+                    for c, q, n in zip(classes, quotas, counts)]
+    return np.sort(np.concatenate(selected))
+
+def _fingerprint(rep, selected, n_samples, pca_dim, seed):
+    h = hashlib.sha1()
+    h.update(np.asarray(rep.shape).tobytes())
+    h.update(np.ascontiguousarray(rep[selected[:64]]).tobytes())
+    h.update(np.asarray([n_samples, pca_dim, seed]).tobytes())
+    return h.hexdigest()
+
+def tsne_projection(rep, labels, n_samples=10000, pca_dim=50, n_jobs=-1, seed=0, cache_path=None):
+    """
+        2-D projection of the representations used for the plots:
+        stratified sampling without replacement, PCA pre-reduction to pca_dim dimensions
+        and multi-threaded Barnes-Hut t-SNE.
+        If cache_path is given the projection is stored there (.npz) and reused while the
+        representations and the parameters do not change.
+
+        t-SNE is a tool to visualize high-dimensional data.
+        It converts similarities between data points to joint probabilities and
+        tries to minimize the Kullback-Leibler divergence between the joint probabilities
+        of the low-dimensional embedding and the high-dimensional data.
+        more here https://scikit-learn.org/stable/modules/generated/sklearn.manifold.TSNE.html
+    """
+    selected = stratified_sample(labels, n_samples, seed)
+    fingerprint = _fingerprint(rep, selected, n_samples, pca_dim, seed)
+
+    if cache_path is not None and exists(cache_path):
+        with np.load(cache_path) as cached:
+            if str(cached['fingerprint']) == fingerprint:
+                return cached['projection'], cached['labels']
+
+    from sklearn.decomposition import PCA
+    from sklearn.manifold import TSNE
+
+    selected_rep = rep[selected].astype(np.float32, copy=False)
+    selected_labels = np.asarray(labels)[selected]
+
+    n_components = min(pca_dim, *selected_rep.shape)
+    if n_components < selected_rep.shape[1]:
+        selected_rep = PCA(n_components=n_components, svd_solver='randomized', random_state=seed).fit_transform(selected_rep)
+
+    tsne = TSNE(2, method='barnes_hut', init='pca', learning_rate='auto', n_jobs=n_jobs, random_state=seed)
+    projection = tsne.fit_transform(selected_rep)
+
+    if cache_path is not None:
+        # np.savez appends .npz to paths without it, write on the final name so the cache is found again
+        with open(cache_path, 'wb') as f:
+            np.savez(f, projection=projection, labels=selected_labels, fingerprint=fingerprint)
+
+    return projection, selected_labels
+
+def plot_projection(projection, labels, plot_path=None):
+    """
+        Scatter plot of a 2-D projection, one color for each class. The figure is returned
+        and, if plot_path is given, saved there
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=(8,6))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    for c in np.unique(labels):
+        ax.plot(projection[labels==c, 0], projection[labels==c, 1], 'o', label=c)
+    ax.legend()
+
+    if plot_path is not None:
+        fig.savefig(plot_path)
+    return fig
+
+def plot_tsne(test_rep, test_labels, plot_path=None, cache_path=None):
+    """
+        Plot the t-SNE projection of the representations (see tsne_projection)
+    """
+    projection, labels = tsne_projection(test_rep, test_labels, cache_path=cache_path)
+    return plot_projection(projection, labels, plot_path)
+
+def plot_values_tsne(embedding_net, test_loader):
+    """
+        Extract representation from test dataloader and plot the t-SNE projection of
+        10000 of them using matplotlib
+    """
+    test_rep, test_labels = extract_representation(embedding_net, test_loader)
+    return plot_tsne(test_rep, test_labels)
+
+def plot_confusion_matrix(confusion, class_names=None, plot_path=None):
+    """
+        Confusion matrix (rows: ground truth, columns: prediction) with the counts in the cells.
+        The figure is returned and, if plot_path is given, saved there
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    confusion = np.asarray(confusion)
+    class_names = class_names or [str(c) for c in range(len(confusion))]
+    fig = Figure(figsize=(6,5))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    image = ax.imshow(confusion, cmap='Blues')
+    fig.colorbar(image, ax=ax)
+    ax.set_xticks(range(len(class_names)))
+    ax.set_xticklabels(class_names)
+    ax.set_yticks(range(len(class_names)))
+    ax.set_yticklabels(class_names)
+    ax.set_xlabel('predicted')
+    ax.set_ylabel('ground truth')
+    for i in range(len(confusion)):
+        for j in range(len(confusion)):
+            ax.text(j, i, int(confusion[i, j]), ha='center', va='center',
+                    color='white' if confusion[i, j] > confusion.max() / 2 else 'black')
+
+    if plot_path is not None:
+        fig.savefig(plot_path)
+    return fig
@@ -0,0 +1,123 @@
+import json
+import os
+import struct
+import numpy as np
+import torch
+from torch import nn
+
+# Flat weight format (.weights):
+#   8 bytes   little-endian uint64 with the length N of the header
+#   N bytes   JSON header {name: {"dtype", "shape", "offset", "nbytes"}, "__metadata__": {...}}
+#   ...       raw tensor data, every tensor aligned to ALIGNMENT bytes from the start of the data section
+# The data section is memory mapped on load, so the tensors are views on the page cache:
+# several processes loading the same file share one copy of the weights and nothing is deserialized.
+
+ALIGNMENT = 64
+WEIGHTS_EXT = '.weights'
+
+# numpy has no bfloat16, it is stored as raw 16 bit words and viewed back by torch
+_TORCH_TO_NUMPY = {
+    torch.float32: np.float32,
+    torch.float64: np.float64,
+    torch.float16: np.float16,
+    torch.bfloat16: np.uint16,
+    torch.int64: np.int64,
+    torch.int32: np.int32,
+    torch.int16: np.int16,
+    torch.int8: np.int8,
+    torch.uint8: np.uint8,
+    torch.bool: np.bool_,
+}
+_DTYPE_NAMES = {dtype: str(dtype).replace('torch.', '') for dtype in _TORCH_TO_NUMPY}
+_NAMES_TO_DTYPE = {name: dtype for dtype, name in _DTYPE_NAMES.items()}
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def save_flat_weights(state_dict, path, metadata=None):
+    """
+        Save a state_dict in the flat .weights format. The file is written on a temporary path
+        and then renamed, so readers never see a partially written file
+    """
+    header, offset, arrays = {}, 0, []
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().to('cpu').contiguous()
+        array = tensor.view(torch.int16).numpy().view(np.uint16) if tensor.dtype == torch.bfloat16 else tensor.numpy()
+        header[name] = {"dtype": _DTYPE_NAMES[tensor.dtype], "shape": list(tensor.shape),
+                        "offset": offset, "nbytes": array.nbytes}
+        arrays.append((offset, array))
+        offset = _aligned(offset + array.nbytes)
+    header["__metadata__"] = {str(k): str(v) for k, v in (metadata or {}).items()}
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    # pad the header so that the data section starts aligned
+    header_bytes += b' ' * (_aligned(8 + len(header_bytes)) - 8 - len(header_bytes))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        data_start = f.tell()
+        for tensor_offset, array in arrays:
+            f.seek(data_start + tensor_offset)
+            f.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+def read_flat_header(path):
+    """
+        Returns the header of a .weights file and the offset of its data section
+    """
+    with open(path, 'rb') as f:
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_len))
+    return header, 8 + header_len
+
+def load_flat_weights(path):
+    """
+        Load a .weights file as a state_dict whose tensors are zero-copy views on a memory map of the file.
+        The map is copy-on-write: pages are shared between processes until a tensor is modified in place
+    """
+    header, data_start = read_flat_header(path)
+    metadata = header.pop("__metadata__", {})
+    mm = np.memmap(path, dtype=np.uint8, mode='c')
+
+    state_dict = {}
+    for name, entry in header.items():
+        dtype = _NAMES_TO_DTYPE[entry["dtype"]]
+        start = data_start + entry["offset"]
+        array = mm[start:start + entry["nbytes"]].view(_TORCH_TO_NUMPY[dtype]).reshape(entry["shape"])
+        tensor = torch.from_numpy(array)
+        state_dict[name] = tensor.view(torch.bfloat16) if dtype == torch.bfloat16 else tensor
+
+    return state_dict, metadata
+
+def assign_state_dict(module, state_dict):
+    """
+        Use the tensors of state_dict as parameters and buffers of module without copying them,
+        unlike nn.Module.load_state_dict. Parameters are frozen since they are shared read-mostly memory
+    """
+    expected = set(module.state_dict().keys())
+    missing, unexpected = expected - set(state_dict), set(state_dict) - expected
+    if missing or unexpected:
+        raise RuntimeError("Error(s) in assigning state_dict: missing keys {}, unexpected keys {}".format(sorted(missing), sorted(unexpected)))
+
+    for name, tensor in state_dict.items():
+        module_path, _, attr = name.rpartition('.')
+        owner = module.get_submodule(module_path) if module_path else module
+        if attr in owner._parameters:
+            owner._parameters[attr] = nn.Parameter(tensor, requires_grad=False)
+        else:
+            owner._buffers[attr] = tensor
+    return module
+
+def convert_to_flat_weights(src_path, dst_path):
+    """
+        Convert a Lightning .ckpt or a torch.save state_dict (.pth) to the flat .weights format
+    """
+    checkpoint = torch.load(src_path, map_location='cpu')
+    metadata = {}
+    if 'state_dict' in checkpoint:
+        metadata = {k: checkpoint[k] for k in ('epoch', 'global_step') if k in checkpoint}
+        metadata['metric'] = checkpoint.get('hyper_parameters', {}).get('metric', 'l2')
+        checkpoint = checkpoint['state_dict']
+    save_flat_weights(checkpoint, dst_path, metadata=metadata)
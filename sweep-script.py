@@ -0,0 +1,199 @@
+import argparse
+import json
+import math
+import os
+import sys
+import time
+import traceback
+from collections import deque
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+from os.path import join
+
+# Hyperparameter sweep of TripletNetwork (lr, momentum, margin) on one CPU host: N trials run at the same time,
+# each in its own process pinned to its own cores, all reading the training images from one shared uint8 image
+# cache (libs.ImageCache) decoded once. After every validation epoch a trial reports its loss to this process,
+# which stops it when its best loss is worse than the median of the other trials at the same epoch.
+
+def sample_trials(args):
+    """
+        Random search: lr log-uniform, momentum and margin uniform in their ranges (a single value is fixed)
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(args.seed)
+
+    def uniform(bounds, log=False):
+        low, high = bounds[0], bounds[-1]
+        if log:
+            return float(math.exp(rng.uniform(math.log(low), math.log(high))))
+        return float(rng.uniform(low, high))
+
+    return [{'id': i, 'lr': uniform(args.lr, log=True), 'momentum': uniform(args.momentum), 'margin': uniform(args.margin)}
+            for i in range(args.trials)]
+
+def core_slots(concurrent, cores_per_trial=None):
+    """
+        Disjoint sets of cores of this process, one for every concurrent trial
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+    cores_per_trial = cores_per_trial or max(1, len(cores) // concurrent)
+    if cores_per_trial * concurrent > len(cores):
+        sys.exit("{} trials x {} cores do not fit in the {} cores available".format(concurrent, cores_per_trial, len(cores)))
+    return [cores[i * cores_per_trial:(i + 1) * cores_per_trial] for i in range(concurrent)]
+
+def median_stop(history, trial_id, grace_epochs, min_trials):
+    """
+        True when the best loss of the trial at its last epoch is worse than the median of the best losses
+        of the other trials at the same epoch (at least min_trials of them, after grace_epochs epochs)
+    """
+    import numpy as np
+
+    epoch = len(history[trial_id]) - 1
+    if epoch < grace_epochs:
+        return False
+    others = [losses[epoch] for other, losses in history.items() if other != trial_id and len(losses) > epoch]
+    return len(others) >= min_trials and history[trial_id][epoch] > np.median(others)
+
+def run_trial(trial, cores, conn, args):
+    """
+        Body of a trial process: train on `cores` only and exchange the validation losses with the sweep process
+    """
+    # pinned before torch starts its thread pools, the dataloader workers inherit the affinity
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    import torch
+
+    torch.set_num_threads(len(cores))
+    torch.set_num_interop_threads(1)
+    import pytorch_lightning as pl
+    from torch import nn
+    from pytorch_lightning.loggers import TensorBoardLogger
+    from libs.Callbacks import ValidationReportCallback
+    from libs.Dataset import TripletTrashbinDataModule
+    from libs.Model import TripletNetwork
+
+    def report(epoch, loss):
+        conn.send(('report', epoch, loss))
+        return conn.recv()
+
+    start = time.perf_counter()
+    try:
+        pl.seed_everything(args['seed'], workers=True)
+        # the corpus was checked once by prepare, the trials only read its manifest
+        dm = TripletTrashbinDataModule(img_size=args['img_size'], batch_size=args['batch_size'], num_workers=args['workers_per_trial'],
+                                       dst_main_path=args['data_dir'], image_cache=args['cache_dir'], validate_images=False)
+        hparams = dict(lr=trial['lr'], momentum=trial['momentum'], criterion=nn.TripletMarginLoss(margin=trial['margin']))
+        if args['checkpoint']:
+            model = TripletNetwork.load_from_checkpoint(checkpoint_path=args['checkpoint'], **hparams)
+        else:
+            model = TripletNetwork(batch_size=args['batch_size'], pretrained=args['pretrained'], **hparams)
+
+        callback = ValidationReportCallback(report)
+        trainer = pl.Trainer(max_epochs=args['epochs'], accelerator="cpu", devices=1, enable_checkpointing=False,
+                             enable_progress_bar=False, enable_model_summary=False, num_sanity_val_steps=0,
+                             limit_train_batches=args['limit_train_batches'], limit_val_batches=args['limit_val_batches'],
+                             logger=TensorBoardLogger(args['log_dir'], name=args['name'], version='trial_{:03d}'.format(trial['id'])),
+                             callbacks=[callback])
+        trainer.fit(model, datamodule=dm)
+        conn.send(('done', {'status': 'stopped' if callback.stopped else 'completed', 'epochs': len(callback.losses),
+                            'best_valid_loss': min(callback.losses) if callback.losses else None,
+                            'valid_losses': callback.losses, 'seconds': time.perf_counter() - start}))
+    except Exception:
+        conn.send(('done', {'status': 'failed', 'error': traceback.format_exc(), 'seconds': time.perf_counter() - start}))
+    finally:
+        conn.close()
+
+def prepare(args):
+    """
+        Validate the corpus and build the shared image cache once, with all the cores, before the trials start
+    """
+    from libs.Dataset import TripletTrashbinDataModule
+    from libs.Inference import build_embedding_net
+
+    # same datamodule arguments of the trials, so the cache holds the images their transforms would produce
+    dm = TripletTrashbinDataModule(img_size=args.img_size, dst_main_path=args.data_dir, decoders=args.decoders, image_cache=args.cache_dir)
+    dm.prepare_data()
+    dm.build_image_cache()
+    if args.pretrained and not args.checkpoint:
+        # downloaded once in the torch hub cache instead of by every trial
+        build_embedding_net(pretrained=True)
+
+def sweep(args):
+    prepare(args)
+    trials = deque(sample_trials(args))
+    free_slots = core_slots(args.concurrent, args.cores_per_trial)
+    context = get_context('spawn')
+    running, history, results = {}, {}, []
+    print("{} trials, {} at a time on cores {}".format(len(trials), args.concurrent, free_slots))
+
+    with open(args.output, 'w') as output:
+        while trials or running:
+            while trials and free_slots:
+                trial, cores = trials.popleft(), free_slots.pop(0)
+                conn, child_conn = context.Pipe()
+                process = context.Process(target=run_trial, args=(trial, cores, child_conn, vars(args)))
+                process.start()
+                child_conn.close()
+                running[conn] = (trial, process, cores)
+                history[trial['id']] = []
+
+            for conn in wait(list(running)):
+                trial, process, cores = running[conn]
+                try:
+                    message = conn.recv()
+                except EOFError:
+                    message = ('done', {'status': 'failed', 'error': 'the trial process exited without a result'})
+
+                if message[0] == 'report':
+                    losses = history[trial['id']]
+                    losses.append(min(message[2], losses[-1]) if losses else message[2])
+                    conn.send(not median_stop(history, trial['id'], args.grace_epochs, args.min_trials))
+                    continue
+
+                process.join()
+                conn.close()
+                del running[conn]
+                free_slots.append(cores)
+                result = dict(trial, **message[1])
+                results.append(result)
+                output.write(json.dumps(result) + '\n')
+                output.flush()
+                print("trial {id:3d} lr {lr:.3g} momentum {momentum:.3f} margin {margin:.2f}: {status}".format(**result),
+                      "best valid loss {:.4f} after {} epochs".format(result['best_valid_loss'], result['epochs'])
+                      if result.get('best_valid_loss') is not None else "")
+
+    ranked = sorted((r for r in results if r.get('best_valid_loss') is not None), key=lambda r: r['best_valid_loss'])
+    if ranked:
+        print("best: lr {lr:.3g} momentum {momentum:.3f} margin {margin:.2f}, valid loss {best_valid_loss:.4f}".format(**ranked[0]))
+    print("results written to {}".format(args.output))
+    return results
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Parallel hyperparameter sweep of TripletNetwork with median early stopping")
+    parser.add_argument("--trials", type=int, default=8)
+    parser.add_argument("--concurrent", type=int, default=2, help="trials running at the same time")
+    parser.add_argument("--cores-per-trial", type=int, default=None, help="all the cores split between the concurrent trials by default")
+    parser.add_argument("--workers-per-trial", type=int, default=0, help="dataloader workers of every trial, on the cores of the trial")
+    parser.add_argument("--lr", type=float, nargs="+", default=[1e-8, 1e-5], help="range, sampled log-uniform")
+    parser.add_argument("--momentum", type=float, nargs="+", default=[0.9, 0.99])
+    parser.add_argument("--margin", type=float, nargs="+", default=[0.5, 2.0])
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--grace-epochs", type=int, default=1, help="epochs before a trial can be stopped")
+    parser.add_argument("--min-trials", type=int, default=2, help="other trials needed at an epoch to stop one")
+    parser.add_argument("--limit-train-batches", type=float, default=1.0)
+    parser.add_argument("--limit-val-batches", type=float, default=1.0)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--img-size", type=int, default=224)
+    parser.add_argument("--data-dir", default="dataset")
+    parser.add_argument("--cache-dir", default=join("dataset", "image_cache"))
+    parser.add_argument("--decoders", default=None, help="decoder preferences, e.g. decoders.json of benchmark-script.py decoders")
+    parser.add_argument("--checkpoint", default=None, help="start every trial from these weights")
+    parser.add_argument("--pretrained", action="store_true", help="ImageNet weights when no checkpoint is given")
+    parser.add_argument("--log-dir", default="logs")
+    parser.add_argument("--name", default="sweep")
+    parser.add_argument("--output", default="sweep_results.jsonl")
+    parser.add_argument("--seed", type=int, default=0)
+
+    sweep(parser.parse_args())
@@ -1,5 +1,8 @@
 from libs.Dataset import TripletTrashbinDataModule
-from libs.Model import TripletNetwork, TripletNetworkV2, evaluating_performance_and_save_tsne_plot, evaluating_performance_only
+from libs.Model import TripletNetwork, TripletNetworkV2, triplet_criterion, evaluating_performance_and_save_tsne_plot, evaluating_performance_only
+from libs.Training import BackgroundEvaluator, CPUThreadsCallback, cpu_split_per_rank, ddp_cpu_trainer_kwargs
+from libs.Callbacks import EmbeddingProjectorCallback, HardNegativeMiningCallback, MemoryCallback, ResumableSamplerCallback, StageTimingCallback
+from libs.FeatureCache import build_feature_cache
 from torchvision.models import squeezenet1_1
 import torch
 from torch import nn
@@ -12,7 +15,7 @@ from typing import Optional
 from torch.utils.data import DataLoader
 from torch.nn import ModuleList
 from pytorch_lightning.loggers import TensorBoardLogger
-from pytorch_lightning.callbacks import progress
+from pytorch_lightning.callbacks import progress, ModelCheckpoint
 from pytorch_lightning.utilities.warnings import PossibleUserWarning
 import numpy as np
 import matplotlib.pyplot as plt
@@ -36,19 +39,55 @@ if __name__ == "__main__":
     DATA_BATCH_SIZE = 256
     N_WORKERS = 0  # os.cpu_count() , if != 0 return warning
     GPUS = 0
+    N_PROCESSES = 1 # > 1 to train with DDP on cpu (gloo), one process for each group of cores
+    NUM_NODES = 1
     LR = 7.585775750291837e-08
     MAX_EPOCHS = 31
     LOGS_FOLDER = "logs"
     MAIN_MODELS_FOLDER = "models"
     CKPT_LAST_PATH = "TripletMarginLoss-epoch-60.ckpt"
+    FROZEN_FIRE = 0 # > 0 trains only the layers after the first FROZEN_FIRE Fire modules, on their cached activations
+    FEATURE_CACHE_FOLDER = join("dataset", "feature_cache")
+    PROFILE_STAGES = False # per-stage timings of the training loop on TensorBoard and summary at the end of fit
+    PROFILE_MEMORY = False # per-step RSS of main process and workers logged with the loss
+    PK_BATCH = None # (P, K): training batches of K triplets for each of P anchor classes, e.g. (3, 10)
+    BATCH_HARD = False # batch-hard loss on the in-batch triplets of all the embeddings of the batch, best with PK_BATCH
+    MEMORY_BANK_SIZE = 0 # > 0 draws harder negatives from a FIFO of the last N anchor embeddings (~338 MB per 1000 in float32)
+    HARD_NEGATIVE_MINING = False # replace the random negatives with mined hard negatives after every epoch
+    METRIC = "l2" # "cosine" trains normalized embeddings searched by inner product (criterion margin 0.5, see triplet_criterion)
+    DECODERS = None # image decoding backends by file type, e.g. "decoders.json" written by `benchmark-script.py decoders`
+    UINT8_TRANSPORT = False # workers send uint8 images, normalized by the model (a quarter of the bytes through shared memory)
+    CKPT_EVERY_N_STEPS = 0 # > 0 saves a mid-epoch checkpoint (last.ckpt) every N steps, fit(ckpt_path=...) resumes at the next batch
+
+    TRAINER_KWARGS = dict(gpus=GPUS, accelerator="auto")
+    CALLBACKS = [ResumableSamplerCallback()]
+    if N_PROCESSES * NUM_NODES > 1:
+        N_THREADS, N_WORKERS = cpu_split_per_rank(N_PROCESSES)
+        TRAINER_KWARGS = ddp_cpu_trainer_kwargs(N_PROCESSES, NUM_NODES)
+        CALLBACKS.append(CPUThreadsCallback(N_THREADS))
+    if PROFILE_STAGES:
+        CALLBACKS.append(StageTimingCallback())
+    if PROFILE_MEMORY:
+        CALLBACKS.append(MemoryCallback())
+    if HARD_NEGATIVE_MINING:
+        CALLBACKS.append(HardNegativeMiningCallback())
+    if CKPT_EVERY_N_STEPS > 0:
+        CALLBACKS.append(ModelCheckpoint(dirpath=MAIN_MODELS_FOLDER, every_n_train_steps=CKPT_EVERY_N_STEPS, save_last=True))
     
-    dm = TripletTrashbinDataModule(img_size=DATA_IMG_SIZE,num_workers=N_WORKERS)
+    PK_KWARGS = dict(classes_per_batch=PK_BATCH[0], samples_per_class=PK_BATCH[1]) if PK_BATCH is not None else {}
+    # every load of the checkpoint gets them, the criterion saved in it follows the metric
+    MODEL_KWARGS = dict(memory_bank_size=MEMORY_BANK_SIZE, metric=METRIC, criterion=triplet_criterion(METRIC), batch_hard=BATCH_HARD)
+
+    dm = TripletTrashbinDataModule(img_size=DATA_IMG_SIZE,num_workers=N_WORKERS, **PK_KWARGS, decoders=DECODERS, uint8_transport=UINT8_TRANSPORT)
+    dm.prepare_data()
     dm.setup()
 
-    dm_v2 = TripletTrashbinDataModule(img_size=DATA_IMG_SIZE,num_workers=N_WORKERS, trb_train_csv="triplet_training_v2.csv", trb_val_csv="triplet_validation_v2.csv", trb_test_csv="triplet_test_v2.csv")
+    dm_v2 = TripletTrashbinDataModule(img_size=DATA_IMG_SIZE,num_workers=N_WORKERS, **PK_KWARGS, decoders=DECODERS, uint8_transport=UINT8_TRANSPORT, trb_train_csv="triplet_training_v2.csv", trb_val_csv="triplet_validation_v2.csv", trb_test_csv="triplet_test_v2.csv")
+    dm_v2.prepare_data()
     dm_v2.setup()
 
-    dm_v3 = TripletTrashbinDataModule(img_size=DATA_IMG_SIZE,num_workers=N_WORKERS, trb_train_csv="triplet_training_v3.csv", trb_val_csv="triplet_validation_v3.csv", trb_test_csv="triplet_test_v3.csv")
+    dm_v3 = TripletTrashbinDataModule(img_size=DATA_IMG_SIZE,num_workers=N_WORKERS, **PK_KWARGS, decoders=DECODERS, uint8_transport=UINT8_TRANSPORT, trb_train_csv="triplet_training_v3.csv", trb_val_csv="triplet_validation_v3.csv", trb_test_csv="triplet_test_v3.csv")
+    dm_v3.prepare_data()
     dm_v3.setup()
 
 
@@ -57,38 +96,50 @@ if __name__ == "__main__":
     # tripletNetwork_tml = TripletNetwork()
 
     # Ho già allenato la rete con il dataset di default per 30 epoche, quindi carico il da .ckpt
-    tripletNetwork_tml = TripletNetwork.load_from_checkpoint(checkpoint_path=join(MAIN_MODELS_FOLDER, CKPT_LAST_PATH)) 
+    tripletNetwork_tml = TripletNetwork.load_from_checkpoint(checkpoint_path=join(MAIN_MODELS_FOLDER, CKPT_LAST_PATH), **MODEL_KWARGS)
+
+    if FROZEN_FIRE > 0:
+        # the activations of the frozen layers are computed once for every image, without data augmentation
+        tripletNetwork_tml = TripletNetwork.load_from_checkpoint(checkpoint_path=join(MAIN_MODELS_FOLDER, CKPT_LAST_PATH),
+                                                                    frozen_fire=FROZEN_FIRE, cached_features=True, **MODEL_KWARGS)
+        build_feature_cache(tripletNetwork_tml.frozen_prefix(), dm_v2.image_paths() + dm_v3.image_paths(),
+                            dm_v2.test_transform, FEATURE_CACHE_FOLDER, num_workers=N_WORKERS, decoder=dm_v2.decoder)
+        for datamodule in (dm_v2, dm_v3):
+            datamodule.feature_cache = FEATURE_CACHE_FOLDER
+            datamodule.setup()
 
     logger_tml = TensorBoardLogger(join(MAIN_MODELS_FOLDER, LOGS_FOLDER), name="TripletMarginLoss")
+    evaluator = BackgroundEvaluator(logger=logger_tml)
 
     MAX_EPOCHS = MAX_EPOCHS + 15 # 46
 
-    trainer1 = pl.Trainer(gpus=GPUS,
+    trainer1 = pl.Trainer(
                         max_epochs=MAX_EPOCHS,
-                        callbacks=[progress.TQDMProgressBar()],
+                        callbacks=[progress.TQDMProgressBar(), EmbeddingProjectorCallback(every_n_epochs=5)] + CALLBACKS,
                         logger=logger_tml,
-                        accelerator="auto",
+                        **TRAINER_KWARGS,
                         )
 
     # effettuo il fit ma con una versione del dataset diversa dalla precedente
     trainer1.fit(model=tripletNetwork_tml, datamodule=dm_v2, ckpt_path=join(MAIN_MODELS_FOLDER, CKPT_LAST_PATH))
-    trainer1.save_checkpoint(join(MAIN_MODELS_FOLDER, 'TripletMarginLoss-epoch-{}.ckpt'.format(MAX_EPOCHS - 1)))
-    torch.save(trainer1.model.state_dict(), join(MAIN_MODELS_FOLDER,'TripletMarginLoss-epoch-{}.pth'.format(MAX_EPOCHS - 1)))
-    evaluating_performance_and_save_tsne_plot(tripletNetwork_tml, datamodule=dm_v2, plot_name='TripletMarginLoss-epoch-{}-TSNE'.format(MAX_EPOCHS - 1))
+    # the checkpoint is saved here, .pth, .weights and the evaluation run in background while the next phase is training
+    evaluator.submit(trainer1, dm_v2, ckpt_path=join(MAIN_MODELS_FOLDER, 'TripletMarginLoss-epoch-{}.ckpt'.format(MAX_EPOCHS - 1)),
+                            plot_name='TripletMarginLoss-epoch-{}-TSNE'.format(MAX_EPOCHS - 1))
 
     MAX_EPOCHS = MAX_EPOCHS + 15 # 61
-    trainer2 = pl.Trainer(gpus=GPUS,
+    trainer2 = pl.Trainer(
                     max_epochs=MAX_EPOCHS,
-                    callbacks=[progress.TQDMProgressBar()],
+                    callbacks=[progress.TQDMProgressBar(), EmbeddingProjectorCallback(every_n_epochs=5)] + CALLBACKS,
                     logger=logger_tml,
-                    accelerator="auto",
+                    **TRAINER_KWARGS,
                     )
 
     # effettuo il fit ma con una versione del dataset diversa dalla precedente
     trainer2.fit(model=tripletNetwork_tml, datamodule=dm_v3, ckpt_path=join(MAIN_MODELS_FOLDER, CKPT_LAST_PATH))
-    trainer2.save_checkpoint(join(MAIN_MODELS_FOLDER, 'TripletMarginLoss-epoch-{}.ckpt'.format(MAX_EPOCHS - 1)))
-    torch.save(trainer2.model.state_dict(), join(MAIN_MODELS_FOLDER,'TripletMarginLoss-epoch-{}.pth'.format(MAX_EPOCHS - 1)))
-    evaluating_performance_and_save_tsne_plot(tripletNetwork_tml, datamodule=dm_v3, plot_name='TripletMarginLoss-epoch-{}-TSNE-AAAAA'.format(MAX_EPOCHS - 1))
+    evaluator.submit(trainer2, dm_v3, ckpt_path=join(MAIN_MODELS_FOLDER, 'TripletMarginLoss-epoch-{}.ckpt'.format(MAX_EPOCHS - 1)),
+                            plot_name='TripletMarginLoss-epoch-{}-TSNE-AAAAA'.format(MAX_EPOCHS - 1))
+
+    evaluator.join()
 
     # ---- Training Triplet Network with Triplet Margin with Distance Loss --------
 
@@ -99,15 +150,14 @@ if __name__ == "__main__":
 
     # logger_tml = TensorBoardLogger(join(MAIN_MODELS_FOLDER, LOGS_FOLDER), name="TripletMarginWithDistanceLoss")
 
-    # trainer1 = pl.Trainer(gpus=GPUS,
+    # trainer1 = pl.Trainer(
     #                     max_epochs=MAX_EPOCHS,
-    #                     callbacks=[progress.TQDMProgressBar()],
+    #                     callbacks=[progress.TQDMProgressBar(), EmbeddingProjectorCallback(every_n_epochs=5)] + CALLBACKS,
     #                     logger=logger_tml,
-    #                     accelerator="auto",
+    #                     **TRAINER_KWARGS,
     #                     )
 
     # trainer1.fit(model=tripletNetwork_tmwdl, datamodule=dm, ckpt_path=join(MAIN_MODELS_FOLDER, CKPT_LAST_PATH))
-    # trainer1.save_checkpoint(join(MAIN_MODELS_FOLDER, 'TripletMarginWithDistanceLoss-epoch-{}.ckpt'.format(MAX_EPOCHS - 1)))
-    # torch.save(trainer1.model.state_dict(), join(MAIN_MODELS_FOLDER,'TripletMarginWithDistanceLoss-epoch-{}.pth'.format(MAX_EPOCHS - 1)))
-    
-    # evaluating_performance_and_save_tsne_plot(tripletNetwork_tmwdl, datamodule=dm, plot_name='TripletMarginWithDistanceLoss-epoch-{}-TSNE'.format(MAX_EPOCHS - 1))
\ No newline at end of file
+    # evaluator.submit(trainer1, dm, ckpt_path=join(MAIN_MODELS_FOLDER, 'TripletMarginWithDistanceLoss-epoch-{}.ckpt'.format(MAX_EPOCHS - 1)),
+    #                     plot_name='TripletMarginWithDistanceLoss-epoch-{}-TSNE'.format(MAX_EPOCHS - 1))
+    # evaluator.join()
\ No newline at end of file